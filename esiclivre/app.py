@@ -8,16 +8,21 @@ from flask import Flask, send_file, send_from_directory
 from flask.ext.cors import CORS
 from flask.ext.restplus import apidoc
 
-from extensions import db, sv
+from control import BrowserControl
+from extensions import db, sv, pedido_cache, token_cache
 from views import api
-from browser import ESicLivre
 
 
-def create_app():
+def create_app(with_browser=None):
+    '''Creates the app. Unless `with_browser` is False (or BROWSER_ENABLED
+    is False, if it's None), it also configures the browser (that still
+    needs to be started).'''
     # App
     app = Flask(__name__)
     app.config.from_pyfile('../settings/common.py', silent=False)
     app.config.from_pyfile('../settings/local_settings.py', silent=False)
+    if with_browser is None:
+        with_browser = app.config['BROWSER_ENABLED']
     configure_logging(app)
     CORS(app, resources={r"*": {"origins": "*"}})
 
@@ -27,22 +32,44 @@ def create_app():
     # Signer/Verifier
     sv.config(pub_key_path="settings/keypub")
 
-    # Browser
-    browser = ESicLivre()
-    browser.config(
-        firefox=app.config['FIREFOX_PATH'],
-        email=app.config['ESIC_EMAIL'],
-        senha=app.config['ESIC_PASSWORD'],
-        pasta=app.config['DOWNLOADS_PATH'],
-        logger=app.logger,
-        app=app,
+    # Cache
+    pedido_cache.config(
+        backend=app.config['PEDIDO_CACHE_BACKEND'],
+        size=app.config['PEDIDO_CACHE_SIZE'],
+        ttl=app.config['PEDIDO_CACHE_TTL'],
+        url=app.config['PEDIDO_CACHE_URL'],
+        )
+    token_cache.config(
+        size=app.config['TOKEN_CACHE_SIZE'],
+        ttl=app.config['TOKEN_CACHE_TTL'],
         )
+
+    # Browser control, opened by path so processes created apart share it
+    control = BrowserControl(app.config['BROWSER_CONTROL_PATH'])
+
+    # Browser
+    if with_browser:
+        # Imported here so API only processes don't load selenium & cia
+        from browser import ESicLivre
+        browser = ESicLivre()
+        browser.config(
+            firefox=app.config['FIREFOX_PATH'],
+            email=app.config['ESIC_EMAIL'],
+            senha=app.config['ESIC_PASSWORD'],
+            pasta=app.config['DOWNLOADS_PATH'],
+            logger=app.logger,
+            app=app,
+            control=control,
+            )
+    else:
+        browser = None
     app.browser = browser
 
     # API
     api.init_app(app)
     app.register_blueprint(apidoc.apidoc)
     api.browser = browser
+    api.control = control
 
     # TODO: colocar isso em um lugar descente...
     @app.route('/static/<path:path>')
@@ -56,6 +83,12 @@ def create_app():
     return app
 
 
+def create_api_app():
+    '''Creates the app without the browser, for API workers. Doesn't
+    import anything related to the scraper nor start helper processes.'''
+    return create_app(with_browser=False)
+
+
 def configure_logging(app):
     """Configure file(info) and email(error) logging."""
 
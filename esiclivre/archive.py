@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import os
+import shutil
+
+from errors import ArchiveError
+
+
+class InternetArchiveBackend(object):
+    '''Archives files in archive.org items.'''
+
+    def upload(self, identifier, path, metadata=None, name=None):
+        '''Uploads the file in `path` to the item `identifier`, as `name`
+        (its file name by default), replacing a file with the same name.
+        Raises ArchiveError if it fails.'''
+        # Only needed by this backend
+        import internetarchive
+        result = internetarchive.Item(identifier).upload(
+            {name or os.path.basename(path): path}, metadata=metadata or {})
+        if not result or result[0].status_code != 200:
+            raise ArchiveError('Upload of {} to {} failed: {}'.format(
+                path, identifier,
+                result[0].status_code if result else 'no response'))
+
+
+class LocalArchiveBackend(object):
+    '''Archives files in a local folder, with a subfolder for each item.
+    Stands for archive.org in development and tests.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, identifier, path, metadata=None, name=None):
+        target = os.path.join(self.root, identifier,
+                              name or os.path.basename(path))
+        folder = os.path.dirname(target)
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # Copies to a temporary file first, so it's never incomplete
+            shutil.copyfile(path, target + '.part')
+            os.rename(target + '.part', target)
+        except (IOError, OSError) as error:
+            raise ArchiveError(str(error))
+
+
+def create_backend(config):
+    '''Returns the archive backend chosen by ARCHIVE_BACKEND.'''
+    if config['ARCHIVE_BACKEND'] == 'internetarchive':
+        return InternetArchiveBackend()
+    elif config['ARCHIVE_BACKEND'] == 'local':
+        return LocalArchiveBackend(config['ARCHIVE_LOCAL_PATH'])
+    raise ValueError(
+        'Unknown archive backend: {}'.format(config['ARCHIVE_BACKEND']))
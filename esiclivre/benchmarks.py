@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+
+# Heavy modules only the scraper needs
+SCRAPER_MODULES = ('selenium', 'speech_recognition', 'internetarchive')
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+from esiclivre.app import {factory}
+{factory}()
+print(time.time() - start)
+print(','.join(m for m in {modules!r} if m in sys.modules) or '-')
+"""
+
+PEDIDO_PAGE = """<!DOCTYPE html>
+<html><head><title>eSIC</title>
+<script type="text/javascript">var theForm = document.forms[0];</script>
+</head><body>
+<form method="post" action="./detalhes_pedido_v2.aspx" id="aspnetForm">
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />
+<table id="ctl00_MainContent_dtv_pedido"><tbody>
+<tr><td>Protocolo</td><td>{protocol}</td></tr>
+<tr><td>Interessado</td><td>Fulano de Tal</td></tr>
+<tr><td>Data do pedido</td><td>{date}</td></tr>
+<tr><td>Órgão</td><td>SMS - Secretaria Municipal da Saúde</td></tr>
+<tr><td>Forma de recebimento</td><td>Pelo sistema (com avisos por email)</td></tr>
+<tr><td>Descrição</td><td>{description}</td></tr>
+</tbody></table>
+<fieldset id="fildSetSituacao"><table><tbody>
+<tr><td>Situação:</td><td>{situation}</td><td></td></tr>
+</tbody></table></fieldset>
+<table id="ctl00_MainContent_grid_historico"><tbody>
+<tr><th>Data</th><th>Situação</th><th>Justificativa</th><th>Responsável</th></tr>
+{history}
+</tbody></table>
+{attachments}
+</form></body></html>
+"""
+
+HISTORY_ROW = """<tr><td><span>{date}</span></td><td>{situation}</td>
+<td>{justification}</td><td>SIC - SMS</td></tr>"""
+
+LISTING_PAGE = """<!DOCTYPE html>
+<html><body><form method="post" action="./consultar_pedido_v2.aspx">
+<table id="ctl00_MainContent_grid_pedido"><tbody>
+<tr><th>Protocolo</th><th>Data do pedido</th><th>Situação</th></tr>
+{rows}
+</tbody></table>
+</form></body></html>
+"""
+
+LISTING_ROW = (
+    """<tr><td><a href="javascript:__doPostBack("""
+    """'ctl00$MainContent$grid_pedido','Select${position}')">"""
+    """{protocol}</a></td>
+<td>01/03/2015</td><td>{situation}</td></tr>""")
+
+ATTACHMENTS_GRID = """<table id="ctl00_MainContent_grid_anexos_resposta"><tbody>
+<tr><th>Arquivo</th><th>Data</th><th></th></tr>
+{rows}
+</tbody></table>"""
+
+ATTACHMENT_ROW = """<tr><td>Resposta {number}.PDF</td><td>{date}</td>
+<td><input type="image" name="ctl00$MainContent$grid$ctl0{number}$btn"
+ src="img/download.png" /></td></tr>"""
+
+
+def mean_time(func, repeat):
+    '''Returns the mean time of a call to `func`, in seconds.'''
+    return timeit.Timer(func).timeit(number=repeat) / repeat
+
+
+def token_verification(token, repeat=1000):
+    '''Compares the per request cost of verifying a token signature every
+    time with using the verified tokens cache.'''
+    from viralata.utils import decode_token
+    from cache import TokenCache
+    from extensions import sv
+    from views import api
+
+    cache = TokenCache()
+    return {
+        'uncached': mean_time(lambda: decode_token(token, sv, api), repeat),
+        'cached': mean_time(
+            lambda: cache.decode(token, lambda: decode_token(token, sv, api)),
+            repeat),
+    }
+
+
+def app_startup(repeat=5):
+    '''Measures the time to import and create the app, with and without
+    the browser, each time in a new process. Returns the mean time and
+    which of the SCRAPER_MODULES were loaded, by app factory.'''
+    script = STARTUP_SCRIPT.format(
+        factory='{factory}', modules=tuple(str(m) for m in SCRAPER_MODULES))
+    results = {}
+    for factory in ('create_app', 'create_api_app'):
+        times = []
+        for _ in range(repeat):
+            output = subprocess.check_output([
+                sys.executable, '-c', script.format(factory=factory)
+            ]).decode('utf8').split()
+            times.append(float(output[-2]))
+            loaded = [m for m in output[-1].split(',') if m != '-']
+        results[factory] = (sum(times) / len(times), loaded)
+    return results
+
+
+def synthetic_situation(protocol):
+    return 'Respondido' if protocol % 2 else 'Em tramitação'
+
+
+def synthetic_pedido_page(protocol, messages=5, attachments=2):
+    '''Returns a pedido page like the ones of eSIC.'''
+    def date(day):
+        return '{:02}/03/2015 1{}:2{}:0{}'.format(day + 1, day % 10,
+                                                  day % 6, day % 10)
+    history = '\n'.join(
+        HISTORY_ROW.format(date=date(i), situation='Em tramitação',
+                           justification='Encaminhado para a área. ' * i)
+        for i in range(messages)
+    )
+    attachments_grid = ''
+    if attachments:
+        attachments_grid = ATTACHMENTS_GRID.format(rows='\n'.join(
+            ATTACHMENT_ROW.format(number=i, date=date(i))
+            for i in range(attachments)
+        ))
+    return PEDIDO_PAGE.format(
+        protocol=protocol,
+        viewstate='dDwtMTQ' * 200,
+        date=date(0),
+        description='Solicito a lista de unidades de saúde. ' * 20,
+        situation=synthetic_situation(protocol),
+        history=history,
+        attachments=attachments_grid,
+    )
+
+
+def load_pedido_pages(corpus=None, size=200):
+    '''Returns the .html pages saved in the `corpus` directory, or `size`
+    synthetic ones.'''
+    if not corpus:
+        return [synthetic_pedido_page(protocol, attachments=protocol % 3)
+                for protocol in range(1, size + 1)]
+    pages = []
+    for name in sorted(os.listdir(corpus)):
+        if name.endswith('.html'):
+            with open(os.path.join(corpus, name), 'rb') as page:
+                pages.append(page.read().decode('utf8'))
+    return pages
+
+
+def pedido_fields(pedido):
+    '''Everything parsed from a pedido page, to compare parsers.'''
+    return {
+        'protocol': pedido.protocol,
+        'interessado': pedido.interessado,
+        'request_date': pedido.request_date,
+        'orgao': pedido.orgao,
+        'contact_option': pedido.contact_option,
+        'description': pedido.description,
+        'situation': pedido.situation,
+        'has_attachments_grid': pedido.has_attachments_grid(),
+        'attachments': [(a.filename, a.created_at)
+                        for a in pedido.attachments],
+        'history': [(h.situation, h.justification, h.responsible, h.date)
+                    for h in pedido.history],
+    }
+
+
+def parse_pedido_pages(parser, pages):
+    return [parser.pedido(parser.document(page), None) for page in pages]
+
+
+def peak_memory():
+    '''Peak memory used by this process, in KiB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _put_result(results, func, args):
+    results.put(func(*args))
+
+
+def run_in_process(func, *args):
+    '''Returns func(*args), called in a new process, so its peak memory
+    isn't affected by what was done before.'''
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_put_result, args=(results, func, args))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _measure_parser(name, pages, repeat):
+    from preprocessors.pedidos import get_parser
+    parser = get_parser(name)
+    before = peak_memory()
+    start = time.time()
+    for _ in range(repeat):
+        parse_pedido_pages(parser, pages)
+    elapsed = time.time() - start
+    return len(pages) * repeat / elapsed, peak_memory() - before
+
+
+def pedido_parsers(corpus=None, repeat=3, names=('html5lib', 'lxml')):
+    '''Measures the pedido pages parsed per second and the peak memory
+    growth (KiB) of each parser backend. Also returns how many pages were
+    parsed differently by them.'''
+    from preprocessors.pedidos import get_parser
+    pages = load_pedido_pages(corpus)
+    measures = dict(
+        (name, run_in_process(_measure_parser, name, pages, repeat))
+        for name in names
+    )
+
+    parsed = [
+        [pedido_fields(p) for p in parse_pedido_pages(get_parser(n), pages)]
+        for n in names
+    ]
+    mismatches = sum(1 for fields in zip(*parsed)
+                     if any(f != fields[0] for f in fields[1:]))
+    return measures, mismatches
+
+
+def synthetic_listing_page(protocols):
+    '''Returns a listing of pedidos like the one of eSIC.'''
+    return LISTING_PAGE.format(rows='\n'.join(
+        LISTING_ROW.format(position=i, protocol=protocol,
+                           situation=synthetic_situation(protocol))
+        for i, protocol in enumerate(protocols)
+    ))
+
+
+class SyntheticListing(object):
+    '''Stands for the browser showing a listing of synthetic pedidos. If
+    not `attachments`, pedidos have none (so there is nothing to
+    download). `on_open` is called with how many pedidos were opened after
+    each one.'''
+
+    class Link(object):
+
+        def __init__(self, listing, protocol):
+            self.listing = listing
+            self.protocol = protocol
+
+        def click(self):
+            attachments = self.protocol % 3 if self.listing.attachments else 0
+            self.listing.page_source = synthetic_pedido_page(
+                self.protocol, attachments=attachments)
+            self.listing.opened += 1
+            if self.listing.on_open:
+                self.listing.on_open(self.listing.opened)
+
+    def __init__(self, size, attachments=True, on_open=None):
+        self.navegador = self
+        self.logger = logging.getLogger(__name__)
+        self.attachments = attachments
+        self.on_open = on_open
+        self.opened = 0
+        protocols = range(1, size + 1)
+        self._listing = synthetic_listing_page(protocols)
+        self._links = [self.Link(self, protocol) for protocol in protocols]
+        self.page_source = self._listing
+
+    def find_element_by_id(self, element_id):
+        return self
+
+    def find_elements_by_tag_name(self, name):
+        return self._links
+
+    def back(self):
+        self.page_source = self._listing
+
+    def ir_para_consultar_pedido(self):
+        self.back()
+
+
+def scratch_app(db_path, **config):
+    '''Returns an app with the default settings (updated with `config`)
+    and a SQLite DB in the file `db_path`, so the scraper can run apart
+    from the real DB. Tables are created by scratch_db.'''
+    import flask
+    from extensions import db
+    app = flask.Flask('esiclivre')
+    app.config.from_pyfile('../settings/common.py', silent=False)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path,
+                      **config)
+    db.init_app(app)
+    return app
+
+
+def scratch_db():
+    '''Creates the tables of the current (scratch) app.'''
+    from extensions import db
+    from search import create_search_index
+    db.create_all()
+    create_search_index(db.engine)
+
+
+def _measure_sync_memory(size, parser_name, checkpoints):
+    from preprocessors.pedidos import update_pedidos_list
+    # A DB in memory would count as memory of the sync
+    folder = tempfile.mkdtemp()
+    app = scratch_app(os.path.join(folder, 'scratch.db'),
+                      SCRAPER_ENGINE='browser', PEDIDO_PARSER=parser_name)
+    growth = []
+
+    def on_open(count):
+        if count in checkpoints:
+            growth.append((count, peak_memory() - before))
+    browser = SyntheticListing(size, attachments=False, on_open=on_open)
+
+    try:
+        with app.app_context():
+            scratch_db()
+            before = peak_memory()
+            # Saves them all, then finds them all unchanged
+            update_pedidos_list(browser, incremental=False)
+            update_pedidos_list(browser, incremental=False)
+    finally:
+        shutil.rmtree(folder)
+    return growth
+
+
+def sync_memory(size=5000, parser='html5lib'):
+    '''Syncs twice, with the browser engine, a synthetic listing of `size`
+    pedidos without attachments, on a scratch DB file: all of them are
+    saved the first time and skipped (as their digests didn't change) the
+    second. Returns the peak memory growth (KiB) after each tenth of them
+    (opened in the two syncs), which should stay flat as pages aren't
+    kept.'''
+    checkpoints = set(2 * size * i // 10 for i in range(1, 11))
+    return run_in_process(_measure_sync_memory, size, parser, checkpoints)
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def load_captcha_corpus(corpus):
+    '''Returns the (path, value) of the labeled captcha audios in the
+    `corpus` directory, named "<value>.wav" or "<value>-<anything>.wav" (as
+    kept in CAPTCHA_CORPUS_PATH), and how many are still unlabeled.'''
+    from captcha import UNLABELED
+    samples = []
+    for name in sorted(os.listdir(corpus)):
+        if name.endswith('.wav'):
+            value = name[:-len('.wav')].split('-', 1)[0]
+            samples.append((os.path.join(corpus, name), value))
+    unlabeled = os.path.join(corpus, UNLABELED)
+    pending = 0
+    if os.path.isdir(unlabeled):
+        pending = sum(1 for name in os.listdir(unlabeled)
+                      if name.endswith('.wav'))
+    return samples, pending
+
+
+def logins_times(attempts, fetch_time, pipelined):
+    '''Splits the (solved, seconds) captcha attempts into logins, each
+    ending at a solved captcha, and returns the time each took.
+
+    Downloading a captcha takes `fetch_time`. One at a time, each attempt
+    downloads and then transcribes. Pipelined, the next download overlaps
+    the transcription. Login requests aren't counted, as they are the same
+    in both cases.'''
+    times = []
+    elapsed = fetch_time
+    for solved, seconds in attempts:
+        if solved:
+            times.append(elapsed + seconds)
+            elapsed = fetch_time
+        elif pipelined:
+            elapsed += max(seconds, fetch_time)
+        else:
+            elapsed += seconds + fetch_time
+    return times
+
+
+def captcha_solvers(corpus, config, names=None, fetch_time=1.0):
+    '''Transcribes the labeled captchas of `corpus` with each solver (the
+    CAPTCHA_SOLVER by default). Returns the rate of captchas solved and the
+    median time to login, one captcha at a time and pipelined, by solver,
+    and how many captchas are labeled and unlabeled.'''
+    from captcha import create_solver
+    samples, unlabeled = load_captcha_corpus(corpus)
+    results = {}
+    for name in names or [config['CAPTCHA_SOLVER']]:
+        solver = create_solver(config, name)
+        attempts = []
+        for path, value in samples:
+            start = time.time()
+            solved = solver.solve(path) == value
+            attempts.append((solved, time.time() - start))
+        solved = sum(1 for ok, _ in attempts if ok)
+        results[name] = (
+            solved / float(len(attempts)) if attempts else 0.0,
+            median(logins_times(attempts, fetch_time, False)),
+            median(logins_times(attempts, fetch_time, True)),
+        )
+    return results, len(samples), unlabeled
@@ -26,21 +26,22 @@ import shutil
 import random
 import time
 import pickle
-from multiprocessing import Process, Manager
+from multiprocessing import Process
 # from datetime import datetime
 
 import arrow
 from selenium import webdriver
 from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-import speech_recognition as sr
 
+from captcha import (CaptchaFetcher, CaptchaPrefetcher, clean_captcha,
+                     create_solver, save_to_corpus)
+from downloads import DownloadWaiter
+from errors import CaptchaError, LoginNeeded
 from extensions import db
-from models import Orgao, PrePedido, PedidosUpdate, OrgaosUpdate
+from models import (Orgao, PrePedido, PedidosUpdate, OrgaosUpdate,
+                    ResourceVersion)
 from preprocessors import pedidos as pedidos_preproc
-
-
-class LoginNeeded(Exception):
-    pass
+from uploader import Uploader
 
 
 class ESicLivre(object):
@@ -59,14 +60,13 @@ class ESicLivre(object):
         self.app = None
         self.logger = None
 
-        manager = Manager()
-        self.safe_dict = manager.dict()
-        self.clear_captcha()
-        self.stop()
+        # Shared with the API processes (see control.BrowserControl)
+        self.control = None
 
         self.try_break_audio_captcha = True
         self.nome_audio_captcha = "somCaptcha.wav"
-        self.recognizer = sr.Recognizer(str('pt-BR'))
+        # Created when first needed (see captcha.create_solver)
+        self.captcha_solver = None
 
         self.user_agent = (
             "User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:28.0)"
@@ -74,6 +74,7 @@ class ESicLivre(object):
         )
         self.base_url = 'http://esic.prefeitura.sp.gov.br'
         self.login_url = self.base_url + '/Account/Login.aspx'
+        self.audio_url = self.base_url + '/Account/pgAudio.ashx'
 
         self.logado = False
         self.ja_tentou_cookies_salvos = False
@@ -132,15 +133,15 @@ class ESicLivre(object):
     def ir_para_login(self):
         self.navegador.get(self.base_url + "/Account/Login.aspx")
 
+    def solver(self):
+        if not self.captcha_solver:
+            self.captcha_solver = create_solver(self.app.config)
+        return self.captcha_solver
+
     def transcribe_audio_captcha(self):
         self.logger.info("Transcribing audio captcha...")
         audio_path = os.path.join(self.pasta, self.nome_audio_captcha)
-        with sr.WavFile(str(audio_path)) as source:
-            audio = self.recognizer.record(source)
-        try:
-            return self.recognizer.recognize(audio)
-        except LookupError:
-            return None
+        return self.solver().transcribe(audio_path)
 
     def baixar_audio_captcha(self):
         # Removes the last downloaded audio file, avoiding adding (1) to
@@ -153,11 +154,15 @@ class ESicLivre(object):
         self.logger.info("Downloading audio captcha...")
         # Esse número deve ser usado para evitar problemas com a cache
         n = random.randint(1, 400)
-        link = self.base_url + "/Account/pgAudio.ashx?%s" % n
-        self.navegador.get(link)
-        time.sleep(3)
-        while str(self.nome_audio_captcha + ".part") in os.listdir(self.pasta):
-            time.sleep(1)
+        link = self.audio_url + "?%s" % n
+        waiter = DownloadWaiter(self.pasta)
+        try:
+            self.navegador.get(link)
+            if not waiter.wait(lambda name: name == self.nome_audio_captcha,
+                               self.app.config['DOWNLOAD_TIMEOUT']):
+                self.logger.info("Audio captcha download didn't finish.")
+        finally:
+            waiter.close()
 
     def baixar_imagem_captcha(self):
         # Removes the last downloaded audio file, avoiding adding (1) to
@@ -300,17 +305,16 @@ class ESicLivre(object):
         return self.criar_dicio_orgaos().keys()
 
     def set_captcha(self, value):
-        self.safe_dict['captcha'] = value
+        self.control.set_captcha(value)
 
     def get_captcha(self):
-        return self.safe_dict['captcha']
+        return self.control.get_captcha()
 
     def clear_captcha(self):
-        self.safe_dict['captcha'] = ''
+        self.control.clear_captcha()
 
     def stop(self):
-        process = Process(target=self.__stop_func__)
-        process.start()
+        self.control.stop()
 
     def start(self):
         process = Process(target=self.__run__)
@@ -323,41 +327,81 @@ class ESicLivre(object):
     def take_care_of_captcha(self):
         if not self.esta_em_login():
             self.ir_para_login()
-        f = True
-        while f:
+        while True:
             self.baixar_audio_captcha()
-            captcha = self.transcribe_audio_captcha()
+            transcription = self.transcribe_audio_captcha()
+            self.logger.info("Transcribed captcha: %s" % transcription)
+            captcha = clean_captcha(transcription)
             if captcha:
-                captcha = captcha.replace("ver ", "v")
-                captcha = captcha.replace(" ", "")
-                self.logger.info("Transcribed captcha: %s" % captcha)
-                if len(captcha) == 4:
-                    break
+                return captcha
             self.gerar_novo_captcha()
-        return captcha
+
+    def usar_cookies(self, cookies):
+        '''Logs the browser in with the cookies of a HTTP session.'''
+        self.ir_para_login()
+        self.navegador.delete_all_cookies()
+        for cookie in cookies:
+            self.navegador.add_cookie(cookie)
+        self.ir_para_consultar_pedido()
+        return not self.esta_em_login()
+
+    def login_com_captcha_prefetch(self):
+        '''Tenta logar por HTTP, transcrevendo cada captcha enquanto os
+        próximos são baixados, cada um na sua sessão (CAPTCHA_PREFETCH).'''
+        config = self.app.config
+        fetcher = CaptchaFetcher(
+            self.login_url, self.audio_url,
+            self.user_agent.split(':', 1)[-1].strip(), self.pasta,
+            config['CAPTCHA_FETCH_TIMEOUT'])
+        prefetcher = CaptchaPrefetcher(fetcher, config['CAPTCHA_PREFETCH'])
+        try:
+            for _ in range(config['CAPTCHA_MAX_ATTEMPTS']):
+                captcha = prefetcher.get(config['CAPTCHA_FETCH_TIMEOUT'])
+                try:
+                    value = self.solver().solve(captcha.audio_path)
+                    self.logger.info("Transcribed captcha: %s" % value)
+                    solved = False
+                    if value:
+                        self.logger.info("Trying to login...")
+                        solved = (
+                            captcha.login(self.email, self.senha, value) and
+                            self.usar_cookies(captcha.cookies()))
+                    # Also the failed ones, so the corpus isn't only made of
+                    # captchas this solver got right
+                    save_to_corpus(config['CAPTCHA_CORPUS_PATH'],
+                                   captcha.audio_path, value, solved)
+                    if solved:
+                        return True
+                finally:
+                    captcha.discard()
+        finally:
+            prefetcher.close()
+        return False
 
     def __run__(self):
-        if not self.safe_dict['running']:
+        # Set flag that can be used later to stop running, unless another
+        # process already runs the browser
+        if self.control.start(os.getpid()):
             # Get context needed for DB
             with self.app.app_context():
-                # Set flag that can be used later to stop running
-                self.safe_dict['running'] = True
+                self.control.set_status('Starting browser')
                 self.criar_navegador()
+                uploader = Uploader(self.app)
+                uploader.start()
 
                 try:
                     self.preparar_receber_captcha()
                     # Main loop
-                    while self.safe_dict['running']:
+                    while self.control.running:
                         self.main_loop()
                         time.sleep(5)
                 except:
                     raise
                 finally:
+                    self.control.set_status('Stopped')
+                    uploader.stop()
                     self.navegador.quit()
 
-    def __stop_func__(self):
-        self.safe_dict['running'] = False
-
     def verificar_lista_orgaos(self):
         # # Loads orgaos list if empty (or with only test data)
         # orgaos = db.session.query(Orgao.name).all()
@@ -390,6 +434,17 @@ class ESicLivre(object):
 
     def login_com_captcha(self):
         '''Tenta interagir com captcha'''
+        prefetch = self.app.config['CAPTCHA_PREFETCH']
+        if self.try_break_audio_captcha and prefetch:
+            try:
+                if self.login_com_captcha_prefetch():
+                    self.logado = True
+                    self.salvar_cookies()
+                    self.logger.info("Seems to have logged in!")
+                return
+            except (CaptchaError, requests.RequestException) as error:
+                self.logger.info(
+                    "HTTP login failed ({}), using the browser.".format(error))
         tentativas = 0
         while not self.logado and tentativas < 10:
             tentativas += 1
@@ -407,6 +462,12 @@ class ESicLivre(object):
                 self.logado = True
                 self.salvar_cookies()
                 self.logger.info("Seems to have logged in!")
+            if self.try_break_audio_captcha:
+                # Also the failed ones (see login_com_captcha_prefetch)
+                save_to_corpus(
+                    self.app.config['CAPTCHA_CORPUS_PATH'],
+                    os.path.join(self.pasta, self.nome_audio_captcha),
+                    captcha, self.logado)
 
     # Subprocess Functions
 
@@ -416,6 +477,7 @@ class ESicLivre(object):
             self.ja_tentou_cookies_salvos = True
 
         if not self.logado:
+            self.control.set_status('Logging in')
             self.login_com_captcha()
 
         if self.logado:
@@ -425,7 +487,7 @@ class ESicLivre(object):
                 # pedidos_preproc.update_pedidos_list(self)
 
                 # counter = 0
-                while self.safe_dict['running']:
+                while self.control.running:
                     # Keep alive; for how long? ...
                     # if counter == 120:
 
@@ -443,7 +505,7 @@ class ESicLivre(object):
                     self.active_loop()
 
                     if self.rodar_apenas_uma_vez:
-                        self.safe_dict['running'] = False
+                        self.control.running = False
                         return True
 
                     # counter += 1
@@ -453,11 +515,13 @@ class ESicLivre(object):
                 self.logger.info("Seems to have been logged out...")
 
             self.logger.info("Need new captcha...")
+            self.control.set_status('Waiting captcha')
             self.preparar_receber_captcha()
 
     def active_loop(self):
         """Does routine stuff inside eSIC, like posting pedidos."""
 
+        self.control.set_status('Sending pedidos')
         pending_pre_pedidos = db.session.query(
             PrePedido).filter_by(state='WAITING').all()
 
@@ -472,35 +536,46 @@ class ESicLivre(object):
         # TODO: ver se quem quer recorrer
         # TODO: ver precisa olhar respostas aos pedidos
 
-        # Inicialmente, a atualização dos pedidos é feita uma vez ao dia
-        # TODO: Abrir uma issue para discutir melhor o processo de atualização
-        # de pedidos
+        # A atualização completa dos pedidos é feita uma vez ao dia, a
+        # incremental a cada PEDIDOS_SYNC_INTERVAL minutos
         last_update = db.session.query(PedidosUpdate).order_by(
             PedidosUpdate.date.desc()).first()  # noqa
 
-        if last_update and last_update.date.date() == arrow.now().date():
+        refresh = self.control.take_refresh()
+        if self.app.config['PEDIDOS_SYNC_MODE'] == 'incremental':
+            interval = self.app.config['PEDIDOS_SYNC_INTERVAL']
+            up_to_date = (
+                last_update and
+                last_update.date > arrow.now().replace(minutes=-interval))
+        else:
+            up_to_date = (
+                last_update and last_update.date.date() == arrow.now().date())
+        if not refresh and up_to_date:
             # self.logger.info("%s: Já houve atualização hoje!" % arrow.now())
+            self.control.set_status('Idle')
             return None
         else:
+            self.control.set_status('Updating pedidos')
             pedidos_preproc.update_pedidos_list(self)
+            self.control.set_status('Idle')
 
         self.logger.info("Nothing more to do...")
 
     def update_orgaos_list(self):
+        names = set(self.lista_de_orgaos())
+        if not names:
+            self.logger.info("No 'orgaos' found, keeping the old list.")
+            return
+
+        # Replaced and versioned in a single transaction, so clients never
+        # see (and cache) an empty or partial list
         db.session.query(Orgao).delete()
+        db.session.add_all([Orgao(name=name) for name in names])
+        ResourceVersion.bump('orgaos')
         db.session.commit()
 
-        new_orgaos = False
-        for org in self.lista_de_orgaos():
-            if not Orgao.query.filter_by(name=org).first():
-                db.session.add(Orgao(name=org))
-                new_orgaos = True
-
-        if new_orgaos:
-            db.session.commit()
-
-            self._last_update_of_orgao_list = arrow.utcnow()
+        self._last_update_of_orgao_list = arrow.utcnow()
 
-            self.logger.info("Last update of the 'orgaos' list: {}".format(
-                self._last_update_of_orgao_list
-            ))
+        self.logger.info("Last update of the 'orgaos' list: {}".format(
+            self._last_update_of_orgao_list
+        ))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+
+class LRUCache(object):
+    '''In-process cache with bounded size and least recently used eviction.
+
+    Entries may also have a time to live, in seconds.'''
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires_at = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires_at is not None and expires_at <= time.time():
+                return None
+            # Reinsert to mark as the most recently used
+            self._data[key] = (value, expires_at)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires_at)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache(object):
+    '''Cache stored in Redis, shared by all processes using the same server.
+
+    Values must be JSON serializable. Size and eviction are handled by the
+    server, that should use "maxmemory" with "maxmemory-policy allkeys-lru".
+    '''
+
+    def __init__(self, url, prefix='esiclivre:', ttl=None):
+        # Optional dependency, only needed if this backend is used
+        import redis
+        self._redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value.decode('utf8')) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._redis.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self._redis.delete(*keys)
+
+
+class PedidoCache(object):
+    '''Read-through cache of serialized pedidos, by id and by protocol.
+
+    Each entry keeps the `version` of the pedido it was loaded from (its
+    ETag, that changes with Pedido.updated_at) and is loaded again when the
+    version read from the DB differs. So changes made by other processes,
+    like the browser, are seen even by the in-process backend, that doesn't
+    get their `invalidate` calls.'''
+
+    def __init__(self):
+        self.backend = LRUCache()
+
+    def config(self, backend='memory', size=1000, ttl=None, url=None):
+        if backend == 'memory':
+            self.backend = LRUCache(max_size=size, ttl=ttl)
+        elif backend == 'redis':
+            self.backend = RedisCache(url, prefix='esiclivre:pedido:',
+                                      ttl=ttl)
+        else:
+            raise ValueError('Unknown cache backend: {}'.format(backend))
+
+    def get(self, field, value, loader, version=None):
+        '''Returns the cached pedido with `field` (id or protocol) equal to
+        `value`. If missing or cached from another `version`, loads it
+        calling `loader` and caches it.'''
+        key = '{}:{}'.format(field, value)
+        entry = self.backend.get(key)
+        if entry is not None and entry['version'] == version:
+            return entry['pedido']
+        pedido = loader()
+        if pedido is not None:
+            self.backend.set(key, {'version': version, 'pedido': pedido})
+        return pedido
+
+    def invalidate(self, pedido_id=None, protocol=None):
+        '''Removes a pedido from the cache.'''
+        keys = []
+        if pedido_id is not None:
+            keys.append('id:{}'.format(pedido_id))
+        if protocol is not None:
+            keys.append('protocol:{}'.format(protocol))
+        self.backend.delete(*keys)
+
+
+class TokenCache(object):
+    '''Cache of the claims of already verified tokens, to avoid checking
+    the same signature again.
+
+    Entries are keyed by a digest of the token, so raw tokens are never
+    stored, and live at most `ttl` seconds. Tokens expiration ("exp") is
+    checked on every use.'''
+
+    def __init__(self):
+        self.cache = LRUCache(ttl=300)
+
+    def config(self, size=1000, ttl=300):
+        self.cache = LRUCache(max_size=size, ttl=ttl)
+
+    def decode(self, token, decoder):
+        '''Returns the claims of a token, calling `decoder` to verify it
+        if it isn't cached or has expired.'''
+        if not token:
+            return decoder()
+        key = hashlib.sha256(token.encode('utf8')).hexdigest()
+        claims = self.cache.get(key)
+        if claims is not None and not self.expired(claims):
+            return claims
+        self.cache.delete(key)
+        claims = decoder()
+        if not self.expired(claims):
+            ttl = None
+            if claims.get('exp') is not None:
+                ttl = claims['exp'] - time.time()
+                if self.cache.ttl is not None:
+                    ttl = min(ttl, self.cache.ttl)
+            self.cache.set(key, claims, ttl=ttl)
+        return claims
+
+    @staticmethod
+    def expired(claims):
+        exp = claims.get('exp')
+        return exp is not None and exp <= time.time()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+import os
+import random
+import shutil
+import subprocess
+import threading
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+import bs4
+import requests
+
+from errors import CaptchaError
+
+
+# Length of eSIC captchas
+CAPTCHA_LENGTH = 4
+
+# Inputs of the login form, by id
+LOGIN_FIELDS = {
+    'email': 'ctl00_MainContent_txt_email',
+    'password': 'ctl00_MainContent_txt_senha',
+    'captcha': 'ctl00_MainContent_txtValorCaptcha',
+    'submit': 'ctl00_MainContent_btnEnviar',
+}
+
+
+def clean_captcha(text):
+    '''Returns the captcha value in a transcription, or None if it can't be
+    one.'''
+    if not text:
+        return None
+    text = text.replace("ver ", "v").replace(" ", "")
+    return text if len(text) == CAPTCHA_LENGTH else None
+
+
+class CaptchaSolver(object):
+    '''Transcribes audio captchas.'''
+
+    def transcribe(self, path):
+        '''Returns the text said in the WAV file in `path`, or None.'''
+        raise NotImplementedError
+
+    def solve(self, path):
+        '''Returns the captcha value said in the WAV file in `path`, or None
+        if it wasn't understood.'''
+        return clean_captcha(self.transcribe(path))
+
+
+class GoogleSolver(CaptchaSolver):
+    '''Transcribes with the Google Speech API (online), through
+    speech_recognition.'''
+
+    def __init__(self, language):
+        import speech_recognition as sr
+        self.sr = sr
+        self.language = language
+        if hasattr(sr.Recognizer, 'recognize_google'):
+            self.recognizer = sr.Recognizer()
+        else:
+            # SpeechRecognition < 3
+            self.recognizer = sr.Recognizer(str(language))
+        # Errors raised when nothing was understood
+        self.unrecognized = (LookupError,) + tuple(
+            getattr(sr, name) for name in ('UnknownValueError', 'RequestError')
+            if hasattr(sr, name))
+
+    def _record(self, path):
+        with self.sr.WavFile(str(path)) as source:
+            return self.recognizer.record(source)
+
+    def recognize(self, audio):
+        if hasattr(self.recognizer, 'recognize_google'):
+            return self.recognizer.recognize_google(
+                audio, language=self.language)
+        return self.recognizer.recognize(audio)
+
+    def transcribe(self, path):
+        audio = self._record(path)
+        try:
+            return self.recognize(audio)
+        except self.unrecognized:
+            return None
+
+
+class SphinxSolver(GoogleSolver):
+    '''Transcribes offline with CMU Sphinx, through speech_recognition (3.1
+    or newer) and pocketsphinx. The model of `language` must be installed.'''
+
+    def __init__(self, language):
+        super(SphinxSolver, self).__init__(language)
+        if not hasattr(self.recognizer, 'recognize_sphinx'):
+            raise CaptchaError(
+                'The sphinx captcha solver needs SpeechRecognition >= 3.1')
+
+    def recognize(self, audio):
+        return self.recognizer.recognize_sphinx(audio, language=self.language)
+
+
+class CommandSolver(CaptchaSolver):
+    '''Transcribes offline running a command, with "{path}" in its
+    arguments replaced by the path of the WAV file, that prints the text.'''
+
+    def __init__(self, command):
+        self.command = command.split()
+
+    def transcribe(self, path):
+        try:
+            output = subprocess.check_output(
+                [arg.replace('{path}', path) for arg in self.command])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return output.decode('utf8').strip()
+
+
+def create_solver(config, name=None):
+    '''Returns the captcha solver chosen by CAPTCHA_SOLVER (or `name`).'''
+    name = name or config['CAPTCHA_SOLVER']
+    if name == 'google':
+        return GoogleSolver(config['CAPTCHA_LANGUAGE'])
+    elif name == 'sphinx':
+        return SphinxSolver(config['CAPTCHA_LANGUAGE'])
+    elif name == 'command':
+        return CommandSolver(config['CAPTCHA_SOLVER_COMMAND'])
+    raise ValueError('Unknown captcha solver: {}'.format(name))
+
+
+# Subdirectory of the corpus with the audios of failed captchas
+UNLABELED = 'unlabeled'
+
+
+def save_to_corpus(corpus, path, value, solved=True):
+    '''Keeps the audio of a captcha in the `corpus` directory, named by its
+    `value`. Captchas that didn't login (not `solved`) are kept in its
+    UNLABELED subdirectory, named by the wrong value, to be labeled by
+    hand: renamed with the right value and moved to the corpus.'''
+    if not corpus:
+        return
+    if not solved:
+        corpus = os.path.join(corpus, UNLABELED)
+    if not os.path.isdir(corpus):
+        os.makedirs(corpus)
+    target = os.path.join(
+        corpus, '{}-{}.wav'.format(value or '_', uuid.uuid4().hex[:8]))
+    shutil.copyfile(path, target + '.part')
+    os.rename(target + '.part', target)
+
+
+class Captcha(object):
+    '''A captcha of its own eSIC session, that can login over HTTP.'''
+
+    def __init__(self, session, url, page, audio_path, timeout=None):
+        self.session = session
+        self.url = url
+        self.page = page
+        self.audio_path = audio_path
+        self.timeout = timeout
+
+    def login(self, email, password, value):
+        '''Posts the login form with the captcha `value`. Returns if it
+        logged in.'''
+        form = self.page.form
+        fields = dict(
+            (field['name'], field.get('value', ''))
+            for field in form.find_all('input', type='hidden')
+            if field.get('name')
+        )
+        names = {}
+        for key, element_id in LOGIN_FIELDS.items():
+            element = self.page.find(id=element_id)
+            if element is None or not element.get('name'):
+                raise CaptchaError('Login form without {}'.format(element_id))
+            names[key] = element['name']
+        fields.update({
+            names['email']: email,
+            names['password']: password,
+            names['captcha']: value,
+            names['submit']: self.page.find(
+                id=LOGIN_FIELDS['submit']).get('value', ''),
+        })
+        action = urljoin(self.url, form.get('action') or '')
+        response = self.session.post(action, data=fields,
+                                     timeout=self.timeout)
+        return response.url.split('?')[0] != self.url.split('?')[0]
+
+    def cookies(self):
+        return [
+            {'name': cookie.name, 'value': cookie.value,
+             'path': cookie.path or '/'}
+            for cookie in self.session.cookies
+        ]
+
+    def discard(self):
+        try:
+            os.remove(self.audio_path)
+        except OSError:
+            pass
+
+
+class CaptchaFetcher(object):
+    '''Opens the login page in a new HTTP session and downloads the audio of
+    its captcha to `folder`. Sessions don't share captchas, so many can be
+    fetched at once. Requests waiting more than `timeout` seconds for eSIC
+    raise requests.Timeout.'''
+
+    def __init__(self, login_url, audio_url, user_agent, folder,
+                 timeout=None):
+        self.login_url = login_url
+        self.audio_url = audio_url
+        self.user_agent = user_agent
+        self.folder = folder
+        self.timeout = timeout
+
+    def __call__(self):
+        session = requests.Session()
+        session.headers['User-Agent'] = self.user_agent
+        response = session.get(self.login_url, timeout=self.timeout)
+        page = bs4.BeautifulSoup(response.text, 'html5lib')
+        if page.form is None:
+            raise CaptchaError('Login page without form')
+        # The number avoids cached audios
+        audio = session.get(
+            '{}?{}'.format(self.audio_url, random.randint(1, 400)),
+            stream=True, timeout=self.timeout)
+        path = os.path.join(
+            self.folder, 'captcha-{}.wav'.format(uuid.uuid4().hex))
+        with open(path + '.part', 'wb') as out_file:
+            for chunk in audio.iter_content(64 * 1024):
+                out_file.write(chunk)
+        os.rename(path + '.part', path)
+        return Captcha(session, response.url, page, path, self.timeout)
+
+
+# What a failed fetch puts in the prefetched captchas
+Failure = collections.namedtuple('Failure', ['error'])
+
+
+class CaptchaPrefetcher(object):
+    '''Fetches captchas (calling `fetch`) in a thread, keeping up to
+    `depth` ready, so the next ones are downloaded while the current one
+    is transcribed. Close it when done.'''
+
+    def __init__(self, fetch, depth=1):
+        self.fetch = fetch
+        self._ready = queue.Queue(max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                item = self.fetch()
+            except (CaptchaError, requests.RequestException) as error:
+                item = Failure(error)
+            except Exception as error:
+                # Raised by get too, as the browser logs in by itself then
+                item = Failure(CaptchaError(
+                    'Fetching a captcha failed: {!r}'.format(error)))
+            while True:
+                if self._stop.is_set():
+                    if isinstance(item, Captcha):
+                        item.discard()
+                    return
+                try:
+                    self._ready.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Failure):
+                return
+
+    def get(self, timeout=None):
+        '''Returns the next captcha. Raises the error if fetching failed,
+        or CaptchaError if none was fetched in `timeout` seconds.'''
+        try:
+            item = self._ready.get(timeout=timeout)
+        except queue.Empty:
+            raise CaptchaError(
+                'No captcha fetched in {} seconds'.format(timeout))
+        if isinstance(item, Failure):
+            raise item.error
+        return item
+
+    def close(self, timeout=1):
+        '''Stops fetching, waiting up to `timeout` seconds for the fetch in
+        progress. A fetch that takes longer is discarded by the thread when
+        it ends.'''
+        self._stop.set()
+        self._thread.join(timeout)
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, Captcha):
+                item.discard()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import contextlib
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+class BrowserControl(object):
+    '''State block used to control the browser process, in a file mapped
+    to memory.
+
+    Any process opening the same `path` shares it, so the API works with a
+    browser started apart (eg.: API workers created by create_api_app).
+    Commands (set captcha, stop, refresh now) and the status are plain
+    memory reads and writes, without IPC round trips or helper processes.
+    Writes that span many bytes hold a lock on the file.'''
+
+    CAPTCHA_SIZE = 32
+    STATUS_SIZE = 128
+
+    # running, refresh requested, browser pid, heartbeat, captcha, status
+    LAYOUT = struct.Struct(
+        str('=??id{}s{}s'.format(CAPTCHA_SIZE, STATUS_SIZE)))
+    RUNNING, REFRESH, PID, HEARTBEAT, CAPTCHA, STATUS = range(6)
+
+    def __init__(self, path):
+        self.path = path
+        # Threads of a process aren't excluded by the file lock
+        self._thread_lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < self.LAYOUT.size:
+                os.ftruncate(fd, self.LAYOUT.size)
+            self._memory = mmap.mmap(fd, self.LAYOUT.size)
+        finally:
+            os.close(fd)
+        self._file = open(path, 'r+b')
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN)
+
+    def _get(self, field):
+        with self._locked():
+            return self.LAYOUT.unpack_from(self._memory)[field]
+
+    def _set(self, **fields):
+        with self._locked():
+            self._set_unlocked(**fields)
+
+    def _set_unlocked(self, **fields):
+        values = list(self.LAYOUT.unpack_from(self._memory))
+        for name, value in fields.items():
+            values[getattr(self, name.upper())] = value
+        self.LAYOUT.pack_into(self._memory, 0, *values)
+
+    @staticmethod
+    def _encode(text, size):
+        return text.encode('utf8')[:size - 1]
+
+    @staticmethod
+    def _decode(data):
+        return data.rstrip(b'\0').decode('utf8', 'ignore')
+
+    @property
+    def running(self):
+        return self._get(self.RUNNING)
+
+    @running.setter
+    def running(self, value):
+        self._set(running=bool(value))
+
+    def start(self, pid):
+        '''Marks the browser in process `pid` as running. Returns False if
+        another living process already runs it.'''
+        with self._locked():
+            state = self.LAYOUT.unpack_from(self._memory)
+            owner = state[self.PID]
+            if state[self.RUNNING] and owner != pid and process_alive(owner):
+                return False
+            self._set_unlocked(running=True, pid=pid)
+            return True
+
+    def stop(self):
+        '''Asks the browser to stop.'''
+        self.running = False
+
+    def set_captcha(self, value):
+        self._set(captcha=self._encode(value, self.CAPTCHA_SIZE))
+
+    def get_captcha(self):
+        return self._decode(self._get(self.CAPTCHA))
+
+    def clear_captcha(self):
+        self._set(captcha=b'')
+
+    def request_refresh(self):
+        '''Asks the browser to update the pedidos as soon as possible.'''
+        self._set(refresh=True)
+
+    def take_refresh(self):
+        '''Returns if a refresh was requested, clearing the request.'''
+        with self._locked():
+            requested = self.LAYOUT.unpack_from(self._memory)[self.REFRESH]
+            self._set_unlocked(refresh=False)
+        return requested
+
+    def set_status(self, text):
+        '''Sets what the browser is doing now.'''
+        self._set(status=self._encode(text, self.STATUS_SIZE),
+                  heartbeat=time.time())
+
+    def status(self):
+        with self._locked():
+            state = self.LAYOUT.unpack_from(self._memory)
+        heartbeat = state[self.HEARTBEAT]
+        return {
+            'running': state[self.RUNNING],
+            'status': self._decode(state[self.STATUS]),
+            'captcha_set': bool(self._decode(state[self.CAPTCHA])),
+            'refresh_requested': state[self.REFRESH],
+            'last_heartbeat': heartbeat if heartbeat else None,
+        }
+
+
+def process_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
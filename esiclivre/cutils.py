@@ -2,15 +2,91 @@
 # coding: utf-8
 
 from __future__ import unicode_literals  # unicode by default
+import base64
 import json
+import time
 
+import sqlalchemy as sa
+from flask import request
 from flask.ext.restplus import Api
+from werkzeug.http import http_date, quote_etag
 
 
-def paginate(query, page, per_page_num):
-    '''Paginate a query, returning also the total before pagination.'''
+# Cached query totals: {key: (total, timestamp)}
+_counts_cache = {}
+
+
+def cached_count(query, key, ttl):
+    '''Count a query's results, reusing the last total for `ttl` seconds.'''
+    now = time.time()
+    cached = _counts_cache.get(key)
+    if cached and now - cached[1] < ttl:
+        return cached[0]
     total = query.count()
-    return (query.offset(page*per_page_num).limit(per_page_num).all(), total)
+    _counts_cache[key] = (total, now)
+    return total
+
+
+def encode_cursor(*values):
+    '''Encodes JSON serializable values as an opaque pagination cursor.'''
+    data = json.dumps(values).encode('utf8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Decodes a cursor created by `encode_cursor`. Returns None if invalid.'''
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def keyset_paginate(query, columns, cursor, per_page_num, key, offset=0):
+    '''Paginate a query by descending `columns`, starting after `cursor`.
+
+    `cursor` holds the values of `columns` of the last row already seen (or
+    is None to start from the beginning) and `key` extracts those values
+    from a result row. With an index over `columns` each page is a single
+    index range scan. `offset` is only meant for legacy page numbers.
+    Returns the results and the cursor to the next page (None if last).'''
+    if cursor is not None:
+        query = query.filter(sa.tuple_(*columns) < sa.tuple_(*[
+            sa.literal(value, type_=column.type)
+            for column, value in zip(columns, cursor)
+        ]))
+    query = query.order_by(*[sa.desc(column) for column in columns])
+    if offset:
+        query = query.offset(offset)
+    results = query.limit(per_page_num + 1).all()
+    next_cursor = None
+    if len(results) > per_page_num:
+        results = results[:per_page_num]
+        next_cursor = encode_cursor(*key(results[-1]))
+    return results, next_cursor
+
+
+def conditional_headers(etag, last_modified=None):
+    '''Returns the validator headers for a response.
+
+    `last_modified` must be an Arrow object (or None).'''
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified.timestamp)
+    return headers
+
+
+def is_not_modified(etag, last_modified=None):
+    '''Checks if the client already has the current version of a response,
+    using the request If-None-Match or If-Modified-Since headers.'''
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since and last_modified is not None:
+        # HTTP dates have no microseconds
+        last_modified = last_modified.to('UTC').naive.replace(microsecond=0)
+        return last_modified <= request.if_modified_since
+    return False
 
 
 class ExtraApi(Api):
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+try:
+    # Optional, used to wait for downloads without polling (Linux only)
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+PART = '.part'
+
+
+if pyinotify:
+    class _IgnoreEvents(pyinotify.ProcessEvent):
+        # Events are only used to wake up the waiter
+        def process_default(self, event):
+            pass
+
+
+def file_digest(path):
+    '''Returns the SHA-256 and the size of a file.'''
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(64 * 1024), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def list_files(folder):
+    return [name.decode('utf8') if isinstance(name, bytes) else name
+            for name in os.listdir(folder)]
+
+
+def file_identity(path):
+    '''What tells if a file was replaced or changed, or None if it is
+    gone.'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+class DownloadWaiter(object):
+    '''Waits for files downloaded by the browser to a folder.
+
+    The browser writes a download to "<name>.part" and renames it when it
+    is done. The waiter wakes up on file events of the folder (using
+    inotify, if pyinotify is installed) or, if not available, checks the
+    folder every `poll_interval` seconds. Create it and call `expect`
+    before starting each download, and close it when done. Only files
+    that appeared after `expect` are taken for the download, and only
+    those are removed by `clean`, as other files (eg.: captchas) may be
+    kept in the folder.'''
+
+    def __init__(self, folder, poll_interval=0.2):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        # Identity of the files in the folder, by name, at `expect`
+        self._existing = None
+        # Files that appeared after any `expect`, not yet cleaned
+        self._appeared = set()
+        self._notifier = None
+        if pyinotify:
+            manager = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(manager, _IgnoreEvents())
+            manager.add_watch(
+                folder,
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE)
+
+    def _new_files(self):
+        '''Returns the files that appeared or changed since `expect`,
+        keeping track of them.'''
+        if self._existing is None:
+            return []
+        files = [
+            name for name in list_files(self.folder)
+            if name not in self._existing or self._existing[name] !=
+            file_identity(os.path.join(self.folder, name))
+        ]
+        self._appeared.update(files)
+        return files
+
+    def expect(self):
+        '''Call before starting a download, so files already in the folder
+        (left by other downloads) aren't taken for it.'''
+        # The ones left by the last download
+        self._new_files()
+        self._existing = dict(
+            (name, file_identity(os.path.join(self.folder, name)))
+            for name in list_files(self.folder))
+
+    def clean(self):
+        '''Removes the files that appeared after `expect` and were left in
+        the folder: downloads that failed (still ".part") or that were
+        never taken. Files that were already there are kept.'''
+        self._new_files()
+        for name in self._appeared:
+            path = os.path.join(self.folder, name)
+            if os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Removed meanwhile
+                    pass
+        self._appeared = set()
+
+    def finished(self, match):
+        '''Returns the name of a new file that matches (`match(name)` is
+        true) if it was fully downloaded.'''
+        files = self._new_files()
+        if any(match(name[:-len(PART)])
+               for name in files if name.endswith(PART)):
+            return None
+        return next(
+            (name for name in files
+             if not name.endswith(PART) and match(name)),
+            None
+        )
+
+    def wait(self, match, timeout=100):
+        '''Waits for a file whose name matches to be fully downloaded.
+        Returns its name, or None if it wasn't after `timeout` seconds.'''
+        deadline = time.time() + timeout
+        while True:
+            name = self.finished(match)
+            if name:
+                return name
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if self._notifier:
+                if self._notifier.check_events(int(remaining * 1000)):
+                    self._notifier.read_events()
+                    self._notifier.process_events()
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
+    def close(self):
+        if self._notifier:
+            self._notifier.stop()
+            self._notifier = None
+
+
+class StagingDir(object):
+    '''Folder where the files of a pedido wait to be archived.
+
+    Files are kept with their names normalized by `normalize`. The
+    manifest maps the original names to them and keeps the SHA-256 and size
+    of each file, so nothing needs to look at other files or folders.
+    `cleanup` removes the folder atomically. Open it and use it holding its
+    folder_lock.'''
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, root, name, normalize):
+        self.path = os.path.join(root, name)
+        self.normalize = normalize
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        try:
+            with open(os.path.join(self.path, self.MANIFEST)) as manifest:
+                data = json.load(manifest)
+        except (IOError, OSError, ValueError):
+            data = {}
+        self.manifest = data.get('names', {})
+        self.digests = data.get('digests', {})
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def add(self, original, source=None, sha256=None, size=None):
+        '''Registers a file downloaded to the folder with its `original`
+        name, or moves it from `source`. Its SHA-256 and size are computed
+        if not given. Returns its normalized name.'''
+        name = self.normalize(original)
+        shutil.move(source or self.file_path(original), self.file_path(name))
+        if sha256 is None or size is None:
+            sha256, size = file_digest(self.file_path(name))
+        self.manifest[original] = name
+        self.digests[name] = [sha256, size]
+        # Replaces the manifest atomically
+        temporary = self.file_path(self.MANIFEST + PART)
+        with open(temporary, 'w') as manifest:
+            json.dump({'names': self.manifest, 'digests': self.digests},
+                      manifest)
+        os.rename(temporary, self.file_path(self.MANIFEST))
+        return name
+
+    def digest(self, name):
+        '''Returns the SHA-256 and the size of a file.'''
+        return tuple(self.digests[name])
+
+    def has(self, name):
+        return name in self.manifest.values() and os.path.exists(
+            self.file_path(name))
+
+    def cleanup(self):
+        remove_folder(self.path)
+
+
+@contextlib.contextmanager
+def folder_lock(path):
+    '''Holds an exclusive lock on the folder `path`, against other threads
+    and processes, so it isn't removed while files are added to it. The
+    lock file is kept next to the folder, which may not exist.'''
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Created meanwhile
+            pass
+    # Each open file has its own flock, so threads also exclude each other
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def remove_folder(path):
+    '''Removes a folder, if it exists. It is renamed first, so it is either
+    complete or gone, even if the removal is interrupted.'''
+    trash = '{}.trash-{}'.format(path, uuid.uuid4().hex)
+    try:
+        os.rename(path, trash)
+    except OSError:
+        # Already removed
+        return
+    shutil.rmtree(trash, ignore_errors=True)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+
+class LoginNeeded(Exception):
+    pass
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class CaptchaError(Exception):
+    pass
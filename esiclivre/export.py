@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+
+import sqlalchemy as sa
+
+from extensions import db
+from models import Pedido
+from serializers import serialize_pedidos
+
+
+def iter_pedidos(since=None, chunk_size=500):
+    '''Yields the dicts of all pedidos (changed after `since`, if passed).
+    Pedidos without updated_at are always included, as it isn't known when
+    they changed.
+
+    Ids are read through a server-side cursor and pedidos are serialized in
+    chunks, so memory use doesn't depend on the number of pedidos.'''
+    ids = db.session.query(Pedido.id).order_by(Pedido.id)
+    if since is not None:
+        ids = ids.filter(sa.or_(Pedido.updated_at >= since,
+                                Pedido.updated_at.is_(None)))
+    ids = ids.execution_options(stream_results=True).yield_per(chunk_size)
+
+    chunk = []
+    for pedido_id, in ids:
+        chunk.append(pedido_id)
+        if len(chunk) == chunk_size:
+            for pedido in serialize_pedidos(chunk):
+                yield pedido
+            chunk = []
+    for pedido in serialize_pedidos(chunk):
+        yield pedido
+
+
+def iter_ndjson(since=None, chunk_size=500):
+    '''Yields all pedidos as newline delimited JSON.'''
+    for pedido in iter_pedidos(since, chunk_size):
+        yield json.dumps(pedido) + '\n'
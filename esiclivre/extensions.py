@@ -8,9 +8,13 @@ from flask.ext.sqlalchemy import SQLAlchemy
 from viratoken import SignerVerifier
 # from browser import ESicLivre
 
+from cache import PedidoCache, TokenCache
+
 
 # print("Importing Extensions")
 db = SQLAlchemy()
 sv = SignerVerifier()
+pedido_cache = PedidoCache()
+token_cache = TokenCache()
 # browser = ESicLivre()
 # print(db, sv)
@@ -2,12 +2,13 @@
 
 from __future__ import unicode_literals  # unicode by default
 
+import hashlib
+
 import arrow
 import sqlalchemy as sa
 import sqlalchemy_utils as sa_utils
-from sqlalchemy.orm.exc import NoResultFound
 
-from extensions import db
+from extensions import db, pedido_cache
 
 
 pedido_attachments = sa.Table(
@@ -43,6 +44,11 @@ class PedidosUpdate(db.Model):
 
     date = db.Column(sa_utils.ArrowType, index=True)
 
+    # Detail pages opened, and the ones skipped as they hadn't changed
+    pages_fetched = db.Column(db.Integer, nullable=True)
+
+    pages_skipped = db.Column(db.Integer, nullable=True)
+
 class RecursosUpdate(db.Model):
 
     __tablename__ = 'recursos_update'
@@ -52,6 +58,35 @@ class RecursosUpdate(db.Model):
     date = db.Column(sa_utils.ArrowType, index=True)
 
 
+class ResourceVersion(db.Model):
+    '''Version of a list resource, bumped every time it changes.'''
+
+    __tablename__ = 'resource_version'
+
+    name = db.Column(db.String(255), primary_key=True)
+
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    updated_at = db.Column(sa_utils.ArrowType)
+
+    @classmethod
+    def bump(cls, name):
+        '''Bumps the version of a resource. Needs to be commited.'''
+        now = arrow.utcnow()
+        updated = db.session.query(cls).filter_by(name=name).update(
+            {'version': cls.version + 1, 'updated_at': now},
+            synchronize_session=False)
+        if not updated:
+            db.session.add(cls(name=name, version=1, updated_at=now))
+
+    @classmethod
+    def current(cls, name):
+        '''Returns the version and the last update of a resource.'''
+        row = (db.session.query(cls.version, cls.updated_at)
+               .filter_by(name=name).first())
+        return row if row else (0, None)
+
+
 class PrePedido(db.Model):
 
     __tablename__ = 'pre_pedido'
@@ -81,7 +116,7 @@ class PrePedido(db.Model):
             'author_id': self.author_id,
             'orgao_name': self.orgao_name,
             'text': self.text,
-            'keywords': [keyword for keyword in self.keywords.split(',')],
+            'keywords': self.keyword_names,
             'tipo': self.tipo,
             'state': self.state
         }
@@ -94,12 +129,17 @@ class PrePedido(db.Model):
     def author(self):
         return Author.query.filter_by(id=self.author_id).one()
 
+    @property
+    def keyword_names(self):
+        '''Names in `keywords`, without blanks.'''
+        names = (name.strip() for name in (self.keywords or '').split(','))
+        return [name for name in names if name]
+
     @property
     def all_keywords(self):
-        return [
-            Keyword.query.filter_by(name=k).one()
-            for k in self.keywords.split(',')  # noqa
-        ]
+        # Avoids circular import
+        from upserts import resolve_keywords
+        return resolve_keywords(self.keyword_names)
 
     def create_pedido(self, protocolo, deadline):
 
@@ -115,9 +155,14 @@ class PrePedido(db.Model):
         pedido.description = self.text
         # pedido.request_date = datetime.datetime.today()
         pedido.request_date = arrow.utcnow()
+        pedido.updated_at = pedido.request_date
 
         db.session.add(pedido)
-        db.session.commit()
+        # Gets the pedido id
+        db.session.flush()
+        # Avoids circular import
+        from search import update_search_index
+        update_search_index([pedido.id])
 
         # self.updated_at = datetime.datetime.today()
         self.updated_at = arrow.utcnow()
@@ -125,6 +170,7 @@ class PrePedido(db.Model):
 
         db.session.add(self)
         db.session.commit()
+        pedido_cache.invalidate(pedido.id, pedido.protocol)
 
     def create_recurso(self, deadline):
 
@@ -170,6 +216,15 @@ class Pedido(db.Model):
 
     orgao_name = db.Column(db.String(255))
 
+    # Last time anything about the pedido changed
+    updated_at = db.Column(sa_utils.ArrowType, index=True)
+
+    # Digest of the pedido row in the eSIC listing when it was last synced
+    listing_summary = db.Column(db.String(40), nullable=True)
+
+    # Digest of its detail page when it was last saved (see detail_digest)
+    detail_digest = db.Column(db.String(40), nullable=True, index=True)
+
     history = db.relationship("Message", backref="pedido")
 
     author = db.relationship(
@@ -186,31 +241,15 @@ class Pedido(db.Model):
 
     @property
     def as_dict(self):
-        return {
-            'id': self.id,
-            'protocol': self.protocol,
-            'interessado': self.interessado,
-            'situation': self.situation,
-            'request_date': self.request_date.isoformat(),
-            'contact_option': self.contact_option,
-            'description': self.description,
-            'deadline': self.deadline.isoformat() if self.deadline else '',
-            'orgao_name': self.orgao_name,
-            'history': [m.as_dict for m in self.history],
-            'author': self.author.as_dict,
-            'keywords': [kw.as_dict for kw in self.keywords],
-            'attachments': [att.as_dict for att in self.attachments]
-        }
+        # Avoids circular import
+        from serializers import serialize_pedido
+        return serialize_pedido(self.id)
 
     def add_keyword(self, keyword_name):
-        try:
-            keyword = (db.session.query(Keyword)
-                       .filter_by(name=keyword_name).one())
-        except NoResultFound:
-            keyword = Keyword(name=keyword_name)
-            db.session.add(keyword)
-            db.session.commit()
-        self.keywords.append(keyword)
+        '''Adds a keyword, creating it if needed. Needs to be commited.'''
+        # Avoids circular import
+        from upserts import resolve_keywords
+        self.keywords.extend(resolve_keywords([keyword_name]))
 
 
 class Recurso(db.Model):
@@ -278,6 +317,14 @@ class Message(db.Model):
 
     __tablename__ = 'message'
 
+    __table_args__ = (
+        # Used by the keyset pagination of messages
+        db.Index('ix_message_date_id', 'date', 'id'),
+        # The same message can't be saved twice in a pedido
+        db.Index('ix_message_pedido_id_fingerprint', 'pedido_id',
+                 'fingerprint', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
 
     situation = db.Column(db.String(255))
@@ -292,6 +339,21 @@ class Message(db.Model):
 
     id_recurso = db.Column('id_recurso', db.Integer, db.ForeignKey('recurso.id'))
 
+    # See make_fingerprint
+    fingerprint = db.Column(db.String(40), nullable=True)
+
+    @staticmethod
+    def make_fingerprint(date, situation, responsible, justification):
+        '''Digest of the content of a message, that identifies it in its
+        pedido.'''
+        if date is not None:
+            # As stored by ArrowType
+            date = arrow.get(date).to('UTC').naive.isoformat()
+        content = '\x1f'.join(
+            value or '' for value in
+            (date, situation, responsible, justification))
+        return hashlib.sha1(content.encode('utf8')).hexdigest()
+
     @property
     def as_dict(self):
         return {
@@ -345,6 +407,11 @@ class Attachment(db.Model):
 
     ia_url = db.Column(sa_utils.URLType)
 
+    # Content of the file, used to avoid archiving it again
+    sha256 = db.Column(db.String(64), nullable=True, index=True)
+
+    size = db.Column(db.BigInteger, nullable=True)
+
     @property
     def as_dict(self):
         return {
@@ -371,4 +438,85 @@ class Attachment_Recurso(db.Model):
             'id': self.id,
             'name': self.name,
             'ia_url': self.ia_url
-        }
\ No newline at end of file
+        }
+
+
+class UploadTask(db.Model):
+    '''An attachment waiting to be archived (see uploader.Uploader).
+
+    Its status is PENDING (waiting its next attempt), UPLOADING, DONE or
+    FAILED (gave up after UPLOAD_MAX_ATTEMPTS).'''
+
+    __tablename__ = 'upload_task'
+
+    __table_args__ = (
+        db.Index('ix_upload_task_protocol_filename', 'pedido_protocol',
+                 'filename', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    pedido_protocol = db.Column(db.Integer, nullable=False)
+
+    filename = db.Column(db.String(255), nullable=False)
+
+    # Staging folder of the file (see downloads.StagingDir)
+    folder = db.Column(db.String(1024), nullable=False)
+
+    # Content of the file, that keys its name in the archive
+    sha256 = db.Column(db.String(64), nullable=True)
+
+    status = db.Column(db.String(20), nullable=False, index=True)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    next_attempt_at = db.Column(sa_utils.ArrowType, index=True)
+
+    last_error = db.Column(sa.UnicodeText())
+
+    updated_at = db.Column(sa_utils.ArrowType)
+
+    @staticmethod
+    def archived_name(filename, sha256=None):
+        '''Name of a file in the archive item of its pedido. It is keyed by
+        its content, so what is archived with a name never changes and can
+        be linked by other pedidos.'''
+        return '{}/{}'.format(sha256, filename) if sha256 else filename
+
+    @classmethod
+    def enqueue(cls, protocol, folder, filenames, digests=None):
+        '''Queues the upload of these files of a pedido, with their SHA-256
+        in `digests` (by file name), restarting the tasks of files queued
+        before (even if being uploaded, see Uploader.finish). Needs to be
+        commited.'''
+        cls.enqueue_many([(protocol, folder, filenames, digests)])
+
+    @classmethod
+    def enqueue_many(cls, uploads):
+        '''Same as `enqueue` for the (protocol, folder, filenames, digests)
+        of many pedidos, with a single query.'''
+        uploads = [(protocol, folder, list(filenames), digests or {})
+                   for protocol, folder, filenames, digests in uploads
+                   if filenames]
+        if not uploads:
+            return
+        now = arrow.utcnow()
+        tasks = dict(
+            ((task.pedido_protocol, task.filename), task)
+            for task in cls.query.filter(cls.pedido_protocol.in_(
+                set(protocol for protocol, _, _, _ in uploads)))
+        )
+        for protocol, folder, filenames, digests in uploads:
+            for filename in filenames:
+                task = tasks.get((protocol, filename))
+                if not task:
+                    task = cls(pedido_protocol=protocol, filename=filename)
+                    db.session.add(task)
+                    tasks[protocol, filename] = task
+                task.folder = folder
+                task.sha256 = digests.get(filename)
+                task.status = 'PENDING'
+                task.attempts = 0
+                task.next_attempt_at = now
+                task.last_error = None
+                task.updated_at = now
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+import contextlib
+import copy
+import hashlib
+import os
+import re
+
+try:
+    from urllib.parse import urljoin
+except ImportError:
+    from urlparse import urljoin
+
+import bs4
+import requests
+
+from esiclivre.errors import LoginNeeded
+from esiclivre.preprocessors.listing import PEDIDOS_GRID_ID, parse_listing
+
+
+FILENAME = re.compile(r'filename\*?=(?:UTF-8\'\')?"?([^";]+)"?', re.I)
+
+ATTACHMENTS_GRID_ID = 'ctl00_MainContent_grid_anexos_resposta'
+
+# A downloaded file, with the SHA-256 and size of its content
+Download = collections.namedtuple('Download', ['filename', 'sha256', 'size'])
+
+
+class EsicSession(object):
+    '''Fetches eSIC pages over HTTP, reusing the session of the browser.
+
+    Only the login needs the browser. ASP.NET postbacks (like clicking a
+    pedido in the grid) are replayed posting the hidden fields of the page
+    (__VIEWSTATE, __EVENTVALIDATION, ...), so no page is rendered.
+
+    `limiter` (a pipeline.HostLimiter) caps concurrent requests among
+    sessions sharing it. Requests waiting more than `timeout` seconds for
+    eSIC raise requests.Timeout. Use `clone` to get more sessions with the
+    same login, as a requests.Session shouldn't be shared by threads.'''
+
+    def __init__(self, browser, limiter=None, timeout=None):
+        self.base_url = browser.base_url
+        self.login_url = browser.login_url
+        self.consult_url = browser.base_url + '/consultar_pedido_v2.aspx'
+        self.limiter = limiter
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # browser.user_agent is written as a whole header line
+        self.session.headers['User-Agent'] = (
+            browser.user_agent.split(':', 1)[-1].strip())
+        for cookie in browser.navegador.get_cookies():
+            self.session.cookies.set(
+                cookie['name'], cookie['value'],
+                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+
+    def clone(self):
+        '''Returns a new session with the same login and limiter.'''
+        other = copy.copy(self)
+        other.session = requests.Session()
+        other.session.headers.update(self.session.headers)
+        other.session.cookies.update(self.session.cookies)
+        return other
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        if self.limiter:
+            with self.limiter.slot(url):
+                yield
+        else:
+            yield
+
+    def check_login(self, response):
+        if response.url.split('?')[0] == self.login_url:
+            raise LoginNeeded
+
+    def get_page(self, url):
+        '''Returns the final URL and the parsed page.'''
+        with self.slot(url):
+            response = self.session.get(url, timeout=self.timeout)
+        self.check_login(response)
+        return response.url, bs4.BeautifulSoup(response.text, 'html5lib')
+
+    @staticmethod
+    def get_form(url, page):
+        '''Returns the action URL and the hidden fields of the form in
+        `page` (loaded from `url`).'''
+        form = page.form
+        fields = dict(
+            (field['name'], field.get('value', ''))
+            for field in form.find_all('input', type='hidden')
+            if field.get('name')
+        )
+        return urljoin(url, form.get('action') or url), fields
+
+    def submit(self, form, target, argument, extra=None, stream=False):
+        '''Replays a postback of a form (see `get_form`), as if `target`
+        was clicked. Returns the response.'''
+        action, fields = form
+        data = dict(fields)
+        data['__EVENTTARGET'] = target
+        data['__EVENTARGUMENT'] = argument
+        data.update(extra or {})
+        with self.slot(action):
+            response = self.session.post(action, data=data, stream=stream,
+                                         timeout=self.timeout)
+        self.check_login(response)
+        return response
+
+    def postback(self, url, page, target, argument, extra=None, stream=False):
+        '''Replays a postback of the form in `page` (loaded from `url`), as
+        if `target` was clicked. Returns the response.'''
+        return self.submit(
+            self.get_form(url, page), target, argument, extra, stream)
+
+    def get_listing(self):
+        '''Returns the URL and the page listing the pedidos, and its rows
+        (see listing.ListingRow) that can be opened with a postback.'''
+        url, page = self.get_page(self.consult_url)
+        rows = [row for row in parse_listing(page.find(id=PEDIDOS_GRID_ID))
+                if row.postback]
+        return url, page, rows
+
+    def download_attachments(self, url, page, folder, select=None):
+        '''Downloads the attachments of a pedido page to `folder`, streaming
+        them to disk. If given, only the ones whose name (as shown in the
+        page) `select` returns true for are downloaded. Returns them (see
+        Download).'''
+        grid = page.find(id=ATTACHMENTS_GRID_ID)
+        if not grid:
+            return []
+        downloaded = []
+        for row in grid.find_all('tr')[1:]:
+            button = row.find('input')
+            cell = row.find('td')
+            if not button or not cell:
+                continue
+            if select and not select(cell.text):
+                continue
+            download = self.download(url, page, button, folder)
+            if download:
+                downloaded.append(download)
+        return downloaded
+
+    def download(self, url, page, button, folder):
+        '''Downloads the file sent when `button` is clicked, hashing it
+        while it is written. Returns a Download, or None if the response
+        isn't a file.'''
+        name = button.get('name')
+        if not name:
+            return None
+        if button.get('type') == 'image':
+            extra = {name + '.x': '1', name + '.y': '1'}
+        else:
+            extra = {name: button.get('value', '')}
+        response = self.postback(url, page, '', '', extra, stream=True)
+        match = FILENAME.search(response.headers.get('Content-Disposition', ''))
+        if not match:
+            response.close()
+            return None
+        filename = os.path.basename(match.group(1))
+        path = os.path.join(folder, filename)
+        sha256 = hashlib.sha256()
+        size = 0
+        # Unfinished downloads keep the .part extension
+        with open(path + '.part', 'wb') as out_file:
+            for chunk in response.iter_content(64 * 1024):
+                out_file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+        os.rename(path + '.part', path)
+        return Download(filename, sha256.hexdigest(), size)
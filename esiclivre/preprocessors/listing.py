@@ -0,0 +1,87 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+import hashlib
+import re
+import unicodedata
+
+
+PEDIDOS_GRID_ID = 'ctl00_MainContent_grid_pedido'
+
+# href of links that trigger ASP.NET postbacks
+POSTBACK = re.compile(r"__doPostBack\('([^']*)','([^']*)'\)")
+
+# A row of the pedidos grid. 'position' is the index of its link among the
+# grid links (what the browser clicks), 'postback' is the (target, argument)
+# that opens it over HTTP and 'summary' is a digest of all its columns.
+ListingRow = collections.namedtuple(
+    'ListingRow', ['position', 'protocol', 'situation', 'summary', 'postback'])
+
+
+def normalize(text):
+    '''Lowercase text without accents, to compare headers.'''
+    text = unicodedata.normalize('NFKD', text.strip().lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def find_column(header, prefix):
+    return next(
+        (i for i, name in enumerate(header) if name.startswith(prefix)),
+        None
+    )
+
+
+def parse_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
+
+def parse_listing(grid):
+    '''Returns the ListingRows of the pedidos grid (a bs4 element).'''
+    if grid is None:
+        return []
+    rows = grid.find_all('tr')
+    if not rows:
+        return []
+    header = [normalize(cell.text) for cell in rows[0].find_all(['th', 'td'])]
+    protocol_column = find_column(header, 'protocolo')
+    situation_column = find_column(header, 'situa')
+
+    links = grid.find_all('a')
+    result = []
+    for row in rows[1:]:
+        link = row.find('a')
+        if not link:
+            continue
+        match = POSTBACK.search(link.get('href', ''))
+        if match and not match.group(2).startswith('Select$'):
+            # Pager row
+            continue
+        cells = [cell.text.strip() for cell in row.find_all('td')]
+
+        if protocol_column is not None and protocol_column < len(cells):
+            protocol = parse_int(cells[protocol_column])
+        else:
+            # Protocol is the only number in the row
+            protocol = next(
+                (parse_int(c) for c in cells if parse_int(c) is not None),
+                None
+            )
+        situation = None
+        if situation_column is not None and situation_column < len(cells):
+            situation = cells[situation_column]
+
+        summary = hashlib.sha1(
+            '\x1f'.join(cells).encode('utf8')).hexdigest()
+        result.append(ListingRow(
+            position=links.index(link),
+            protocol=protocol,
+            situation=situation,
+            summary=summary,
+            postback=match.groups() if match else None,
+        ))
+    return result
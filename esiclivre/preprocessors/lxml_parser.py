@@ -0,0 +1,155 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+import hashlib
+
+import bs4
+import lxml.html
+
+from esiclivre.preprocessors.pedidos import (
+    ParsedPedido, clear_attachment_name, parse_date)
+
+
+PedidoAttachment = collections.namedtuple(
+    'PedidoAttachment', ['filename', 'created_at'])
+PedidoHistory = collections.namedtuple(
+    'PedidoHistory', ['situation', 'justification', 'responsible', 'date'])
+
+# Elements of the page with the pedido data, by id
+DETAILS_ID = 'ctl00_MainContent_dtv_pedido'
+ATTACHMENTS_ID = 'ctl00_MainContent_grid_anexos_resposta'
+SITUATION_ID = 'fildSetSituacao'
+HISTORY_ID = 'ctl00_MainContent_grid_historico'
+
+
+def text(element):
+    return element.text_content().strip()
+
+
+def table_rows(table):
+    # html5lib always adds a tbody, so the default parser only sees its rows
+    tbody = table.find('.//tbody')
+    return (tbody if tbody is not None else table).findall('.//tr')
+
+
+def cells(row):
+    return row.findall('.//td')
+
+
+def detail_digest(document):
+    '''Same as pedidos.detail_digest, for lxml documents.'''
+    form = document.find('.//form')
+    if form is None:
+        return None
+    texts = (
+        ' '.join(t.split())
+        for t in form.xpath(
+            './/text()[not(parent::script) and not(parent::style)]')
+    )
+    return hashlib.sha1(
+        '\n'.join(t for t in texts if t).encode('utf8')).hexdigest()
+
+
+class LxmlParsedPedido(ParsedPedido):
+    '''ParsedPedido that extracts all the fields in a single pass over a
+    page parsed by lxml, which is much faster than html5lib.'''
+
+    # Plain attributes, set when parsing, instead of the parent properties
+    protocol = interessado = orgao = contact_option = description = None
+
+    def __init__(self, raw_data, browser, session=None, url=None):
+
+        self._browser = browser
+        self._session = session
+        self._url = url
+        self.listing_summary = None
+        self.detail_digest = None
+        self.attachment_digests = {}
+        self.archived_copies = {}
+        self._raw_data = raw_data
+        self._main_data = raw_data.find('.//form')
+
+        self._elements = {}
+        if self._main_data is not None:
+            wanted = (DETAILS_ID, ATTACHMENTS_ID, SITUATION_ID, HISTORY_ID)
+            for element in self._main_data.iter():
+                element_id = element.get('id')
+                if element_id in wanted:
+                    self._elements.setdefault(element_id, element)
+            self._parse()
+
+    def _parse(self):
+        details = [cells(row) for row in table_rows(
+            self._elements[DETAILS_ID])]
+        values = [text(value) for _, value in details[:6]]
+        (protocol, self.interessado, request_date, self.orgao,
+         self.contact_option, self.description) = values
+        self.protocol = int(protocol)
+        self.request_date = parse_date(request_date)
+
+        self.attachments = self._parse_attachments()
+
+        situation_row = table_rows(self._elements[SITUATION_ID])[0]
+        self.situation = text(cells(situation_row)[:2][1])
+
+        self.history = self._parse_history()
+
+    def _parse_attachments(self):
+        grid = self._elements.get(ATTACHMENTS_ID)
+        if grid is None:
+            return ()  # 'Sem anexos.'
+        data = table_rows(grid)[1:]
+        if not data or not any(row.text_content().split() for row in data):
+            return ()  # 'Sem anexos.'
+
+        result = ()
+        for row in data:
+            filename, created_at, _ = cells(row)
+            result += (PedidoAttachment(
+                filename=clear_attachment_name(filename.text_content()),
+                created_at=parse_date(text(created_at)),
+            ),)
+        return result
+
+    def _parse_history(self):
+        result = ()
+        for row in table_rows(self._elements[HISTORY_ID])[1:]:
+            situation, justification, responsible = cells(row)[1:]
+            result += (PedidoHistory(
+                situation=text(situation),
+                justification=text(justification),
+                responsible=text(responsible),
+                date=parse_date(text(row.find('.//span'))),
+            ),)
+        try:
+            result = sorted(result, key=lambda h: h.date)
+        except:
+            pass
+        return result
+
+    def has_attachments_grid(self):
+        # In the whole page, as ParsedPedido does, not only in the form
+        grid = self._raw_data.get_element_by_id(ATTACHMENTS_ID, None)
+        return grid is not None
+
+    def _page(self):
+        # EsicSession downloads attachments from a BeautifulSoup page, so
+        # pages with modified attachments are parsed again by html5lib,
+        # losing the lxml speedup on them (their downloads take longer)
+        return bs4.BeautifulSoup(
+            lxml.html.tostring(self._raw_data, encoding='unicode'),
+            "html5lib")
+
+
+class LxmlParser(object):
+    '''Pedido pages parser using lxml.'''
+
+    pedido = LxmlParsedPedido
+
+    @staticmethod
+    def document(html):
+        return lxml.html.document_fromstring(html)
+
+    digest = staticmethod(detail_digest)
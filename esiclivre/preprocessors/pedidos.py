@@ -4,20 +4,24 @@ from __future__ import print_function
 from __future__ import unicode_literals  # unicode by default
 
 import collections
+import contextlib
+import hashlib
 import logging
 import os
 import string
-import time
 
 import arrow
 import bs4
 import dateutil.parser
 import flask
-import internetarchive
-from sqlalchemy.orm import joinedload
-from sqlalchemy.orm.exc import NoResultFound
+import sqlalchemy as sa
+from sqlalchemy.orm import subqueryload
 
-from esiclivre import models, extensions
+from esiclivre import models, extensions, search, upserts
+from esiclivre.downloads import DownloadWaiter, StagingDir, folder_lock
+from esiclivre.preprocessors.http_session import EsicSession
+from esiclivre.preprocessors.listing import PEDIDOS_GRID_ID, parse_listing
+from esiclivre.preprocessors.pipeline import HostLimiter, Pipeline
 
 
 logger = logging.getLogger(__name__)
@@ -29,11 +33,88 @@ def parse_date(text):
     return arrow.get(dateutil.parser.parse(text, dayfirst=True))
 
 
+def detail_digest(pagesource):
+    '''Digest of the text of a pedido page, ignoring scripts and hidden
+    fields (like __VIEWSTATE) that change on every request.'''
+    form = pagesource.form
+    if form is None:
+        return None
+    texts = (
+        ' '.join(text.split())
+        for text in form.find_all(text=True)
+        if text.parent.name not in ('script', 'style') and
+        not isinstance(text, bs4.Comment)
+    )
+    return hashlib.sha1(
+        '\n'.join(t for t in texts if t).encode('utf8')).hexdigest()
+
+
+def by_protocol(column, protocols, chunk_size=500):
+    '''Returns `column` of the saved pedidos with these protocols, by
+    protocol. Queried in chunks, as databases limit the query parameters.'''
+    protocols = [p for p in protocols if p is not None]
+    values = {}
+    for start in range(0, len(protocols), chunk_size):
+        values.update(extensions.db.session.query(
+            models.Pedido.protocol, column
+        ).filter(models.Pedido.protocol.in_(
+            protocols[start:start + chunk_size])))
+    return values
+
+
+def known_detail_digests(rows):
+    '''Returns the digests of the detail pages of the saved pedidos of
+    these listing rows, by protocol.'''
+    return by_protocol(models.Pedido.detail_digest,
+                       [row.protocol for row in rows])
+
+
+def known_attachment_dates(rows, chunk_size=500):
+    '''Returns the creation dates of the saved attachments of the pedidos
+    of these listing rows, by protocol and name. Queried in chunks, like
+    by_protocol.'''
+    protocols = [row.protocol for row in rows if row.protocol is not None]
+    dates = collections.defaultdict(dict)
+    for start in range(0, len(protocols), chunk_size):
+        query = extensions.db.session.query(
+            models.Pedido.protocol, models.Attachment.name,
+            models.Attachment.created_at,
+        ).join(models.Pedido.attachments_recurso).filter(
+            models.Pedido.protocol.in_(protocols[start:start + chunk_size]))
+        for protocol, name, created_at in query:
+            dates[protocol][name] = created_at
+    return dates
+
+
+def skip_unchanged_pedido(protocol, digest, listing_summary=None):
+    '''Called instead of saving a pedido whose detail page didn't change.
+    Only its listing summary may need to be updated. Needs to be commited.'''
+    if listing_summary:
+        models.Pedido.query.filter(
+            models.Pedido.protocol == protocol,
+            models.Pedido.detail_digest == digest,
+            sa.or_(models.Pedido.listing_summary.is_(None),
+                   models.Pedido.listing_summary != listing_summary)
+        ).update({'listing_summary': listing_summary},
+                 synchronize_session=False)
+
+
 class ParsedPedido(object):
 
-    def __init__(self, raw_data, browser):
+    def __init__(self, raw_data, browser, session=None, url=None):
 
         self._browser = browser
+        # If the page was fetched over HTTP (see EsicSession)
+        self._session = session
+        self._url = url
+        # Digests of its row in the listing and of its page, saved with the
+        # pedido
+        self.listing_summary = None
+        self.detail_digest = None
+        # (SHA-256, size) of the downloaded attachments and URLs of archived
+        # copies of their content, by file name
+        self.attachment_digests = {}
+        self.archived_copies = {}
         self._raw_data = raw_data
         self._main_data = self._get_main_data()
 
@@ -156,126 +237,147 @@ class ParsedPedido(object):
 
         return result
 
-    def upload_modified_attachments(self):
+    def has_attachments_grid(self):
+        return bool(
+            self._raw_data.select('#ctl00_MainContent_grid_anexos_resposta'))
+
+    def _page(self):
+        '''The page as parsed by BeautifulSoup.'''
+        return self._raw_data
+
+    def download_modified_attachments(self, saved_dates, stage):
+        '''Downloads the attachments whose creation date isn't the one in
+        `saved_dates` (by name, see known_attachment_dates) to the staging
+        folder `stage(protocol)` opens, keeping their digests. Their uploads
+        are queued when the pedido is saved (see queue_uploads).'''
 
         attachments_el_id = 'ctl00_MainContent_grid_anexos_resposta'
         # If pedido has no attachments
-        if not self._raw_data.select('#' + attachments_el_id):  # noqa
+        if not self.has_attachments_grid():
             return None
 
-        # Get the current pedido and its attachments from the DB
-        db_pedido = extensions.db.session.query(models.Pedido).filter_by(
-            protocol=self.protocol).options(joinedload('attachments')).first()
-        db_attachments = db_pedido.attachments if db_pedido else []
-
-        for attachment in self.attachments:
-            # Get last created_at time saved in DB
-            old_created_at = next(
-                (a.created_at
-                 for a in db_attachments
-                 if a.name == attachment.filename),
-                None
-            )
-            # old_created_at = [a.created_at for a in db_attachments
-            #                   if a.name == attachment.filename]
-            # old_created_at = old_created_at[0] if old_created_at else None
-
-            # Download and upload attachments that created_at changed
-            if not old_created_at or (attachment.created_at != old_created_at):
-                logger.info(
-                    'Anexo modificado ou novo. Baixando e enviando para IA.')
-
-                attachments_el = self._browser.navegador.find_element_by_id(
-                    attachments_el_id)
-                if attachments_el:
-                    # TODO: atualmente está baixando TODOS os anexos do pedido,
-                    # o certo seria baixar apenas o anexo cuja data realmente
-                    # mudou
-                    self.download_pedido_attachments(attachments_el)
-
-                upload_attachment_to_internet_archive(
-                    self.protocol, attachment.filename
-                )
-
-    def download_pedido_attachments(self, attachments):
-
-        for attachment in attachments.find_elements_by_tag_name('input'):
-
-            # baixar o arquivo
-            attachment.click()
-
-            # a ideia aqui é que se houver algum arquivo .part, ou seja, algum
-            # download ainda não terminou, o processo aguarde até esses
-            # arquivos serem baixados ou completar N tentativas
-
-            max_retries = 0
-            if str('.part') in os.listdir(flask.current_app.config['DOWNLOADS_PATH']):  # noqa
-                logger.info("Existe algum download inacabado...")
-                while max_retries != 10:
-
-                    download_dir = os.listdir(
-                        flask.current_app.config['DOWNLOADS_PATH']
-                    )
-
-                    uncomplete_download = next(
-                        (arq for arq in download_dir if arq.endswith('.part')),
-                        None
-                    )
-
-                    if not uncomplete_download:
-                        logger.info("Sem downloads inacabados...")
-                        break
-                    else:
-                        logger.info("Aguardar 10 segundos...")
-                        time.sleep(10)
-                        max_retries += 1
+        # Only attachments whose created_at changed are downloaded
+        modified = [
+            attachment.filename for attachment in self.attachments
+            if attachment.created_at != saved_dates.get(attachment.filename)
+        ]
+        if not modified:
+            return None
+        logger.info(
+            'Anexos modificados ou novos: {}. Baixando e enviando para '
+            'IA.'.format(', '.join(modified)))
+
+        staging = stage(self.protocol)
+        if self._session:
+            downloaded = self._session.download_attachments(
+                self._url, self._page(), staging.path,
+                select=lambda name: clear_attachment_name(name) in modified)
+            for download in downloaded:
+                staging.add(download.filename, sha256=download.sha256,
+                            size=download.size)
+        else:
+            attachments_el = self._browser.navegador.find_element_by_id(
+                attachments_el_id)
+            if attachments_el:
+                self.download_pedido_attachments(
+                    attachments_el, modified, staging)
+
+        downloaded = [name for name in modified if staging.has(name)]
+        for filename in set(modified) - set(downloaded):
+            # TODO: O que fazer se o arquivo não estiver disponivel?
+            # Já temos um caso onde o download não completa, mas por
+            # falha no servidor do esic.
+            logger.info("Arquivo {!r} não existe!.".format(filename))
+        for filename in downloaded:
+            self.attachment_digests[filename] = staging.digest(filename)
+
+    def download_pedido_attachments(self, attachments, filenames, staging):
+        '''Downloads with the browser the attachments with these (cleared)
+        names, waiting each one to finish and moving it to `staging`.
+        Files these downloads left in the downloads folder are removed
+        after.'''
+        config = flask.current_app.config
+        waiter = DownloadWaiter(config['DOWNLOADS_PATH'])
+        try:
+            for row in attachments.find_elements_by_tag_name('tr')[1:]:
+                cells = row.find_elements_by_tag_name('td')
+                if not cells:
+                    continue
+                filename = clear_attachment_name(cells[0].text)
+                if filename not in filenames:
+                    continue
+
+                # baixar o arquivo
+                waiter.expect()
+                row.find_element_by_tag_name('input').click()
+                downloaded = waiter.wait(
+                    lambda name: clear_attachment_name(name) == filename,
+                    config['DOWNLOAD_TIMEOUT'])
+                if downloaded:
+                    staging.add(downloaded, source=os.path.join(
+                        config['DOWNLOADS_PATH'], downloaded))
+                else:
+                    logger.info(
+                        "Download de {!r} não terminou.".format(filename))
+        finally:
+            waiter.clean()
+            waiter.close()
+
+
+class Html5libParser(object):
+    '''Default pedido pages parser, using BeautifulSoup with html5lib.'''
+
+    pedido = ParsedPedido
+
+    @staticmethod
+    def document(html):
+        return bs4.BeautifulSoup(html, "html5lib")
+
+    digest = staticmethod(detail_digest)
+
+
+def get_parser(name):
+    '''Returns the pedido pages parser backend called `name` (see
+    PEDIDO_PARSER).'''
+    if name == 'html5lib':
+        return Html5libParser
+    elif name == 'lxml':
+        # Optional dependency, only needed if this backend is used
+        from esiclivre.preprocessors.lxml_parser import LxmlParser
+        return LxmlParser
+    raise ValueError('Unknown pedido parser: {}'.format(name))
 
 
 class Pedidos(object):
-
-    _parsedpedidos = []
-    _pedido_pagesource = []
+    '''The pedidos listing, navigated with the browser.'''
 
     def set_full_data(self, browser):
         self._full_data = browser.navegador.find_element_by_id(
-            'ctl00_MainContent_grid_pedido')
-
-    def get_all_pages_source(self, browser):
+            PEDIDOS_GRID_ID)
+
+    def get_listing_rows(self, browser):
+        pagesource = bs4.BeautifulSoup(browser.navegador.page_source,
+                                       "html5lib")
+        return parse_listing(pagesource.find(id=PEDIDOS_GRID_ID))
+
+    def iter_pages_source(self, browser, rows=None):
+        '''Opens the pedidos of the listing `rows` (see get_listing_rows),
+        or all of them, one at a time. Yields the row (if known) and the
+        source of the page, while it is open.'''
+        if rows is None:
+            total_of_pedidos = len(
+                self._full_data.find_elements_by_tag_name('a'))
+            positions = range(total_of_pedidos)
+        else:
+            positions = [row.position for row in rows]
+        rows = dict((row.position, row) for row in rows or ())
 
-        total_of_pedidos = len(self._full_data.find_elements_by_tag_name('a'))
-        for pos in range(total_of_pedidos):
+        for pos in positions:
 
             self.set_full_data(browser)
             self._full_data.find_elements_by_tag_name('a')[pos].click()
-
-            pagesource = bs4.BeautifulSoup(browser.navegador.page_source,
-                                           "html5lib")
-
-            self._pedido_pagesource.append(pagesource)
-            pedido = self.process_pedidos(browser, pagesource)
-            fix_attachment_name_and_extension()
-            pedido.upload_modified_attachments()
+            yield rows.get(pos), browser.navegador.page_source
             browser.navegador.back()
-        fix_attachment_name_and_extension()
-
-    def process_pedidos(self, browser, page_source=None):
-
-        # Existe a possibilidade da pagina não retornar um codigo fonte válido
-        # a classe que estrutura o pedido retornará None se o código
-        # fonte não for válido...
-        if page_source:
-            pedido = ParsedPedido(page_source, browser)
-            self._parsedpedidos.append(pedido) if pedido else None
-            return pedido
-        else:
-            self._parsedpedidos = list(p for p in (
-                ParsedPedido(pp, browser) for pp in self._pedido_pagesource
-                ) if p._main_data
-            )
-            return self._parsedpedidos
-
-    def get_all_parsed_pedidos(self):
-        return self._parsedpedidos
 
 
 def clear_attachment_name(name):
@@ -285,184 +387,468 @@ def clear_attachment_name(name):
     return ''.join([l for l in name if l in VALID_ATTACHMENTS_NAME_CHARS])
 
 
-def fix_attachment_name_and_extension():
-    # remover caracter invalidos
-    # mudar extensão para lowercase
-    # apagar arquivos .part (nessa etapa, se um arquivo ainda é .part é porque
-    # o download falhou).
-    download_dir = flask.current_app.config['DOWNLOADS_PATH']
-    for _file in os.listdir(download_dir):
-        _file = _file.decode('utf8')
-        # logger.info("file: {}".format(_file))
-        _file_fullpath = '{}/{}'.format(download_dir, _file)
-
-        if _file.endswith('.part'):
-            os.remove(_file_fullpath)
-        else:
-            os.rename(
-                _file_fullpath,
-                '{}/{}'.format(download_dir, clear_attachment_name(_file))
-            )
+@contextlib.contextmanager
+def pedido_staging(protocol):
+    '''Opens the folder where the attachments of a pedido are kept until
+    they are archived, holding its lock (see downloads.folder_lock).'''
+    root = os.path.join(flask.current_app.config['DOWNLOADS_PATH'], 'staging')
+    name = 'pedido_{}'.format(protocol)
+    with folder_lock(os.path.join(root, name)):
+        yield StagingDir(root, name, clear_attachment_name)
 
 
-def update_pedido_messages(pre_pedido, pedido):
-    '''Update messages for a pedido.'''
-    new_insetion = False
+def new_messages(pre_pedido, fingerprints):
+    '''Returns the messages of a parsed pedido whose fingerprints aren't in
+    `fingerprints` (the ones already saved), as rows of the message table
+    (without pedido_id).'''
+    fingerprints = set(fingerprints)
+    rows = []
     for item in pre_pedido.history:
-        # Check if is a new msg
-        already_inserted = False
-        for itemDB in pedido.history:
-            # justification can be empty, so using all fields
-            if (item.date == itemDB.date and
-               item.justification == itemDB.justification and
-               item.situation == itemDB.situation and
-               item.responsible == itemDB.responsible):
-                already_inserted = True
-
-        # Insert if is a new msg
-        if not already_inserted:
-            message = models.Message()
-            message.date = item.date
-            message.justification = item.justification
-            message.responsible = item.responsible
-            message.situation = item.situation
-            message.pedido_id = pedido.id
-            extensions.db.session.add(message)
-            new_insetion = True
-
-    extensions.db.session.commit() if new_insetion else None
-
-
-def create_pedido_attachments(pre_pedido):
-
-    attachments = []
-    for item in pre_pedido.attachments:
-
-        attachment = models.Attachment()
-        attachment.created_at = item.created_at
-        attachment.name = item.filename
-        base_url = 'https://archive.org/download'
-        attachment.ia_url = (
-            u'{base}/{prefix}_pedido_{protocol}/{filename}'.format(
-                base=base_url,
-                prefix=flask.current_app.config['ATTACHMENT_URL_PREFIX'],
-                protocol=pre_pedido.protocol,
-                filename=item.filename
-            )
-        )
+        # justification can be empty, so using all fields
+        fingerprint = models.Message.make_fingerprint(
+            item.date, item.situation, item.responsible, item.justification)
+        if fingerprint in fingerprints:
+            continue
+        fingerprints.add(fingerprint)
+        rows.append({
+            'date': item.date,
+            'justification': item.justification,
+            'responsible': item.responsible,
+            'situation': item.situation,
+            'fingerprint': fingerprint,
+        })
+    return rows
+
+
+def attachment_url(protocol, filename, sha256=None):
+    '''URL of an attachment archived by the uploader (see
+    models.UploadTask.archived_name).'''
+    return '{base}/{prefix}_pedido_{protocol}/{name}'.format(
+        base='https://archive.org/download',
+        prefix=flask.current_app.config['ATTACHMENT_URL_PREFIX'],
+        protocol=protocol,
+        name=models.UploadTask.archived_name(filename, sha256))
+
+
+def archived_copies(digests):
+    '''Returns the URLs of archived attachments with these (SHA-256, size),
+    by (SHA-256, size). Only copies archived with a name keyed by their
+    content are returned, as they never change.'''
+    digests = set(digests)
+    if not digests:
+        return {}
+    query = extensions.db.session.query(
+        models.Attachment.sha256, models.Attachment.size,
+        models.Attachment.ia_url,
+    ).join(
+        models.pedido_attachments,
+        models.pedido_attachments.c.attachment_id == models.Attachment.id
+    ).join(
+        models.Pedido,
+        models.Pedido.id == models.pedido_attachments.c.pedido_id
+    ).join(
+        models.UploadTask,
+        sa.and_(models.UploadTask.pedido_protocol == models.Pedido.protocol,
+                models.UploadTask.filename == models.Attachment.name,
+                models.UploadTask.sha256 == models.Attachment.sha256)
+    ).filter(
+        models.UploadTask.status == 'DONE',
+        models.Attachment.sha256.in_([sha256 for sha256, _ in digests]),
+    )
+    return dict(
+        ((sha256, size), ia_url) for sha256, size, ia_url in query
+        if (sha256, size) in digests
+    )
 
-        extensions.db.session.add(attachment)
-        attachments.append(attachment)
-    extensions.db.session.commit() if attachments else None
 
-    return attachments
+def queue_uploads(pre_pedidos, stagings):
+    '''Queues the uploads of the attachments of these parsed pedidos
+    downloaded to their staging folders (by protocol). Files whose content
+    is already archived (only republished with a new date, or the same as
+    an attachment of another pedido) are linked to the archived copy
+    instead. Folders left with nothing to upload are removed. Makes a few
+    queries for the whole batch. Needs to be commited, holding the locks of
+    the folders.'''
+    pre_pedidos = [p for p in pre_pedidos if p.protocol in stagings]
+    copies = archived_copies(
+        digest for pre_pedido in pre_pedidos
+        for digest in pre_pedido.attachment_digests.values())
+    uploads = []
+    for pre_pedido in pre_pedidos:
+        digests = pre_pedido.attachment_digests
+        to_upload = []
+        for filename, digest in digests.items():
+            if digest in copies:
+                pre_pedido.archived_copies[filename] = copies[digest]
+            else:
+                to_upload.append(filename)
+        logger.info('{} anexos com conteúdo já arquivado.'.format(
+            len(digests) - len(to_upload)))
+        # Archived by the uploader, that removes the staging folder after
+        uploads.append((
+            pre_pedido.protocol, stagings[pre_pedido.protocol].path,
+            to_upload, dict((name, digests[name][0]) for name in to_upload)))
+    models.UploadTask.enqueue_many(uploads)
+
+    idle = [stagings[protocol] for protocol, _, to_upload, _ in uploads
+            if not to_upload]
+    if idle:
+        busy = set(folder for folder, in extensions.db.session.query(
+            models.UploadTask.folder
+        ).filter(
+            models.UploadTask.folder.in_([staging.path for staging in idle]),
+            models.UploadTask.status.in_(['PENDING', 'UPLOADING'])
+        ))
+        for staging in idle:
+            if staging.path not in busy:
+                staging.cleanup()
+
+
+def add_new_attachments(pre_pedido, pedido):
+    '''Links the attachments of a parsed pedido to the saved one, creating
+    the new ones and updating the creation date and content of the modified
+    ones. Returns if there were changes. Needs to be commited.'''
+    saved = dict((a.name, a) for a in pedido.attachments_recurso)
+    changed = False
+    for item in pre_pedido.attachments:
+        attachment = saved.get(item.filename)
+        if not attachment:
+            attachment = models.Attachment()
+            attachment.name = item.filename
+            attachment.ia_url = attachment_url(pre_pedido.protocol,
+                                               item.filename)
+            pedido.attachments_recurso.append(attachment)
+            saved[attachment.name] = attachment
+            changed = True
+
+        values = {'created_at': item.created_at}
+        if item.filename in pre_pedido.attachment_digests:
+            values['sha256'], values['size'] = (
+                pre_pedido.attachment_digests[item.filename])
+            # Its own copy, unless one with the same content was archived
+            values['ia_url'] = pre_pedido.archived_copies.get(
+                item.filename) or attachment_url(
+                    pre_pedido.protocol, item.filename, values['sha256'])
+        for field, value in values.items():
+            if getattr(attachment, field) != value:
+                setattr(attachment, field, value)
+                changed = True
+    return changed
+
+
+def save_pedidos_into_db(pre_pedidos, unchanged=(), stagings=None):
+    '''Saves a batch of parsed pedidos in a single transaction. The pedidos
+    (with their attachments and messages fingerprints), orgaos and author
+    needed are loaded with a few queries for the whole batch. The uploads
+    of their attachments downloaded to `stagings` (see queue_uploads) are
+    queued in the same transaction.
+
+    `unchanged` are (protocol, digest, listing summary) of pedidos whose
+    page didn't change (see skip_unchanged_pedido), updated in the same
+    transaction.'''
+    session = extensions.db.session
+    # If a protocol comes twice, the last page read wins
+    pre_pedidos = collections.OrderedDict(
+        (pre_pedido.protocol, pre_pedido) for pre_pedido in pre_pedidos)
+    try:
+        pedidos = {}
+        fingerprints = collections.defaultdict(set)
+        if pre_pedidos:
+            pedidos = dict(
+                (pedido.protocol, pedido)
+                for pedido in models.Pedido.query.filter(
+                    models.Pedido.protocol.in_(list(pre_pedidos))
+                ).options(subqueryload('attachments_recurso'))
+            )
+        if pedidos:
+            query = session.query(
+                models.Message.pedido_id, models.Message.fingerprint
+            ).filter(models.Message.pedido_id.in_(
+                [pedido.id for pedido in pedidos.values()]))
+            for pedido_id, fingerprint in query:
+                fingerprints[pedido_id].add(fingerprint)
+        queue_uploads(pre_pedidos.values(), stagings or {})
+
+        # TODO: O que fazer se o orgão não existir no DB?
+        orgaos_names = [p.orgao or 'desconhecido'
+                        for p in pre_pedidos.values()]
+        orgaos = dict((orgao.name, orgao) for orgao in upserts.resolve_by_name(
+            models.Orgao, orgaos_names, 'orgaos'))
+
+        new_pedido_data = None
+        changed = []
+        messages = []
+        for protocol, pre_pedido in pre_pedidos.items():
+            pedido = pedidos.get(protocol)
+            if not pedido:
+                if not new_pedido_data:
+                    new_pedido_data = (
+                        upserts.resolve_author(
+                            flask.current_app.config['DEFAULT_AUTHOR']),
+                        upserts.resolve_keywords(['recuperado']),
+                    )
+                author, keywords = new_pedido_data
+                pedido = models.Pedido(protocol=protocol, author=author)
+                pedido.keywords.extend(keywords)
+                session.add(pedido)
+                pedidos[protocol] = pedido
+
+            fields = {
+                'orgao_name': orgaos[pre_pedido.orgao or 'desconhecido'].name,
+                'interessado': pre_pedido.interessado,
+                'situation': pre_pedido.situation,
+                'request_date': pre_pedido.request_date,
+                'contact_option': pre_pedido.contact_option,
+                'description': pre_pedido.description,
+            }
+            # Only touch updated_at if something really changed, as it is
+            # used by clients to know if they need to download the pedido
+            # again
+            pedido_changed = False
+            for field, value in fields.items():
+                if getattr(pedido, field) != value:
+                    setattr(pedido, field, value)
+                    pedido_changed = True
+            pedido_messages = new_messages(
+                pre_pedido, fingerprints[pedido.id] if pedido.id else ())
+            if pedido_messages:
+                messages.append((pedido, pedido_messages))
+                pedido_changed = True
+            # Not short-circuited, it must run
+            pedido_changed = add_new_attachments(pre_pedido, pedido) | (
+                pedido_changed)
+            if pedido_changed:
+                pedido.updated_at = arrow.utcnow()
+                changed.append(pedido)
+
+            # The pedido is now up to date with its row in the listing and
+            # its page
+            if pre_pedido.listing_summary:
+                pedido.listing_summary = pre_pedido.listing_summary
+            if pre_pedido.detail_digest:
+                pedido.detail_digest = pre_pedido.detail_digest
+
+        for protocol, digest, listing_summary in unchanged:
+            skip_unchanged_pedido(protocol, digest, listing_summary)
+
+        # Gets the ids of new pedidos and writes the changes to be indexed
+        session.flush()
+        # Messages saved meanwhile (by another process) are ignored
+        upserts.insert_ignoring_conflicts(models.Message.__table__, [
+            dict(row, pedido_id=pedido.id)
+            for pedido, rows in messages for row in rows
+        ])
+        search.update_search_index([pedido.id for pedido in changed])
+        # Read before the commit expires them, which would reload each one
+        changed = [(pedido.id, pedido.protocol) for pedido in changed]
+        session.commit()
+    except:
+        session.rollback()
+        raise
+
+    for pedido_id, protocol in changed:
+        extensions.pedido_cache.invalidate(pedido_id, protocol)
 
 
 def save_pedido_into_db(pre_pedido):
-    # check if there is a object with the same protocol
-    pedido = models.Pedido.query.filter(
-        models.Pedido.protocol == pre_pedido.protocol)
-    pedido = pedido.options(joinedload('history')).first()
-    if not pedido:
-        # if not, create one
-        default_author = flask.current_app.config['DEFAULT_AUTHOR']
+    save_pedidos_into_db([pre_pedido])
+
+
+# What save_pedidos_into_db reads of a ParsedPedido, without its page
+PedidoData = collections.namedtuple('PedidoData', [
+    'protocol', 'interessado', 'request_date', 'orgao', 'contact_option',
+    'description', 'situation', 'attachments', 'history', 'listing_summary',
+    'detail_digest', 'attachment_digests', 'archived_copies'])
+
+
+def pedido_data(pedido):
+    '''Returns the PedidoData of a ParsedPedido, which doesn't keep its
+    parsed page.'''
+    return PedidoData(*(getattr(pedido, name) for name in PedidoData._fields))
+
+
+class PedidoSaver(object):
+    '''Takes what parse_pedido_page returns, one at a time, downloads the
+    modified attachments and saves the pedidos in batches of `batch_size`
+    (see save_pedidos_into_db). Only their PedidoData is kept meanwhile,
+    not their pages. `attachment_dates` are the ones of the saved
+    attachments (see known_attachment_dates).
+
+    Staging folders stay locked until the uploads of their files are
+    queued with the batch, so the uploader doesn't remove them meanwhile.
+    Call `flush` after the last one, and `close` to release them if it
+    wasn't called.'''
+
+    def __init__(self, batch_size=100, attachment_dates=None):
+        self.batch_size = batch_size
+        self.attachment_dates = attachment_dates or {}
+        self._pedidos = []
+        self._unchanged = []
+        self._stagings = {}
+        self._locks = []
+
+    def stage(self, protocol):
+        '''Opens the staging folder of a pedido, locked until its batch is
+        saved.'''
+        if protocol not in self._stagings:
+            lock = pedido_staging(protocol)
+            self._stagings[protocol] = lock.__enter__()
+            self._locks.append(lock)
+        return self._stagings[protocol]
+
+    def __call__(self, pedido):
+        if isinstance(pedido, tuple):
+            self._unchanged.append(pedido)
+        elif pedido._main_data is not None:
+            pedido.download_modified_attachments(
+                self.attachment_dates.get(pedido.protocol, {}), self.stage)
+            self._pedidos.append(pedido_data(pedido))
+        if len(self._pedidos) + len(self._unchanged) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
         try:
-            author = extensions.db.session.query(models.Author).filter(
-                models.Author.name == default_author
-            ).one()
-        except NoResultFound:
-            author = models.Author(name=default_author)
-            extensions.db.session.add(author)
-            extensions.db.session.commit()
-
-        pedido = models.Pedido(protocol=pre_pedido.protocol, author=author)
-        pedido.add_keyword('recuperado')
-        extensions.db.session.add(pedido)
-
-    # TODO: O que fazer se o orgão não existir no DB?
-    if not pre_pedido.orgao:
-        orgao_name = 'desconhecido'
-    else:
-        orgao_name = pre_pedido.orgao
-
-    orgao = models.Orgao.query.filter_by(name=orgao_name).first()
-    if not orgao:
-        orgao = models.Orgao(name=orgao_name)
-        extensions.db.session.add(orgao)
-        extensions.db.session.commit()
-    pedido.orgao_name = orgao.name
-
-    pedido.interessado = pre_pedido.interessado
-    pedido.situation = pre_pedido.situation
-    pedido.request_date = pre_pedido.request_date
-    pedido.contact_option = pre_pedido.contact_option
-    pedido.description = pre_pedido.description
-
-    extensions.db.session.commit()
-
-    update_pedido_messages(pre_pedido, pedido)
-
-    if pre_pedido.attachments:
-        pedido.attachments = create_pedido_attachments(pre_pedido)
-
-
-def upload_attachment_to_internet_archive(pedido_protocol, filename):
-
-    download_dir = flask.current_app.config['DOWNLOADS_PATH']
-    downloaded_attachments = os.listdir(download_dir)
-
-    if filename not in [a.decode('utf8') for a in downloaded_attachments]:
-        logger.info("Arquivo {!r} não existe!.".format(filename))
-        # TODO: O que fazer se o arquivo não estiver disponivel?
-        # Já temos um caso onde o download não completa, mas por falha no
-        # servidor do esic.
-        return None
-    else:
-
-        # try:
-        #     # get mediatype from file extension
-        #     mediatype = filename.rpartition('.')[2]
-        # except:
-        #     mediatype = None
-
-        item = internetarchive.Item('{prefix}_pedido_{protocol}'.format(
-            prefix=flask.current_app.config['ATTACHMENT_URL_PREFIX'],
-            protocol=pedido_protocol))
-        metadata = dict(
-            # mediatype=mediatype,
-            # creator='OKF',
-            created_at=arrow.now().isoformat()
-        )
-        result = item.upload(
-            '{}/{}'.format(download_dir, filename), metadata=metadata
-        )
-
-        if not result or result[0].status_code != 200:
-            # TODO: O que fazer nessa situação?
-            logger.info("Erro ao executar upload.")
-        else:
-            os.remove('{}/{}'.format(download_dir, filename))
-
-
-def update_pedidos_list(browser):
+            if self._pedidos or self._unchanged:
+                save_pedidos_into_db(
+                    self._pedidos, self._unchanged, self._stagings)
+        finally:
+            self.close()
+
+    def close(self):
+        '''Releases the staging folders and drops what wasn't saved.'''
+        for lock in reversed(self._locks):
+            lock.__exit__(None, None, None)
+        self._pedidos = []
+        self._unchanged = []
+        self._stagings = {}
+        self._locks = []
+
+
+def changed_listing_rows(rows):
+    '''Returns the listing rows of pedidos that are new or whose row
+    changed since they were last synced.'''
+    summaries = by_protocol(models.Pedido.listing_summary,
+                            [row.protocol for row in rows])
+    return [
+        row for row in rows
+        if row.protocol is None or summaries.get(row.protocol) != row.summary
+    ]
+
+
+def parse_pedido_page(parser, html, browser, known_digest, stats,
+                      protocol=None, summary=None, session=None, url=None):
+    '''Parses a pedido page with `parser` (see get_parser). Returns the
+    ParsedPedido or, if the page didn't change since it was saved (its
+    digest is `known_digest`, the one saved with the pedido of `protocol`),
+    a (protocol, digest, summary) tuple.'''
+    document = parser.document(html)
+    stats['fetched'] += 1
+    digest = parser.digest(document)
+    if digest is not None and digest == known_digest:
+        stats['skipped'] += 1
+        return protocol, digest, summary
+    pedido = parser.pedido(document, browser, session, url)
+    pedido.listing_summary = summary
+    pedido.detail_digest = digest
+    return pedido
+
+
+def update_pedidos_over_http(browser, incremental=False, stats=None):
+    '''Fetches, parses and saves the pedidos, using the browser only for
+    its login (see EsicSession). Pedidos pages are fetched concurrently by
+    SCRAPER_WORKERS sessions, while the ones already fetched are parsed
+    and saved. If `incremental`, only new or changed pedidos are fetched.
+    Pages that didn't change since they were saved are skipped, counted in
+    `stats`.'''
+    stats = stats if stats is not None else collections.Counter()
+    config = flask.current_app.config
+    limiter = HostLimiter(config['SCRAPER_HOST_CONCURRENCY'])
+    session = EsicSession(browser, limiter, config['SCRAPER_TIMEOUT'])
+    url, page, rows = session.get_listing()
+    if incremental:
+        total = len(rows)
+        rows = changed_listing_rows(rows)
+        logger.info("{} de {} pedidos mudaram.".format(len(rows), total))
+    # All postbacks are made from the listing state, so there is no need
+    # to go back after each one
+    form = session.get_form(url, page)
+    known_digests = known_detail_digests(rows)
+    attachment_dates = known_attachment_dates(rows)
+    parser = get_parser(config['PEDIDO_PARSER'])
+
+    def fetcher(worker_session):
+        def fetch(row):
+            response = worker_session.submit(form, *row.postback)
+            return row, response.url, response.text
+        return fetch
+
+    def parse(fetched):
+        row, pedido_url, html = fetched
+        # Attachments are downloaded by the main session, used only by
+        # the persist stage
+        return parse_pedido_page(parser, html, browser,
+                                 known_digests.get(row.protocol), stats,
+                                 row.protocol, row.summary, session,
+                                 pedido_url)
+
+    saver = PedidoSaver(config['PEDIDOS_SAVE_BATCH'], attachment_dates)
+    with contextlib.closing(saver):
+        Pipeline(
+            [fetcher(session.clone())
+             for _ in range(config['SCRAPER_WORKERS'])],
+            parse, saver, config['SCRAPER_QUEUE_SIZE'],
+        ).run(rows)
+        saver.flush()
+
+
+def update_pedidos_list(browser, incremental=None):
+    '''Syncs the pedidos with eSIC. `incremental` defaults to
+    PEDIDOS_SYNC_MODE.'''
     global logger
     logger = browser.logger
 
+    config = flask.current_app.config
+    if incremental is None:
+        incremental = config['PEDIDOS_SYNC_MODE'] == 'incremental'
+
     # garantir que a tela inicial seja a de consulta de pedidos.
     browser.ir_para_consultar_pedido()
 
-    pedidos = Pedidos()
-    pedidos.set_full_data(browser)
-    pedidos.get_all_pages_source(browser)
-    # pedidos.process_pedidos(browser)
-
-    for pedido in pedidos.get_all_parsed_pedidos():
-        save_pedido_into_db(pedido)
+    stats = collections.Counter()
+    if config['SCRAPER_ENGINE'] == 'http':
+        update_pedidos_over_http(browser, incremental, stats)
+    else:
+        parser = get_parser(config['PEDIDO_PARSER'])
+        pedidos = Pedidos()
+        pedidos.set_full_data(browser)
+        # Also in full mode, so the summaries of the rows are saved
+        rows = pedidos.get_listing_rows(browser)
+        if incremental:
+            total = len(rows)
+            rows = changed_listing_rows(rows)
+            logger.info("{} de {} pedidos mudaram.".format(len(rows), total))
+        known_digests = known_detail_digests(rows)
+        attachment_dates = known_attachment_dates(rows)
+
+        # Each pedido is handled and discarded before the next one is
+        # opened, while its page is still open to download its attachments
+        saver = PedidoSaver(config['PEDIDOS_SAVE_BATCH'], attachment_dates)
+        with contextlib.closing(saver):
+            for row, html in pedidos.iter_pages_source(browser, rows):
+                pedido = parse_pedido_page(parser, html, browser,
+                                           known_digests.get(row.protocol),
+                                           stats, row.protocol, row.summary)
+                saver(pedido)
+            saver.flush()
 
     # registrar atualização do dia
     extensions.db.session.add(
-        models.PedidosUpdate(date=arrow.now())
+        models.PedidosUpdate(date=arrow.now(),
+                             pages_fetched=stats['fetched'],
+                             pages_skipped=stats['skipped'])
     )
     extensions.db.session.commit()
 
-    logger.info("Pedidos atualizados. Atualização registrada.")
+    logger.info(
+        "Pedidos atualizados: {} páginas abertas, {} sem mudanças. "
+        "Atualização registrada.".format(stats['fetched'], stats['skipped']))
@@ -0,0 +1,139 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import contextlib
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import six
+
+
+# Marks the end of a stage output
+STOP = object()
+
+
+class HostLimiter(object):
+    '''Caps the number of concurrent requests to each host.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        '''Waits until a request to the host of `url` can be made.'''
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.limit))
+        with semaphore:
+            yield
+
+
+class Pipeline(object):
+    '''Runs fetch, parse and persist as stages joined by bounded queues.
+
+    Each function in `fetchers` runs in its own thread, taking items to
+    fetch. `parse` runs in another thread and `persist` in the thread that
+    calls `run`, so it can use the app context (and the DB session). If
+    any stage fails, the others stop and the error is raised by `run`.'''
+
+    def __init__(self, fetchers, parse, persist, queue_size=16):
+        self.fetchers = fetchers
+        self.parse = parse
+        self.persist = persist
+        self.queue_size = queue_size
+        self._failed = threading.Event()
+
+    def _put(self, output, item):
+        # Gives up if another stage failed, so no thread stays blocked
+        while not self._failed.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, input_):
+        # Acts as if the input ended if another stage failed
+        while not self._failed.is_set():
+            try:
+                return input_.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return STOP
+
+    def _fetch_stage(self, fetch, items, output):
+        try:
+            while True:
+                item = self._get(items)
+                if item is STOP:
+                    break
+                self._put(output, (None, fetch(item)))
+        except Exception:
+            self._put(output, (sys.exc_info(), None))
+        finally:
+            self._put(output, STOP)
+
+    def _parse_stage(self, fetched, output):
+        stopped = 0
+        try:
+            while stopped < len(self.fetchers):
+                item = self._get(fetched)
+                if item is STOP:
+                    stopped += 1
+                    continue
+                error, data = item
+                self._put(output, (error, None if error else self.parse(data)))
+        except Exception:
+            self._put(output, (sys.exc_info(), None))
+        finally:
+            self._put(output, STOP)
+
+    def run(self, items):
+        '''Fetches, parses and persists all `items`.'''
+        self._failed.clear()
+        to_fetch = queue.Queue()
+        for item in items:
+            to_fetch.put(item)
+        for _ in self.fetchers:
+            to_fetch.put(STOP)
+        fetched = queue.Queue(self.queue_size)
+        parsed = queue.Queue(self.queue_size)
+
+        threads = [
+            threading.Thread(target=self._fetch_stage,
+                             args=(fetch, to_fetch, fetched))
+            for fetch in self.fetchers
+        ]
+        threads.append(threading.Thread(target=self._parse_stage,
+                                        args=(fetched, parsed)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                item = parsed.get()
+                if item is STOP:
+                    break
+                error, data = item
+                if error:
+                    six.reraise(*error)
+                self.persist(data)
+        finally:
+            self._failed.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import weakref
+
+import sqlalchemy as sa
+from flask import current_app
+
+from extensions import db
+from models import Message, Pedido
+
+
+# Full text index over the pedidos descriptions and their messages
+# justifications. Postgres uses a tsvector column with a GIN index and SQLite
+# an FTS5 virtual table (with the pedido id as rowid), so the table is
+# managed here instead of being a model. Other databases, and SQLite builds
+# without FTS5, have no index and are searched with LIKE (see like_search).
+
+CREATE_INDEX = {
+    'postgresql': [
+        'CREATE TABLE pedido_search ('
+        '  pedido_id INTEGER PRIMARY KEY,'
+        '  document TSVECTOR NOT NULL)',
+        'CREATE INDEX ix_pedido_search_document '
+        '  ON pedido_search USING gin(document)',
+    ],
+    'sqlite': [
+        'CREATE VIRTUAL TABLE pedido_search '
+        '  USING fts5(description, justifications)',
+    ],
+}
+
+UPDATE_INDEX = {
+    'postgresql':
+        'INSERT INTO pedido_search (pedido_id, document) '
+        'SELECT p.id, '
+        '  setweight(to_tsvector(CAST(:language AS regconfig), '
+        '    coalesce(p.description, \'\')), \'A\') || '
+        '  setweight(to_tsvector(CAST(:language AS regconfig), '
+        '    coalesce(string_agg(m.justification, \' \'), \'\')), \'B\') '
+        'FROM pedido p LEFT JOIN message m ON m.pedido_id = p.id '
+        '{where} GROUP BY p.id',
+    'sqlite':
+        'INSERT INTO pedido_search (rowid, description, justifications) '
+        'SELECT p.id, coalesce(p.description, \'\'), '
+        '  coalesce(group_concat(m.justification, \' \'), \'\') '
+        'FROM pedido p LEFT JOIN message m ON m.pedido_id = p.id '
+        '{where} GROUP BY p.id',
+}
+
+SEARCH = {
+    'postgresql':
+        'SELECT pedido_id, ts_rank(document, query) AS rank '
+        'FROM pedido_search, '
+        '  plainto_tsquery(CAST(:language AS regconfig), :query) query '
+        'WHERE document @@ query '
+        'ORDER BY rank DESC, pedido_id DESC LIMIT :limit OFFSET :offset',
+    'sqlite':
+        # bm25 is lower for better matches; descriptions weight more
+        'SELECT rowid, -bm25(pedido_search, 2.0, 1.0) AS rank '
+        'FROM pedido_search WHERE pedido_search MATCH :query '
+        'ORDER BY rank DESC, rowid DESC LIMIT :limit OFFSET :offset',
+}
+
+COUNT = {
+    'postgresql':
+        'SELECT count(*) FROM pedido_search '
+        'WHERE document @@ plainto_tsquery(CAST(:language AS regconfig), '
+        '  :query)',
+    'sqlite':
+        'SELECT count(*) FROM pedido_search '
+        'WHERE pedido_search MATCH :query',
+}
+
+
+# FTS5 registers this function, so it's missing from SQLite builds without it
+FTS5_PROBE = 'SELECT fts5_source_id()'
+
+# If each SQLite engine has FTS5
+_fts5_support = weakref.WeakKeyDictionary()
+
+
+def has_fts5(bind, engine):
+    '''Checks once per engine if its SQLite has FTS5, running the probe
+    through `bind` (a session or connection of it).'''
+    if engine not in _fts5_support:
+        try:
+            bind.execute(sa.text(FTS5_PROBE))
+        except sa.exc.OperationalError:
+            _fts5_support[engine] = False
+        else:
+            _fts5_support[engine] = True
+    return _fts5_support[engine]
+
+
+def dialect_name(bind):
+    '''Returns the dialect of an engine, connection or session, or None if
+    there's no full text search for it.'''
+    if hasattr(bind, 'dialect'):
+        engine = getattr(bind, 'engine', bind)
+    else:
+        engine = bind.get_bind(mapper=None)
+    name = engine.dialect.name
+    if name == 'sqlite' and not has_fts5(bind, engine):
+        return None
+    return name if name in CREATE_INDEX else None
+
+
+def create_search_index(bind):
+    '''Creates the full text index table, if the database has one.'''
+    for statement in CREATE_INDEX.get(dialect_name(bind), []):
+        bind.execute(sa.text(statement))
+
+
+def drop_search_index(bind):
+    '''Drops the full text index table, if it exists.'''
+    bind.execute(sa.text('DROP TABLE IF EXISTS pedido_search'))
+
+
+def update_search_index(pedido_ids=None, session=None):
+    '''(Re)indexes the pedidos with these ids, or all pedidos if None.
+
+    Runs in the current transaction, so needs to be commited. Does nothing
+    if the database has no full text index.'''
+    session = session or db.session
+    dialect = dialect_name(session)
+    if not dialect:
+        return
+    if pedido_ids is None:
+        where = delete_where = ''
+    else:
+        # Ids are integers, so it's safe to format them in the SQL
+        ids = ','.join(str(int(i)) for i in pedido_ids)
+        if not ids:
+            return
+        where = 'WHERE p.id IN ({})'.format(ids)
+        delete_where = 'WHERE {} IN ({})'.format(
+            'rowid' if dialect == 'sqlite' else 'pedido_id', ids)
+    params = {'language': current_app.config['SEARCH_LANGUAGE']}
+    session.execute(sa.text(
+        'DELETE FROM pedido_search {}'.format(delete_where)))
+    session.execute(sa.text(UPDATE_INDEX[dialect].format(where=where)),
+                    params)
+
+
+def fts5_query(query):
+    '''Makes a FTS5 query matching all the words, ignoring its syntax.'''
+    return ' '.join('"{}"'.format(word.replace('"', '""'))
+                    for word in query.split())
+
+
+def like_pattern(word):
+    '''Pattern matching text containing `word`, escaped with "\\".'''
+    for char in ('\\', '%', '_'):
+        word = word.replace(char, '\\' + char)
+    return '%{}%'.format(word)
+
+
+def like_search(query, page, per_page_num):
+    '''Searches pedidos whose description or messages have all the words,
+    for databases without full text index. All of them get the same rank,
+    so the newest come first.'''
+    matches = db.session.query(Pedido.id)
+    for word in query.split():
+        pattern = like_pattern(word)
+        matches = matches.filter(sa.or_(
+            Pedido.description.ilike(pattern, escape='\\'),
+            Pedido.history.any(
+                Message.justification.ilike(pattern, escape='\\')),
+        ))
+    total = matches.count()
+    results = (matches.order_by(Pedido.id.desc())
+               .offset(page * per_page_num).limit(per_page_num))
+    return total, [(pedido_id, 0.0) for pedido_id, in results]
+
+
+def search(query, page, per_page_num):
+    '''Searches pedidos, returning the total of matches and a page of
+    (pedido_id, rank), best matches first.'''
+    dialect = dialect_name(db.session)
+    if not dialect:
+        return like_search(query, page, per_page_num)
+    params = {
+        'language': current_app.config['SEARCH_LANGUAGE'],
+        'query': fts5_query(query) if dialect == 'sqlite' else query,
+        'limit': per_page_num,
+        'offset': page * per_page_num,
+    }
+    total = db.session.execute(sa.text(COUNT[dialect]), params).scalar()
+    results = db.session.execute(sa.text(SEARCH[dialect]), params).fetchall()
+    return total, [(pedido_id, rank) for pedido_id, rank in results]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+
+import sqlalchemy as sa
+
+from extensions import db
+from models import (PrePedido, Pedido, Message, Author, Keyword, Attachment,
+                    pedido_author, pedido_keyword, pedido_attachments)
+
+
+# Rows are read as plain tuples with only the needed columns, so no ORM
+# objects are built. Date columns are read as plain datetimes, skipping
+# ArrowType, and formatted by `isoformat`.
+
+def raw(column, type_=sa.DateTime):
+    '''Selects a column skipping its type conversion (eg.: ArrowType).'''
+    return sa.type_coerce(column, type_).label(column.key)
+
+
+def isoformat(value):
+    '''Formats a datetime read by `raw` the same way Arrow does.'''
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        # ArrowType stores UTC naive datetimes
+        return value.isoformat() + '+00:00'
+    return value.isoformat()
+
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.situation,
+    Message.justification,
+    Message.responsible,
+    raw(Message.date),
+    Message.pedido_id,
+    Message.id_recurso,
+)
+
+
+def message_as_dict(row):
+    '''Same as `Message.as_dict`, for a row with `MESSAGE_COLUMNS`.'''
+    return {
+        'id': row.id,
+        'situation': row.situation,
+        'justification': row.justification,
+        'responsible': row.responsible,
+        'date': isoformat(row.date),
+        'pedido_id': row.pedido_id,
+        'id_recurso': row.id_recurso,
+    }
+
+
+def pedidos_keywords(pedido_ids):
+    '''Returns the keywords names of each pedido, using a single query.'''
+    keywords = collections.defaultdict(list)
+    if pedido_ids:
+        for pedido_id, name in (
+                db.session.query(pedido_keyword.c.pedido_id, Keyword.name)
+                .join(Keyword, Keyword.id == pedido_keyword.c.keyword_id)
+                .filter(pedido_keyword.c.pedido_id.in_(pedido_ids))):
+            keywords[pedido_id].append(name)
+    return keywords
+
+
+def serialize_pedidos(pedido_ids):
+    '''Returns the dicts of the pedidos with these ids, in the same order.
+
+    Each relationship is loaded with a single query for all the pedidos, so
+    the number of queries doesn't depend on how many pedidos are passed.
+    Ids not found are skipped.'''
+    pedido_ids = list(pedido_ids)
+    if not pedido_ids:
+        return []
+
+    pedidos = db.session.query(
+        Pedido.id, Pedido.protocol, Pedido.interessado, Pedido.situation,
+        raw(Pedido.request_date), Pedido.contact_option, Pedido.description,
+        raw(Pedido.deadline), Pedido.orgao_name,
+    ).filter(Pedido.id.in_(pedido_ids))
+
+    history = collections.defaultdict(list)
+    messages = (db.session.query(*MESSAGE_COLUMNS)
+                .filter(Message.pedido_id.in_(pedido_ids))
+                .order_by(Message.id))
+    for msg in messages:
+        history[msg.pedido_id].append(message_as_dict(msg))
+
+    authors = dict(
+        db.session.query(pedido_author.c.pedido_id, Author.name)
+        .join(Author, Author.id == pedido_author.c.author_id)
+        .filter(pedido_author.c.pedido_id.in_(pedido_ids))
+    )
+
+    keywords = pedidos_keywords(pedido_ids)
+
+    attachments = collections.defaultdict(list)
+    rows = (db.session.query(pedido_attachments.c.pedido_id, Attachment.id,
+                             Attachment.name,
+                             raw(Attachment.ia_url, sa.Unicode))
+            .join(Attachment,
+                  Attachment.id == pedido_attachments.c.attachment_id)
+            .filter(pedido_attachments.c.pedido_id.in_(pedido_ids)))
+    for pedido_id, att_id, name, ia_url in rows:
+        attachments[pedido_id].append(
+            {'id': att_id, 'name': name, 'ia_url': ia_url})
+
+    by_id = dict((p.id, p) for p in pedidos)
+    return [
+        {
+            'id': p.id,
+            'protocol': p.protocol,
+            'interessado': p.interessado,
+            'situation': p.situation,
+            'request_date': isoformat(p.request_date),
+            'contact_option': p.contact_option,
+            'description': p.description,
+            'deadline': isoformat(p.deadline) if p.deadline else '',
+            'orgao_name': p.orgao_name,
+            'history': history[p.id],
+            'author': authors.get(p.id),
+            'keywords': keywords[p.id],
+            'attachments': attachments[p.id],
+        }
+        for p in (by_id[i] for i in pedido_ids if i in by_id)
+    ]
+
+
+def serialize_pedido(pedido_id):
+    '''Returns the dict of a single pedido, or None if it doesn't exist.'''
+    result = serialize_pedidos([pedido_id])
+    return result[0] if result else None
+
+
+def serialize_author_pedidos(author_id):
+    '''Returns the summary of the pedidos of an author.'''
+    pedidos = db.session.query(
+        Pedido.id, Pedido.protocol, Pedido.orgao_name, Pedido.situation,
+        raw(Pedido.deadline),
+    )
+    pedidos = (pedidos
+               .join(pedido_author, pedido_author.c.pedido_id == Pedido.id)
+               .filter(pedido_author.c.author_id == author_id).all())
+    keywords = pedidos_keywords([p.id for p in pedidos])
+    return [
+        {
+            'id': p.id,
+            'protocolo': p.protocol,
+            'orgao': p.orgao_name,
+            'situacao': p.situation,
+            'deadline': isoformat(p.deadline) if p.deadline else '',
+            'keywords': keywords[p.id],
+        }
+        for p in pedidos
+    ]
+
+
+def serialize_waiting_prepedidos():
+    '''Returns the PrePedidos waiting to be sent, with their authors.'''
+    prepedidos = db.session.query(
+        PrePedido.text, PrePedido.orgao_name, raw(PrePedido.created_at),
+        PrePedido.keywords, Author.name,
+    )
+    prepedidos = (prepedidos.filter(PrePedido.state == 'WAITING')
+                  .filter(PrePedido.author_id == Author.id))
+    return [
+        {
+            'text': p.text,
+            'orgao': p.orgao_name,
+            'created': isoformat(p.created_at),
+            'keywords': p.keywords,
+            'author': p.name,
+        }
+        for p in prepedidos
+    ]
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import os
+import threading
+import time
+
+import arrow
+
+from archive import create_backend
+from downloads import folder_lock, remove_folder
+from errors import ArchiveError
+from extensions import db
+from models import UploadTask
+
+
+class Uploader(object):
+    '''Archives the queued attachments (see models.UploadTask) with
+    UPLOAD_WORKERS threads, so scraping doesn't wait for uploads.
+
+    Failed uploads are retried later, with exponential backoff. Uploading a
+    file again replaces it, so a retry after an interrupted upload is
+    harmless. A task queued again while it is uploaded is left for a new
+    upload. When all files of a staging folder are archived, the folder
+    is removed.'''
+
+    def __init__(self, app, backend=None):
+        self.app = app
+        self.backend = backend or create_backend(app.config)
+        self._stop = threading.Event()
+        self._threads = []
+
+    @property
+    def config(self):
+        return self.app.config
+
+    def start(self):
+        with self.app.app_context():
+            # Uploads interrupted when an uploader stopped. Recent ones may
+            # be of another uploader still running (eg.: the browser's and
+            # manage.py uploader)
+            stale = arrow.utcnow().replace(
+                seconds=-self.config['UPLOAD_STALE_AFTER'])
+            UploadTask.query.filter(
+                UploadTask.status == 'UPLOADING',
+                UploadTask.updated_at < stale,
+            ).update({'status': 'PENDING'}, synchronize_session=False)
+            db.session.commit()
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._work)
+            for _ in range(self.config['UPLOAD_WORKERS'])
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, wait=True):
+        '''Stops the workers, waiting for the current uploads to finish.'''
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def run(self):
+        '''Uploads until interrupted.'''
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        finally:
+            self.stop()
+
+    def _work(self):
+        with self.app.app_context():
+            try:
+                while not self._stop.is_set():
+                    if not self.upload_next():
+                        self._stop.wait(self.config['UPLOAD_POLL_INTERVAL'])
+            finally:
+                db.session.remove()
+
+    def claim(self):
+        '''Takes the next task due, marking it as UPLOADING. Returns None if
+        there is none.'''
+        now = arrow.utcnow()
+        candidates = db.session.query(UploadTask.id).filter(
+            UploadTask.status == 'PENDING',
+            UploadTask.next_attempt_at <= now,
+        ).order_by(UploadTask.next_attempt_at).limit(
+            self.config['UPLOAD_WORKERS'] + 1).all()
+        for (task_id,) in candidates:
+            # Only one worker changes it from PENDING
+            claimed = UploadTask.query.filter_by(
+                id=task_id, status='PENDING'
+            ).update({'status': 'UPLOADING', 'updated_at': now},
+                     synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return UploadTask.query.get(task_id)
+        return None
+
+    def upload_next(self):
+        '''Uploads the next task due. Returns if there was one.'''
+        task = self.claim()
+        if not task:
+            return False
+        path = os.path.join(task.folder, task.filename)
+        identifier = '{prefix}_pedido_{protocol}'.format(
+            prefix=self.config['ATTACHMENT_URL_PREFIX'],
+            protocol=task.pedido_protocol)
+        try:
+            if not os.path.exists(path):
+                raise ArchiveError('File not found: {}'.format(path))
+            self.backend.upload(
+                identifier, path,
+                metadata={'created_at': arrow.now().isoformat()},
+                name=UploadTask.archived_name(task.filename, task.sha256))
+        except Exception as error:
+            self.retry_later(task, error)
+        else:
+            self.done(task)
+        return True
+
+    def finish(self, task, **changes):
+        '''Updates the task claimed by this worker with `changes`, unless
+        it was queued again meanwhile (see UploadTask.enqueue), as then the
+        file changed. Returns if it was updated.'''
+        updated = UploadTask.query.filter_by(
+            id=task.id, status='UPLOADING', updated_at=task.updated_at
+        ).update(changes, synchronize_session=False)
+        db.session.commit()
+        if not updated:
+            self.app.logger.info(
+                'Anexo {} enfileirado de novo.'.format(task.filename))
+        return bool(updated)
+
+    def done(self, task):
+        if not self.finish(task, status='DONE', updated_at=arrow.utcnow()):
+            return
+        self.app.logger.info('Anexo {} enviado.'.format(task.filename))
+
+        # The scraper holds the lock until the tasks of the files it adds
+        # to the folder are commited
+        with folder_lock(task.folder):
+            remaining = UploadTask.query.filter(
+                UploadTask.folder == task.folder,
+                UploadTask.status != 'DONE',
+            ).count()
+            if not remaining:
+                remove_folder(task.folder)
+
+    def retry_later(self, task, error):
+        now = arrow.utcnow()
+        attempts = task.attempts + 1
+        changes = {
+            'attempts': attempts,
+            'last_error': '{}: {}'.format(type(error).__name__, error),
+            'updated_at': now,
+        }
+        if attempts >= self.config['UPLOAD_MAX_ATTEMPTS']:
+            changes['status'] = 'FAILED'
+        else:
+            changes['status'] = 'PENDING'
+            delay = min(
+                self.config['UPLOAD_RETRY_BASE'] * 2 ** (attempts - 1),
+                self.config['UPLOAD_RETRY_MAX'])
+            changes['next_attempt_at'] = now.replace(seconds=+delay)
+        if self.finish(task, **changes):
+            self.app.logger.info('Erro ao enviar anexo {} ({}): {}'.format(
+                task.filename, changes['status'], changes['last_error']))
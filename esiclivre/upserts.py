@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import collections
+
+import sqlalchemy as sa
+
+from extensions import db
+from models import Author, Keyword, ResourceVersion
+
+
+def insert_ignoring_conflicts(table, rows, session=None, chunk_size=100):
+    '''Inserts rows with a single statement per `chunk_size` rows, skipping
+    the ones that violate unique constraints (ON CONFLICT DO NOTHING on
+    Postgres and INSERT OR IGNORE on SQLite). Other databases do a plain
+    insert.
+
+    All rows must have the same keys. Needs to be commited.'''
+    if not rows:
+        return
+    session = session or db.session
+    # Keeps the statements under the databases bound parameters limits
+    if len(rows) > chunk_size:
+        for start in range(0, len(rows), chunk_size):
+            insert_ignoring_conflicts(
+                table, rows[start:start + chunk_size], session, chunk_size)
+        return
+    dialect = session.get_bind(mapper=None).dialect.name
+    columns = sorted(rows[0])
+    values = ', '.join(
+        '({})'.format(', '.join(':{}_{}'.format(c, i) for c in columns))
+        for i in range(len(rows))
+    )
+    sql = 'INSERT {ignore}INTO {table} ({columns}) VALUES {values}{conflict}'
+    statement = sa.text(sql.format(
+        ignore='OR IGNORE ' if dialect == 'sqlite' else '',
+        table=table.name,
+        columns=', '.join(columns),
+        values=values,
+        conflict=' ON CONFLICT DO NOTHING' if dialect == 'postgresql' else '',
+    ))
+    # Keeps the columns types, so values are converted as usual
+    statement = statement.bindparams(*[
+        sa.bindparam('{}_{}'.format(c, i), row[c], type_=table.c[c].type)
+        for i, row in enumerate(rows) for c in columns
+    ])
+    session.execute(statement)
+
+
+def resolve_by_name(model, names, resource):
+    '''Returns the objects of `model` with these names, in the same order,
+    creating the missing ones and bumping the version of `resource`.
+
+    Uses a single SELECT, plus one INSERT and one SELECT for the missing
+    ones, whatever the number of names. Needs to be commited.'''
+    names = list(collections.OrderedDict.fromkeys(names))
+    if not names:
+        return []
+    found = dict(
+        (obj.name, obj)
+        for obj in db.session.query(model).filter(model.name.in_(names))
+    )
+    missing = [name for name in names if name not in found]
+    if missing:
+        insert_ignoring_conflicts(
+            model.__table__, [{'name': name} for name in missing])
+        found.update(
+            (obj.name, obj)
+            for obj in db.session.query(model).filter(model.name.in_(missing))
+        )
+        ResourceVersion.bump(resource)
+    return [found[name] for name in names]
+
+
+def resolve_keywords(names):
+    '''Returns the Keywords with these names, creating the missing ones.'''
+    return resolve_by_name(Keyword, names, 'keywords')
+
+
+def resolve_author(name):
+    '''Returns the Author with this name, creating it if needed.'''
+    return resolve_by_name(Author, [name], 'authors')[0]
@@ -3,20 +3,28 @@
 
 from __future__ import unicode_literals  # unicode by default
 
-from multiprocessing import Process
-
 import arrow
 import bleach
-from sqlalchemy import desc
-from sqlalchemy.orm import joinedload
+import six
 from sqlalchemy.orm.exc import NoResultFound
+from flask import current_app, Response, stream_with_context
 from flask.ext.restplus import Resource
 
 from viralata.utils import decode_token
-from cutils import paginate, ExtraApi
-
-from models import Orgao, Author, PrePedido, Pedido, Message, Keyword
-from extensions import db, sv
+from cutils import (ExtraApi, cached_count, decode_cursor, keyset_paginate,
+                    conditional_headers, is_not_modified)
+
+from models import (Orgao, Author, PrePedido, Pedido, Message, Keyword,
+                    ResourceVersion, pedido_keyword)
+from export import iter_ndjson
+from search import search
+from upserts import resolve_author, resolve_keywords
+from serializers import (
+    MESSAGE_COLUMNS, isoformat, message_as_dict, pedidos_keywords,
+    serialize_pedido, serialize_pedidos, serialize_author_pedidos,
+    serialize_waiting_prepedidos,
+)
+from extensions import db, sv, pedido_cache, token_cache
 
 
 api = ExtraApi(version='1.0',
@@ -38,17 +46,63 @@ api.update_parser_arguments({
         'type': list,
         'help': 'Keywords to tag the pedido.',
     },
+    'pedidos': {
+        'location': 'json',
+        'type': list,
+        'help': 'List of pedidos, each with "text", "orgao" and "keywords".',
+    },
+    'cursor': {
+        'help': 'Opaque cursor returned as "next_cursor" by the previous '
+        'page. Takes precedence over "page".',
+    },
+    'q': {
+        'help': 'Words to search for.',
+    },
+    'since': {
+        'help': 'Only include what changed after this date (ISO 8601).',
+    },
 })
 
 
+def resource_validators(name):
+    '''Returns the ETag and Last-Modified of a list resource.'''
+    version, updated_at = ResourceVersion.current(name)
+    return '{}-{}'.format(name, version), updated_at
+
+
+def pedido_validators(**filters):
+    '''Returns the ETag and Last-Modified of the pedido matching `filters`.
+    Aborts if the pedido doesn't exist.'''
+    pedido = (db.session.query(Pedido.id, Pedido.updated_at)
+              .filter_by(**filters).first())
+    if not pedido:
+        api.abort(404)
+    timestamp = 0
+    if pedido.updated_at:
+        timestamp = '{}.{:06}'.format(pedido.updated_at.timestamp,
+                                      pedido.updated_at.microsecond)
+    return 'pedido-{}-{}'.format(pedido.id, timestamp), pedido.updated_at
+
+
 @api.route('/orgaos')
 class ListOrgaos(Resource):
 
     def get(self):
         '''List orgaos.'''
+        etag, last_modified = resource_validators('orgaos')
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return None, 304, headers
         return {
             "orgaos": [i[0] for i in db.session.query(Orgao.name).all()]
-        }
+        }, 200, headers
+
+
+def get_control():
+    '''Returns the browser control, aborting if the app has none.'''
+    if getattr(api, 'control', None) is None:
+        api.abort(503, 'No browser control configured.')
+    return api.control
 
 
 @api.route('/captcha/<string:value>')
@@ -56,35 +110,159 @@ class SetCaptcha(Resource):
 
     def get(self, value):
         '''Sets a captcha to be tried by the browser.'''
-        process = Process(target=set_captcha_func, args=(value,))
-        process.start()
+        get_control().set_captcha(value)
         return {}
 
 
+@api.route('/browser/status')
+class BrowserStatus(Resource):
+
+    def get(self):
+        '''Returns what the browser is doing.'''
+        return get_control().status()
+
+
+@api.route('/browser/refresh')
+class BrowserRefresh(Resource):
+
+    @api.doc(parser=api.create_parser('token'))
+    def post(self):
+        '''Asks the browser to update the pedidos as soon as possible.'''
+        args = api.general_parse()
+        verify_token(args['token'])
+        get_control().request_refresh()
+        return {'status': 'ok'}
+
+
 @api.route('/messages')
 class MessageApi(Resource):
 
-    @api.doc(parser=api.create_parser('page', 'per_page_num'))
+    @api.doc(parser=api.create_parser('cursor', 'page', 'per_page_num'))
     def get(self):
-        '''List messages by decrescent time.'''
+        '''List messages by decrescent time.
+
+        Follow "next_cursor" to get the next page. "page" is still accepted,
+        but gets slower as it goes deeper.'''
         args = api.general_parse()
-        page = args['page']
         per_page_num = args['per_page_num']
-        messages = (db.session.query(Pedido, Message)
-                    .options(joinedload('keywords'))
-                    .filter(Message.pedido_id == Pedido.id)
-                    .order_by(desc(Message.date)))
+        cursor = None
+        if args['cursor']:
+            cursor = decode_cursor(args['cursor'])
+            try:
+                date, msg_id = cursor
+                cursor = (arrow.get(date), int(msg_id))
+            except (TypeError, ValueError, arrow.parser.ParserError):
+                api.abort_with_msg(400, 'Invalid cursor.', ['cursor'])
+        messages = (db.session.query(*MESSAGE_COLUMNS)
+                    .join(Pedido, Pedido.id == Message.pedido_id))
+        total = cached_count(
+            messages, 'messages', current_app.config['MESSAGES_TOTAL_TTL'])
         # Limit que number of results per page
-        messages, total = paginate(messages, page, per_page_num)
+        messages, next_cursor = keyset_paginate(
+            messages, (Message.date, Message.id), cursor, per_page_num,
+            key=lambda row: (isoformat(row.date), row.id),
+            offset=0 if cursor else args['page'] * per_page_num,
+        )
+        keywords = pedidos_keywords(set(msg.pedido_id for msg in messages))
         return {
             'messages': [
-                dict(msg.as_dict, keywords=[kw.name for kw in pedido.keywords])
-                for pedido, msg in messages
+                dict(message_as_dict(msg), keywords=keywords[msg.pedido_id])
+                for msg in messages
             ],
             'total': total,
+            'next_cursor': next_cursor,
+        }
+
+
+@api.route('/search')
+class Search(Resource):
+
+    @api.doc(parser=api.create_parser('q', 'page', 'per_page_num'))
+    def get(self):
+        '''Searches pedidos by their descriptions and messages, returning
+        the best matches first.'''
+        args = api.general_parse()
+        if not args['q'] or not args['q'].split():
+            api.abort_with_msg(400, 'No search terms.', ['q'])
+        total, results = search(args['q'], args['page'], args['per_page_num'])
+        ranks = dict(results)
+        return {
+            'query': args['q'],
+            'total': total,
+            'pedidos': [
+                dict(pedido, rank=ranks[pedido['id']])
+                for pedido in serialize_pedidos(i for i, _ in results)
+            ],
         }
 
 
+@api.route('/export')
+class Export(Resource):
+
+    @api.doc(parser=api.create_parser('since'))
+    def get(self):
+        '''Streams all pedidos, with their history, keywords and
+        attachments, as newline delimited JSON (one pedido per line).'''
+        args = api.general_parse()
+        since = None
+        if args['since']:
+            try:
+                since = arrow.get(args['since'])
+            except (TypeError, ValueError, arrow.parser.ParserError):
+                api.abort_with_msg(400, 'Invalid date.', ['since'])
+        return Response(
+            stream_with_context(iter_ndjson(
+                since, current_app.config['EXPORT_CHUNK_SIZE'])),
+            mimetype='application/x-ndjson',
+        )
+
+
+def verify_token(token):
+    '''Returns the claims of a token, verifying its signature only if it
+    wasn't verified recently.'''
+    return token_cache.decode(token, lambda: decode_token(token, sv, api))
+
+
+def check_pedido(text, orgao, orgao_exists):
+    '''Returns the error message and fields of an invalid pedido, or None.
+
+    `orgao_exists` is a function that checks if an orgao name is valid.'''
+    # Size limit enforced by eSIC
+    if len(text) > 6000:
+        return 'Text size limit exceeded.', ['text']
+    if not orgao:
+        return 'No Orgao specified.', ['orgao']
+    if not orgao_exists(orgao):
+        return 'Orgao not found.', ['orgao']
+    return None
+
+
+def check_batch_item(item):
+    '''Returns the error message and fields of a pedido of a batch whose
+    values have wrong types, or None.'''
+    if not isinstance(item, dict):
+        return 'Invalid pedido.', []
+    for field in ('text', 'orgao'):
+        value = item.get(field)
+        if value is not None and not isinstance(value, six.string_types):
+            return 'Invalid {}.'.format(field), [field]
+    keywords = item.get('keywords') or []
+    if (not isinstance(keywords, list) or
+       not all(isinstance(k, six.string_types) for k in keywords)):
+        return 'Invalid keywords.', ['keywords']
+    return None
+
+
+def new_pre_pedido(author_id, orgao, text, keywords):
+    '''Returns a PrePedido waiting to be sent.'''
+    pre_pedido = PrePedido(author_id=author_id, orgao_name=orgao)
+    pre_pedido.keywords = ','.join(k for k in keywords)
+    pre_pedido.text = text
+    pre_pedido.state = 'WAITING'
+    pre_pedido.created_at = arrow.now()
+    return pre_pedido
+
+
 @api.route('/pedidos')
 class PedidoApi(Resource):
 
@@ -92,68 +270,93 @@ class PedidoApi(Resource):
     def post(self):
         '''Adds a new pedido to be submited to eSIC.'''
         args = api.general_parse()
-        decoded = decode_token(args['token'], sv, api)
+        decoded = verify_token(args['token'])
         author_name = decoded['username']
 
         text = bleach.clean(args['text'], strip=True)
 
-        # Size limit enforced by eSIC
-        if len(text) > 6000:
-            api.abort_with_msg(400, 'Text size limit exceeded.', ['text'])
-
-        # Validate 'orgao'
-        if args['orgao']:
-            orgao_exists = db.session.query(Orgao).filter_by(
-                name=args['orgao']).count() == 1
-            if not orgao_exists:
-                api.abort_with_msg(400, 'Orgao not found.', ['orgao'])
-        else:
-            api.abort_with_msg(400, 'No Orgao specified.', ['orgao'])
-
-        # Get author (add if needed)
-        try:
-            author_id = db.session.query(
-                Author.id).filter_by(name=author_name).one()
-        except NoResultFound:
-            author = Author(name=author_name)
-            db.session.add(author)
-            db.session.commit()
-            author_id = author.id
+        error = check_pedido(
+            text, args['orgao'],
+            lambda name: db.session.query(Orgao).filter_by(
+                name=name).count() == 1)
+        if error:
+            api.abort_with_msg(400, *error)
 
-        pre_pedido = PrePedido(author_id=author_id, orgao_name=args['orgao'])
+        # Get author and keywords (add if needed)
+        author = resolve_author(author_name)
+        resolve_keywords(args['keywords'])
 
-        # Set keywords
-        for keyword_name in args['keywords']:
-            try:
-                keyword = (db.session.query(Keyword)
-                           .filter_by(name=keyword_name).one())
-            except NoResultFound:
-                keyword = Keyword(name=keyword_name)
-                db.session.add(keyword)
-                db.session.commit()
-        pre_pedido.keywords = ','.join(k for k in args['keywords'])
-        pre_pedido.text = text
-        pre_pedido.state = 'WAITING'
-        pre_pedido.created_at = arrow.now()
-
-        db.session.add(pre_pedido)
+        db.session.add(new_pre_pedido(
+            author.id, args['orgao'], text, args['keywords']))
         db.session.commit()
         return {'status': 'ok'}
 
 
+@api.route('/pedidos/batch')
+class PedidoBatchApi(Resource):
+
+    @api.doc(parser=api.create_parser('token', 'pedidos'))
+    def post(self):
+        '''Adds many pedidos to be submited to eSIC at once.
+
+        Each pedido has "text", "orgao" and "keywords", as in "/pedidos".
+        Returns the result of each one, in the same order. Invalid pedidos
+        are skipped, the valid ones are added in a single transaction.'''
+        args = api.general_parse()
+        decoded = verify_token(args['token'])
+
+        items = args['pedidos'] or []
+        if len(items) > current_app.config['PEDIDOS_BATCH_MAX']:
+            api.abort_with_msg(400, 'Too many pedidos.', ['pedidos'])
+
+        orgaos = set(name for name, in db.session.query(Orgao.name))
+
+        results = []
+        valid = []
+        for item in items:
+            error = check_batch_item(item)
+            if not error:
+                text = bleach.clean(item.get('text') or '', strip=True)
+                error = check_pedido(
+                    text, item.get('orgao'), orgaos.__contains__)
+            if error:
+                message, fields = error
+                results.append({'status': 'error',
+                                'message': message, 'fields': fields})
+                continue
+            valid.append((item['orgao'], text, item.get('keywords') or []))
+            results.append({'status': 'ok'})
+
+        if valid:
+            # Get author and keywords (add if needed)
+            author = resolve_author(decoded['username'])
+            resolve_keywords(k for _, _, keywords in valid for k in keywords)
+            db.session.add_all([
+                new_pre_pedido(author.id, orgao, text, keywords)
+                for orgao, text, keywords in valid
+            ])
+            db.session.commit()
+        return {'results': results}
+
+
 @api.route('/pedidos/protocolo/<int:protocolo>')
 class GetPedidoProtocolo(Resource):
 
     def get(self, protocolo):
         '''Returns a pedido by its protocolo.'''
-        try:
-            pedido = (db.session.query(Pedido)
-                      .options(joinedload('history'))
-                      .options(joinedload('keywords'))
-                      .filter_by(protocol=protocolo).one())
-        except NoResultFound:
+        etag, last_modified = pedido_validators(protocol=protocolo)
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return None, 304, headers
+
+        def load():
+            pedido_id = (db.session.query(Pedido.id)
+                         .filter_by(protocol=protocolo).scalar())
+            return serialize_pedido(pedido_id) if pedido_id else None
+        pedido = pedido_cache.get('protocol', protocolo, load, etag)
+        if not pedido:
             api.abort(404)
-        return pedido.as_dict
+        return pedido, 200, headers
 
 
 @api.route('/pedidos/id/<int:id_number>')
@@ -161,11 +364,15 @@ class GetPedidoId(Resource):
 
     def get(self, id_number):
         '''Returns a pedido by its id.'''
-        try:
-            pedido = db.session.query(Pedido).filter_by(id=id_number).one()
-        except NoResultFound:
+        etag, last_modified = pedido_validators(id=id_number)
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return None, 304, headers
+        pedido = pedido_cache.get(
+            'id', id_number, lambda: serialize_pedido(id_number), etag)
+        if not pedido:
             api.abort(404)
-        return pedido.as_dict
+        return pedido, 200, headers
 
 
 @api.route('/keywords/<string:keyword_name>')
@@ -173,20 +380,15 @@ class GetPedidoKeyword(Resource):
 
     def get(self, keyword_name):
         '''Returns pedidos marked with a specific keyword.'''
-        try:
-            pedidos = (db.session.query(Keyword)
-                       .options(joinedload('pedidos'))
-                       .options(joinedload('pedidos.history'))
-                       .filter_by(name=keyword_name).one()).pedidos
-        except NoResultFound:
-            pedidos = []
+        pedido_ids = (db.session.query(Pedido.id)
+                      .join(pedido_keyword,
+                            pedido_keyword.c.pedido_id == Pedido.id)
+                      .join(Keyword, Keyword.id == pedido_keyword.c.keyword_id)
+                      .filter(Keyword.name == keyword_name)
+                      .order_by(Pedido.request_date.desc()))
         return {
             'keyword': keyword_name,
-            'pedidos': [
-                pedido.as_dict for pedido in sorted(
-                    pedidos, key=lambda p: p.request_date, reverse=True
-                )
-            ],
+            'pedidos': serialize_pedidos(i for i, in pedido_ids),
         }
 
 
@@ -195,10 +397,11 @@ class GetPedidoOrgao(Resource):
 
     def get(self, orgao):
         try:
-            pedido = db.session.query(Pedido).filter_by(orgao=orgao).one()
+            pedido_id, = (db.session.query(Pedido.id)
+                          .filter_by(orgao_name=orgao).one())
         except NoResultFound:
             api.abort(404)
-        return pedido.as_dict
+        return serialize_pedido(pedido_id)
 
 
 @api.route('/keywords')
@@ -206,11 +409,16 @@ class ListKeywords(Resource):
 
     def get(self):
         '''List keywords.'''
+        etag, last_modified = resource_validators('keywords')
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return None, 304, headers
+
         keywords = db.session.query(Keyword.name).all()
 
         return {
             "keywords": [k[0] for k in keywords]
-        }
+        }, 200, headers
 
 
 @api.route('/authors/<string:name>')
@@ -219,24 +427,13 @@ class GetAuthor(Resource):
     def get(self, name):
         '''Returns pedidos marked with a specific keyword.'''
         try:
-            author = (db.session.query(Author)
-                      .options(joinedload('pedidos'))
-                      .filter_by(name=name).one())
+            author_id, = (db.session.query(Author.id)
+                          .filter_by(name=name).one())
         except NoResultFound:
             api.abort(404)
         return {
-            'name': author.name,
-            'pedidos': [
-                {
-                    'id': p.id,
-                    'protocolo': p.protocol,
-                    'orgao': p.orgao,
-                    'situacao': p.situation(),
-                    'deadline': p.deadline.isoformat() if p.deadline else '',
-                    'keywords': [kw.name for kw in p.keywords],
-                }
-                for p in author.pedidos
-            ]
+            'name': name,
+            'pedidos': serialize_author_pedidos(author_id),
         }
 
 
@@ -245,11 +442,16 @@ class ListAuthors(Resource):
 
     def get(self):
         '''List authors.'''
+        etag, last_modified = resource_validators('authors')
+        headers = conditional_headers(etag, last_modified)
+        if is_not_modified(etag, last_modified):
+            return None, 304, headers
+
         authors = db.session.query(Author.name).all()
 
         return {
             "authors": [a[0] for a in authors]
-        }
+        }, 200, headers
 
 
 @api.route('/prepedidos')
@@ -257,20 +459,5 @@ class PrePedidoAPI(Resource):
 
     def get(self):
         '''List PrePedidos.'''
-        q = db.session.query(PrePedido, Author).filter_by(state='WAITING')
-        q = q.filter(PrePedido.author_id == Author.id)
-
-        return {
-            'prepedidos': [{
-                'text': p.text,
-                'orgao': p.orgao_name,
-                'created': p.created_at.isoformat(),
-                'keywords': p.keywords,
-                'author': a.name,
-            } for p, a in q.all()]
-        }
-
+        return {'prepedidos': serialize_waiting_prepedidos()}
 
-def set_captcha_func(value):
-    '''Sets a captcha to be tried by the browser.'''
-    api.browser.set_captcha(value)
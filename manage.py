@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+from __future__ import print_function
 from __future__ import unicode_literals  # unicode by default
 import os
+import sys
 
 from flask.ext.script import Manager, Shell
 from flask.ext.migrate import Migrate, MigrateCommand
@@ -27,11 +29,19 @@ manager.add_command('shell', Shell(make_context=lambda: {
 }))
 
 
+def require_browser():
+    '''Exits with an error if this app has no browser.'''
+    if manager.app.browser is None:
+        sys.exit('The browser is disabled (BROWSER_ENABLED = False in the '
+                 'settings).')
+
+
 @manager.command
 def run(browserless=False):
     '''Run in local machine.'''
     # Allows disable browser by parameter
     if not browserless:
+        require_browser()
         # Avoids starting the browser when manager loads
         if (not manager.app.debug or
            os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
@@ -43,14 +53,116 @@ def run(browserless=False):
 @manager.command
 def browser_once():
     '''Run browser once.'''
+    require_browser()
     manager.app.browser.rodar_uma_vez()
 
 
+@manager.command
+def uploader():
+    '''Archive the queued attachments, without the browser.'''
+    from esiclivre.uploader import Uploader
+    Uploader(manager.app).run()
+
+
+@manager.command
+def export(output=None, since=None):
+    '''Export pedidos as newline delimited JSON.'''
+    from esiclivre.export import iter_ndjson
+    import arrow
+    import codecs
+
+    since = arrow.get(since) if since else None
+    if output:
+        out = codecs.open(output, 'w', encoding='utf8')
+    else:
+        out = codecs.getwriter('utf8')(sys.stdout)
+    chunk_size = manager.app.config['EXPORT_CHUNK_SIZE']
+    try:
+        for line in iter_ndjson(since, chunk_size):
+            out.write(line)
+    finally:
+        if output:
+            out.close()
+
+
+# Benchmarks
+benchmark = Manager(usage='Run performance benchmarks.')
+manager.add_command('benchmark', benchmark)
+
+
+def print_times(times):
+    for name, seconds in sorted(times.items()):
+        print('{}: {:.3f} ms'.format(name, seconds * 1000))
+
+
+def format_seconds(seconds):
+    return 'n/a' if seconds is None else '{:.2f} s'.format(seconds)
+
+
+@benchmark.command
+def token(token, repeat=1000):
+    '''Per request cost of verifying a token, with and without cache.'''
+    from esiclivre.benchmarks import token_verification
+    print_times(token_verification(token, repeat))
+
+
+@benchmark.command
+def startup(repeat=5):
+    '''Time to import and create the app, with and without the browser.'''
+    from esiclivre.benchmarks import app_startup
+    for factory, (seconds, loaded) in sorted(app_startup(repeat).items()):
+        print('{}: {:.3f} s (scraper modules loaded: {})'.format(
+            factory, seconds, ', '.join(loaded) or 'none'))
+
+
+@benchmark.command
+def parser(corpus=None, repeat=3):
+    '''Pedido pages parsed per second and peak memory, by parser. Uses
+    the .html pages saved in the corpus directory, or synthetic ones.'''
+    from esiclivre.benchmarks import pedido_parsers
+    measures, mismatches = pedido_parsers(corpus, repeat)
+    for name, (rate, peak) in sorted(measures.items()):
+        print('{}: {:.1f} pages/s, peak memory +{} KiB'.format(
+            name, rate, peak))
+    print('Pages parsed differently: {}'.format(mismatches))
+
+
+@benchmark.command
+def memory(size=5000, parser='html5lib'):
+    '''Peak memory while syncing twice a synthetic listing of pedidos, on
+    a scratch DB.'''
+    from esiclivre.benchmarks import sync_memory
+    for count, growth in sync_memory(size, parser):
+        print('{} pages opened: peak memory +{} KiB'.format(count, growth))
+
+
+@benchmark.command
+def captcha(corpus=None, solvers=None, fetch_time=1.0):
+    '''Captchas solved and median time to login, by captcha solver, over
+    a corpus of labeled captcha audios (CAPTCHA_CORPUS_PATH by default).
+    `solvers` is a comma separated list.'''
+    from esiclivre.benchmarks import captcha_solvers
+    config = manager.app.config
+    names = solvers.split(',') if solvers else None
+    results, labeled, unlabeled = captcha_solvers(
+        corpus or config['CAPTCHA_CORPUS_PATH'], config, names,
+        float(fetch_time))
+    print('{} labeled captchas, {} unlabeled (not used)'.format(
+        labeled, unlabeled))
+    for name, (rate, sequential, pipelined) in sorted(results.items()):
+        print('{}: {:.1%} solved, median time to login: {} one at a time, '
+              '{} pipelined'.format(name, rate, format_seconds(sequential),
+                                    format_seconds(pipelined)))
+
+
 @manager.command
 def initdb():
     from esiclivre.models import Orgao
+    from esiclivre.search import create_search_index, drop_search_index
+    drop_search_index(db.engine)
     db.drop_all()
     db.create_all()
+    create_search_index(db.engine)
 
     db.session.add(Orgao(name='A test'))
     db.session.add(Orgao(name='B test'))
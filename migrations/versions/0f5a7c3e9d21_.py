@@ -0,0 +1,47 @@
+"""Add UploadTask table, the queue of attachments to archive.
+
+Revision ID: 0f5a7c3e9d21
+Revises: b4c81d6f2e90
+Create Date: 2026-10-18 17:08:41.660917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0f5a7c3e9d21'
+down_revision = 'b4c81d6f2e90'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+def upgrade():
+    op.create_table(
+        'upload_task',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('pedido_protocol', sa.Integer(), nullable=False),
+        sa.Column('filename', sa.String(length=255), nullable=False),
+        sa.Column('folder', sa.String(length=1024), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at',
+                  sqlalchemy_utils.types.arrow.ArrowType(), nullable=True),
+        sa.Column('last_error', sa.UnicodeText(), nullable=True),
+        sa.Column('updated_at',
+                  sqlalchemy_utils.types.arrow.ArrowType(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_upload_task_protocol_filename', 'upload_task',
+                    ['pedido_protocol', 'filename'], unique=True)
+    op.create_index(op.f('ix_upload_task_status'), 'upload_task',
+                    ['status'], unique=False)
+    op.create_index(op.f('ix_upload_task_next_attempt_at'), 'upload_task',
+                    ['next_attempt_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_upload_task_next_attempt_at'),
+                  table_name='upload_task')
+    op.drop_index(op.f('ix_upload_task_status'), table_name='upload_task')
+    op.drop_index('ix_upload_task_protocol_filename',
+                  table_name='upload_task')
+    op.drop_table('upload_task')
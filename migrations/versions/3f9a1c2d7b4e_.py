@@ -0,0 +1,22 @@
+"""Add Message (date, id) index for keyset pagination.
+
+Revision ID: 3f9a1c2d7b4e
+Revises: 21bf24bc247d
+Create Date: 2026-10-18 09:12:31.402117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2d7b4e'
+down_revision = '21bf24bc247d'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_message_date_id',
+                    'message', ['date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_date_id', table_name='message')
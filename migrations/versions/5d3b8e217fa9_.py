@@ -0,0 +1,24 @@
+"""Add Pedido.listing_summary for incremental syncs.
+
+Revision ID: 5d3b8e217fa9
+Revises: a72d4e9f0c13
+Create Date: 2026-10-18 13:41:26.504118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3b8e217fa9'
+down_revision = 'a72d4e9f0c13'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('pedido',
+                  sa.Column('listing_summary', sa.String(length=40),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('pedido', 'listing_summary')
@@ -0,0 +1,32 @@
+"""Add SHA-256 and size to attachments, and SHA-256 to upload tasks.
+
+Revision ID: 7e2d94b05c18
+Revises: 0f5a7c3e9d21
+Create Date: 2026-10-18 18:14:57.402391
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e2d94b05c18'
+down_revision = '0f5a7c3e9d21'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('attachment',
+                  sa.Column('sha256', sa.String(length=64), nullable=True))
+    op.add_column('attachment',
+                  sa.Column('size', sa.BigInteger(), nullable=True))
+    op.create_index(op.f('ix_attachment_sha256'), 'attachment', ['sha256'],
+                    unique=False)
+    op.add_column('upload_task',
+                  sa.Column('sha256', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('upload_task', 'sha256')
+    op.drop_index(op.f('ix_attachment_sha256'), table_name='attachment')
+    op.drop_column('attachment', 'size')
+    op.drop_column('attachment', 'sha256')
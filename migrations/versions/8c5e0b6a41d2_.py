@@ -0,0 +1,38 @@
+"""Add Pedido.updated_at and ResourceVersion table.
+
+Revision ID: 8c5e0b6a41d2
+Revises: 3f9a1c2d7b4e
+Create Date: 2026-10-18 10:02:47.918305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c5e0b6a41d2'
+down_revision = '3f9a1c2d7b4e'
+
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+
+def upgrade():
+    op.add_column('pedido',
+                  sa.Column('updated_at',
+                            sqlalchemy_utils.types.arrow.ArrowType(),
+                            nullable=True))
+    op.create_index(op.f('ix_pedido_updated_at'),
+                    'pedido', ['updated_at'], unique=False)
+    op.create_table(
+        'resource_version',
+        sa.Column('name', sa.String(length=255), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at',
+                  sqlalchemy_utils.types.arrow.ArrowType(),
+                  nullable=True),
+        sa.PrimaryKeyConstraint('name'))
+
+
+def downgrade():
+    op.drop_table('resource_version')
+    op.drop_index(op.f('ix_pedido_updated_at'), table_name='pedido')
+    op.drop_column('pedido', 'updated_at')
@@ -0,0 +1,63 @@
+"""Add full text search index over pedidos and messages.
+
+Revision ID: a72d4e9f0c13
+Revises: 8c5e0b6a41d2
+Create Date: 2026-10-18 11:20:05.113462
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a72d4e9f0c13'
+down_revision = '8c5e0b6a41d2'
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+def sqlite_has_fts5():
+    try:
+        op.get_bind().execute(sa.text('SELECT fts5_source_id()'))
+    except sa.exc.OperationalError:
+        return False
+    return True
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            'CREATE TABLE pedido_search ('
+            '  pedido_id INTEGER PRIMARY KEY,'
+            '  document TSVECTOR NOT NULL)')
+        op.execute(
+            'CREATE INDEX ix_pedido_search_document '
+            '  ON pedido_search USING gin(document)')
+        # Backfills existing pedidos
+        op.get_bind().execute(sa.text(
+            'INSERT INTO pedido_search (pedido_id, document) '
+            'SELECT p.id, '
+            '  setweight(to_tsvector(CAST(:language AS regconfig), '
+            '    coalesce(p.description, \'\')), \'A\') || '
+            '  setweight(to_tsvector(CAST(:language AS regconfig), '
+            '    coalesce(string_agg(m.justification, \' \'), \'\')), \'B\') '
+            'FROM pedido p LEFT JOIN message m ON m.pedido_id = p.id '
+            'GROUP BY p.id'),
+            language=current_app.config['SEARCH_LANGUAGE'])
+    elif dialect == 'sqlite' and sqlite_has_fts5():
+        op.execute(
+            'CREATE VIRTUAL TABLE pedido_search '
+            '  USING fts5(description, justifications)')
+        # Backfills existing pedidos
+        op.execute(
+            'INSERT INTO pedido_search (rowid, description, justifications) '
+            'SELECT p.id, coalesce(p.description, \'\'), '
+            '  coalesce(group_concat(m.justification, \' \'), \'\') '
+            'FROM pedido p LEFT JOIN message m ON m.pedido_id = p.id '
+            'GROUP BY p.id')
+    # Other databases, and SQLite without FTS5, have no index. They are
+    # searched with LIKE
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS pedido_search')
@@ -0,0 +1,79 @@
+"""Add Message.fingerprint, unique in each pedido.
+
+Revision ID: b4c81d6f2e90
+Revises: e61f0a9c3b57
+Create Date: 2026-10-18 15:52:33.208457
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b4c81d6f2e90'
+down_revision = 'e61f0a9c3b57'
+
+from alembic import op
+import arrow
+import hashlib
+import sqlalchemy as sa
+
+
+message = sa.table(
+    'message',
+    sa.column('id', sa.Integer),
+    sa.column('pedido_id', sa.Integer),
+    sa.column('date', sa.DateTime),
+    sa.column('situation', sa.String),
+    sa.column('responsible', sa.String),
+    sa.column('justification', sa.UnicodeText),
+    sa.column('fingerprint', sa.String),
+)
+
+
+def make_fingerprint(date, situation, responsible, justification):
+    # Same as Message.make_fingerprint, that may change later
+    if date is not None:
+        date = arrow.get(date).to('UTC').naive.isoformat()
+    content = u'\x1f'.join(
+        value or u'' for value in
+        (date, situation, responsible, justification))
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+
+def upgrade():
+    op.add_column('message',
+                  sa.Column('fingerprint', sa.String(length=40),
+                            nullable=True))
+
+    # Backfills the fingerprints, removing the repeated messages
+    bind = op.get_bind()
+    rows = bind.execute(sa.select([
+        message.c.id, message.c.pedido_id, message.c.date,
+        message.c.situation, message.c.responsible, message.c.justification,
+    ]).order_by(message.c.id)).fetchall()
+    seen = set()
+    updates = []
+    repeated = []
+    for row in rows:
+        fingerprint = make_fingerprint(
+            row.date, row.situation, row.responsible, row.justification)
+        key = (row.pedido_id, fingerprint)
+        if row.pedido_id is not None and key in seen:
+            repeated.append(row.id)
+            continue
+        seen.add(key)
+        updates.append({'_id': row.id, '_fingerprint': fingerprint})
+    if updates:
+        bind.execute(
+            message.update().where(message.c.id == sa.bindparam('_id'))
+            .values(fingerprint=sa.bindparam('_fingerprint')),
+            updates)
+    for start in range(0, len(repeated), 500):
+        bind.execute(message.delete().where(
+            message.c.id.in_(repeated[start:start + 500])))
+
+    op.create_index('ix_message_pedido_id_fingerprint', 'message',
+                    ['pedido_id', 'fingerprint'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_message_pedido_id_fingerprint', table_name='message')
+    op.drop_column('message', 'fingerprint')
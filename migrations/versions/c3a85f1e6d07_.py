@@ -0,0 +1,34 @@
+"""Backfill Pedido.updated_at.
+
+Revision ID: c3a85f1e6d07
+Revises: 7e2d94b05c18
+Create Date: 2026-10-19 09:12:31.560218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3a85f1e6d07'
+down_revision = '7e2d94b05c18'
+
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Pedidos saved before updated_at existed: their last message, or when
+    # they were requested
+    op.get_bind().execute(sa.text(
+        'UPDATE pedido SET updated_at = coalesce('
+        '  (SELECT max(message.date) FROM message'
+        '   WHERE message.pedido_id = pedido.id),'
+        '  pedido.request_date, :now) '
+        'WHERE updated_at IS NULL'
+    ).bindparams(sa.bindparam(
+        'now', datetime.datetime.utcnow(), type_=sa.DateTime)))
+
+
+def downgrade():
+    # Nothing to undo, the values are still valid
+    pass
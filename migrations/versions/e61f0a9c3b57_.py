@@ -0,0 +1,33 @@
+"""Add Pedido.detail_digest and PedidosUpdate page counts.
+
+Revision ID: e61f0a9c3b57
+Revises: 5d3b8e217fa9
+Create Date: 2026-10-18 14:25:09.731640
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e61f0a9c3b57'
+down_revision = '5d3b8e217fa9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('pedido',
+                  sa.Column('detail_digest', sa.String(length=40),
+                            nullable=True))
+    op.create_index(op.f('ix_pedido_detail_digest'),
+                    'pedido', ['detail_digest'], unique=False)
+    op.add_column('pedidos_update',
+                  sa.Column('pages_fetched', sa.Integer(), nullable=True))
+    op.add_column('pedidos_update',
+                  sa.Column('pages_skipped', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('pedidos_update', 'pages_skipped')
+    op.drop_column('pedidos_update', 'pages_fetched')
+    op.drop_index(op.f('ix_pedido_detail_digest'), table_name='pedido')
+    op.drop_column('pedido', 'detail_digest')
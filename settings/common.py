@@ -1 +1,104 @@
 DEFAULT_AUTHOR= 'ninguem'
+
+# Seconds to reuse the total number of messages returned by /messages
+MESSAGES_TOTAL_TTL = 60
+
+# Cache of serialized pedidos: 'memory' (per process) or 'redis' (shared).
+# Entries are checked against the pedido updated_at, the TTL only bounds
+# changes that didn't touch it
+PEDIDO_CACHE_BACKEND = 'memory'
+PEDIDO_CACHE_SIZE = 1000
+PEDIDO_CACHE_TTL = 300  # seconds
+PEDIDO_CACHE_URL = None  # eg.: 'redis://localhost:6379/0'
+
+# Number of pedidos serialized at a time by the export
+EXPORT_CHUNK_SIZE = 500
+
+# Text search configuration used by Postgres full text search
+SEARCH_LANGUAGE = 'portuguese'
+
+# Maximum number of pedidos sent at once to /pedidos/batch
+PEDIDOS_BATCH_MAX = 100
+
+# Cache of verified tokens (their expiration is still checked)
+TOKEN_CACHE_SIZE = 1000
+TOKEN_CACHE_TTL = 300  # seconds
+
+# Set to False in API only processes (see create_api_app)
+BROWSER_ENABLED = True
+
+# File shared by the browser and the API processes to control the browser
+# (captcha, stop, refresh requests and status). Relative to the working dir.
+BROWSER_CONTROL_PATH = 'browser.control'
+
+# How pedidos are scraped: 'browser' (clicking with Selenium) or 'http'
+# (reusing the browser session, which is only used to login)
+SCRAPER_ENGINE = 'browser'
+
+# 'http' engine: sessions fetching pedidos concurrently, maximum concurrent
+# requests to the eSIC host and pedidos waiting between stages
+SCRAPER_WORKERS = 4
+SCRAPER_HOST_CONCURRENCY = 2
+SCRAPER_QUEUE_SIZE = 16
+# Seconds the http engine waits for each eSIC response (and for each chunk
+# of a downloading attachment)
+SCRAPER_TIMEOUT = 60
+
+# 'full' opens every pedido of the listing once a day. 'incremental' checks
+# the listing every PEDIDOS_SYNC_INTERVAL minutes and only opens the pedidos
+# that are new or whose row changed since the last sync
+PEDIDOS_SYNC_MODE = 'full'
+PEDIDOS_SYNC_INTERVAL = 30
+
+# Parser of pedidos pages: 'html5lib' or 'lxml' (faster, needs lxml installed).
+# With the 'http' engine, lxml pages with modified attachments are also
+# parsed by html5lib, to download them
+PEDIDO_PARSER = 'html5lib'
+
+# Scraped pedidos saved by each DB transaction
+PEDIDOS_SAVE_BATCH = 100
+
+# Seconds to wait for a file downloaded by the browser
+DOWNLOAD_TIMEOUT = 100
+
+# Where attachments are archived: 'internetarchive' or 'local' (copied to
+# ARCHIVE_LOCAL_PATH, for development and tests)
+ARCHIVE_BACKEND = 'internetarchive'
+ARCHIVE_LOCAL_PATH = None
+
+# Attachments uploads queue: concurrent uploads, seconds between checks for
+# new uploads and retries (doubling from UPLOAD_RETRY_BASE seconds up to
+# UPLOAD_RETRY_MAX) before giving up
+UPLOAD_WORKERS = 2
+UPLOAD_POLL_INTERVAL = 5
+UPLOAD_MAX_ATTEMPTS = 8
+UPLOAD_RETRY_BASE = 60
+UPLOAD_RETRY_MAX = 6 * 60 * 60
+# Seconds after which an upload still running is taken as interrupted, and
+# is retried by the next uploader started. Longer than the slowest upload
+UPLOAD_STALE_AFTER = 2 * 60 * 60
+
+# Audio captcha solver: 'google' (online), 'sphinx' (offline, needs
+# pocketsphinx and its CAPTCHA_LANGUAGE model) or 'command' (offline, runs
+# CAPTCHA_SOLVER_COMMAND, with {path} replaced by the WAV file, and reads
+# the text it prints)
+CAPTCHA_SOLVER = 'google'
+CAPTCHA_LANGUAGE = 'pt-BR'
+CAPTCHA_SOLVER_COMMAND = None
+
+# Captchas downloaded ahead, each in its own HTTP session, while the current
+# one is transcribed (0 solves them one at a time in the browser), and
+# captchas tried by each login
+CAPTCHA_PREFETCH = 1
+CAPTCHA_MAX_ATTEMPTS = 30
+
+# Seconds to wait for a prefetched captcha before giving up the login, and
+# for each eSIC response while fetching one
+CAPTCHA_FETCH_TIMEOUT = 60
+
+# Audios of captchas that logged in are kept here, named by their value, as
+# the corpus of `manage.py benchmark captcha` (None to not keep them). The
+# ones that didn't are kept in its 'unlabeled' subdirectory, named by the
+# wrong value: rename them with the right one and move them to the corpus,
+# or the solve rate only counts captchas the solver already got right
+CAPTCHA_CORPUS_PATH = None
@@ -0,0 +1,49 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import os
+
+import flask
+import pytest
+
+from esiclivre.extensions import db, pedido_cache
+from esiclivre.search import create_search_index, drop_search_index
+from esiclivre.views import api
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app():
+    '''The API, without the browser, on an in-memory SQLite DB.'''
+    app = flask.Flask('esiclivre')
+    app.config.from_pyfile(os.path.join(ROOT, 'settings', 'common.py'))
+    app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI='sqlite://',
+        ATTACHMENT_URL_PREFIX='test',
+    )
+    db.init_app(app)
+    api.init_app(app)
+    api.browser = None
+    return app
+
+
+@pytest.fixture
+def db_session(app):
+    '''Empty tables for each test, inside an app context.'''
+    with app.app_context():
+        db.create_all()
+        create_search_index(db.engine)
+        pedido_cache.backend.clear()
+        yield db.session
+        db.session.remove()
+        drop_search_index(db.engine)
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app, db_session):
+    return app.test_client()
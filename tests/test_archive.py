@@ -0,0 +1,60 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import arrow
+import pytest
+
+from esiclivre.archive import LocalArchiveBackend
+from esiclivre.downloads import file_digest
+from esiclivre.extensions import db
+from esiclivre.models import Attachment, Pedido, UploadTask
+from esiclivre.preprocessors.pedidos import archived_copies, attachment_url
+from esiclivre.uploader import Uploader
+
+
+@pytest.fixture
+def archive(tmpdir):
+    return tmpdir.mkdir('archive')
+
+
+@pytest.fixture
+def uploader(app, archive):
+    return Uploader(app, LocalArchiveBackend(str(archive)))
+
+
+def archive_attachment(tmpdir, uploader, pedido, content):
+    '''Stages, archives and saves the attachment a.pdf of `pedido`, as the
+    scraper and the uploader do. Returns its (SHA-256, size).'''
+    folder = tmpdir.join('staging', 'pedido_1')
+    folder.ensure(dir=True).join('a.pdf').write(content)
+    sha256, size = file_digest(str(folder.join('a.pdf')))
+    UploadTask.enqueue(1, str(folder), ['a.pdf'], {'a.pdf': sha256})
+    db.session.commit()
+    assert uploader.upload_next()
+
+    attachment, = pedido.attachments_recurso or [Attachment(name='a.pdf')]
+    attachment.sha256, attachment.size = sha256, size
+    attachment.ia_url = attachment_url(1, 'a.pdf', sha256)
+    pedido.attachments_recurso = [attachment]
+    db.session.commit()
+    return sha256, size
+
+
+def test_archived_copies_never_change(db_session, tmpdir, archive,
+                                      uploader):
+    pedido = Pedido(protocol=1, request_date=arrow.get(2015, 3, 1))
+    db.session.add(pedido)
+    first = archive_attachment(tmpdir, uploader, pedido, 'first')
+
+    copy = archived_copies([first])[first]
+    assert copy.endswith('/test_pedido_1/{}/a.pdf'.format(first[0]))
+
+    # The owner's file changes, the copy linked by others stays as it was
+    second = archive_attachment(tmpdir, uploader, pedido, 'second')
+
+    assert archive.join('test_pedido_1', first[0], 'a.pdf').read() == 'first'
+    assert archive.join('test_pedido_1', second[0], 'a.pdf').read() == (
+        'second')
+    assert archived_copies([first]) == {}
+    assert list(archived_copies([second])) == [second]
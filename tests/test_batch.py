@@ -0,0 +1,56 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+
+import pytest
+
+from esiclivre import views
+from esiclivre.extensions import db
+from esiclivre.models import Orgao, PrePedido
+
+
+@pytest.fixture
+def token(monkeypatch):
+    monkeypatch.setattr(views, 'decode_token', lambda token, sv, api: {
+        'username': 'fulano', 'type': 'micro', 'exp': None})
+    return 'token'
+
+
+def post_batch(client, token, pedidos):
+    response = client.post(
+        '/pedidos/batch', content_type='application/json',
+        data=json.dumps({'token': token, 'pedidos': pedidos}))
+    return response.status_code, json.loads(response.data)
+
+
+def test_batch_reports_invalid_items_without_failing(client, token):
+    db.session.add(Orgao(name='SMS'))
+    db.session.commit()
+
+    status, data = post_batch(client, token, [
+        {'text': 'ok', 'orgao': 'SMS', 'keywords': ['saúde']},
+        'not a pedido',
+        {'text': 'x', 'orgao': ['SMS']},
+        {'text': 'x', 'orgao': {'name': 'SMS'}},
+        {'text': ['x'], 'orgao': 'SMS'},
+        {'text': {'x': 1}, 'orgao': 'SMS'},
+        {'text': 'x', 'orgao': 'SMS', 'keywords': 'saúde'},
+        {'text': 'x', 'orgao': 'SME'},
+        {'text': 'x'},
+    ])
+
+    assert status == 200
+    assert [(r['status'], r.get('fields')) for r in data['results']] == [
+        ('ok', None),
+        ('error', []),
+        ('error', ['orgao']),
+        ('error', ['orgao']),
+        ('error', ['text']),
+        ('error', ['text']),
+        ('error', ['keywords']),
+        ('error', ['orgao']),
+        ('error', ['orgao']),
+    ]
+    assert db.session.query(PrePedido).count() == 1
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+
+import arrow
+
+from esiclivre.cache import LRUCache, PedidoCache
+from esiclivre.extensions import db
+from esiclivre.models import Pedido
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+
+def test_pedido_cache_loads_again_other_versions():
+    cache = PedidoCache()
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return {'loads': len(loads)}
+
+    assert cache.get('id', 1, loader, 'v1') == {'loads': 1}
+    assert cache.get('id', 1, loader, 'v1') == {'loads': 1}
+    assert cache.get('id', 1, loader, 'v2') == {'loads': 2}
+
+
+def test_pedido_changed_by_another_process_is_not_stale(client):
+    pedido = Pedido(protocol=1, description='antes',
+                    request_date=arrow.get(2015, 3, 1),
+                    updated_at=arrow.get(2015, 3, 1))
+    db.session.add(pedido)
+    db.session.commit()
+    for url in ('/pedidos/id/1', '/pedidos/protocolo/1'):
+        assert json.loads(client.get(url).data)['description'] == 'antes'
+
+    # As the browser process does, which can't reach this process cache
+    pedido.description = 'depois'
+    pedido.updated_at = arrow.get(2015, 3, 1, 0, 0, 0, 500)
+    db.session.commit()
+
+    for url in ('/pedidos/id/1', '/pedidos/protocolo/1'):
+        assert json.loads(client.get(url).data)['description'] == 'depois'
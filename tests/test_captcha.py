@@ -0,0 +1,64 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import threading
+import time
+
+import pytest
+
+from esiclivre.benchmarks import load_captcha_corpus
+from esiclivre.captcha import CaptchaPrefetcher, save_to_corpus
+from esiclivre.errors import CaptchaError
+
+
+def test_prefetcher_get_gives_up_after_timeout():
+    fetched = threading.Event()
+
+    def fetch():
+        fetched.wait()
+        raise CaptchaError('Login page without form')
+    prefetcher = CaptchaPrefetcher(fetch)
+
+    with pytest.raises(CaptchaError):
+        prefetcher.get(timeout=0.05)
+    fetched.set()
+    prefetcher.close()
+
+
+def test_prefetcher_close_does_not_wait_for_a_hung_fetch():
+    fetched = threading.Event()
+
+    def fetch():
+        fetched.wait()
+        raise CaptchaError('Login page without form')
+    prefetcher = CaptchaPrefetcher(fetch)
+
+    started = time.time()
+    prefetcher.close(timeout=0.1)
+    assert time.time() - started < 1
+    fetched.set()
+
+
+def test_prefetcher_raises_unexpected_fetch_errors():
+    def fetch():
+        raise KeyError('audio')
+    prefetcher = CaptchaPrefetcher(fetch)
+
+    with pytest.raises(CaptchaError):
+        prefetcher.get(timeout=5)
+    prefetcher.close()
+
+
+def test_failed_captchas_are_kept_unlabeled(tmpdir):
+    audio = tmpdir.join('captcha.wav')
+    audio.write('audio')
+    corpus = str(tmpdir.join('corpus'))
+
+    save_to_corpus(corpus, str(audio), 'ab12')
+    save_to_corpus(corpus, str(audio), 'xy34', solved=False)
+    save_to_corpus(corpus, str(audio), '', solved=False)
+
+    samples, unlabeled = load_captcha_corpus(corpus)
+    assert [value for _, value in samples] == ['ab12']
+    assert unlabeled == 2
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from esiclivre.control import BrowserControl
+from esiclivre.views import api
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def control(tmpdir, monkeypatch):
+    control = BrowserControl(str(tmpdir.join('browser.control')))
+    monkeypatch.setattr(api, 'control', control, raising=False)
+    return control
+
+
+def run_apart(path, code):
+    '''Runs `code` in a new process (not a fork) with `control` opened.'''
+    subprocess.check_call([
+        sys.executable, '-c',
+        'from esiclivre.control import BrowserControl\n'
+        'control = BrowserControl({!r})\n{}'.format(str(path), code),
+    ], cwd=ROOT)
+
+
+def test_control_is_shared_by_processes_created_apart(control):
+    control.set_status('Idle')
+    run_apart(control.path,
+              'assert control.status()["status"] == "Idle"\n'
+              'control.set_captcha("abc12")\n'
+              'control.request_refresh()')
+
+    assert control.get_captcha() == 'abc12'
+    assert control.take_refresh()
+    assert not control.take_refresh()
+
+
+def test_browser_of_a_dead_process_does_not_block_start(control):
+    run_apart(control.path, 'import os; control.start(os.getpid())')
+    assert control.running
+
+    assert control.start(os.getpid())
+    # But a living one does
+    run_apart(control.path, 'import os; assert not control.start(os.getpid())')
+
+
+def test_api_without_browser_controls_it(client, control):
+    assert client.get('/captcha/xyz98').status_code == 200
+    control.set_status('Waiting captcha')
+
+    status = json.loads(client.get('/browser/status').data)
+
+    assert control.get_captcha() == 'xyz98'
+    assert status['status'] == 'Waiting captcha'
+    assert status['captcha_set']
@@ -0,0 +1,57 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import time
+
+import pytest
+
+from esiclivre.downloads import DownloadWaiter
+
+
+@pytest.fixture
+def waiter(tmpdir):
+    waiter = DownloadWaiter(str(tmpdir), poll_interval=0.01)
+    yield waiter
+    waiter.close()
+
+
+def is_pdf(name):
+    return name == 'a.pdf'
+
+
+def test_files_left_before_the_download_are_not_taken(tmpdir, waiter):
+    tmpdir.join('a.pdf').write('old')
+    waiter.expect()
+
+    assert waiter.wait(is_pdf, timeout=0.05) is None
+    # Downloaded again
+    tmpdir.join('a.pdf').remove()
+    tmpdir.join('a.pdf').write('new content')
+    assert waiter.wait(is_pdf, timeout=0.05) == 'a.pdf'
+
+
+def test_stale_part_file_does_not_delay_the_download(tmpdir, waiter):
+    tmpdir.join('a.pdf.part').write('failed')
+    waiter.expect()
+    tmpdir.join('a.pdf').write('new')
+
+    start = time.time()
+    assert waiter.wait(is_pdf, timeout=5) == 'a.pdf'
+    assert time.time() - start < 1
+
+
+def test_clean_removes_only_files_left_by_the_downloads(tmpdir, waiter):
+    # As the captchas kept in the same folder
+    tmpdir.join('captcha.wav').write('not a download')
+    tmpdir.mkdir('staging').join('c.pdf').write('waiting upload')
+    waiter.expect()
+    tmpdir.join('a.pdf.part').write('failed')
+    waiter.expect()
+    tmpdir.join('b.pdf').write('never taken')
+
+    waiter.clean()
+
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        'captcha.wav', 'staging']
+    assert tmpdir.join('staging', 'c.pdf').check()
@@ -0,0 +1,35 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+
+import arrow
+
+from esiclivre.export import iter_pedidos
+from esiclivre.extensions import db
+from esiclivre.models import Pedido
+
+
+def test_export_since_includes_pedidos_without_updated_at(db_session):
+    db.session.add_all([
+        Pedido(protocol=1, updated_at=arrow.get(2015, 3, 1)),
+        Pedido(protocol=2, updated_at=arrow.get(2015, 5, 1)),
+        Pedido(protocol=3),
+    ])
+    db.session.commit()
+
+    exported = iter_pedidos(since=arrow.get(2015, 4, 1), chunk_size=2)
+
+    assert [p['protocol'] for p in exported] == [2, 3]
+
+
+def test_export_endpoint_streams_ndjson(client):
+    db.session.add_all([Pedido(protocol=p) for p in (1, 2, 3)])
+    db.session.commit()
+
+    response = client.get('/export')
+
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf8').splitlines()
+    assert [json.loads(line)['protocol'] for line in lines] == [1, 2, 3]
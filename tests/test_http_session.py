@@ -0,0 +1,121 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import threading
+import time
+
+import flask
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+from esiclivre.preprocessors.http_session import EsicSession
+
+
+LISTING = """<!DOCTYPE html>
+<html><body><form method="post" action="./consultar_pedido_v2.aspx">
+<input type="hidden" name="__VIEWSTATE" value="state" />
+<input type="hidden" name="__EVENTVALIDATION" value="valid" />
+<input type="hidden" name="__EVENTTARGET" />
+<input type="text" name="ctl00$MainContent$txt_busca" value="ignored" />
+<table id="ctl00_MainContent_grid_pedido"><tbody>
+<tr><th>Protocolo</th><th>Situação</th></tr>
+<tr><td><a href="javascript:__doPostBack('ctl00$MainContent$grid_pedido',\
+'Select$0')">1001</a></td><td>Respondido</td></tr>
+<tr><td><a href="javascript:__doPostBack('ctl00$MainContent$grid_pedido',\
+'Select$1')">1002</a></td><td>Em tramitação</td></tr>
+<tr><td><a href="javascript:__doPostBack('ctl00$MainContent$grid_pedido',\
+'Page$2')">2</a></td></tr>
+</tbody></table>
+</form></body></html>
+"""
+
+
+class FakeBrowser(object):
+
+    user_agent = 'User-Agent: esiclivre-test'
+
+    class navegador(object):
+
+        @staticmethod
+        def get_cookies():
+            return [{'name': 'ASP.NET_SessionId', 'value': 'logged',
+                     'domain': '127.0.0.1', 'path': '/'}]
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.login_url = base_url + '/login.aspx'
+
+
+def esic_app():
+    app = flask.Flask(__name__)
+    app.posts = []
+
+    @app.route('/consultar_pedido_v2.aspx', methods=['GET', 'POST'])
+    def consult():
+        if flask.request.cookies.get('ASP.NET_SessionId') != 'logged':
+            return flask.redirect('/login.aspx')
+        if flask.request.method == 'GET':
+            return LISTING
+        app.posts.append(flask.request.form.to_dict())
+        return 'pedido'
+
+    @app.route('/login.aspx')
+    def login():
+        return 'login'
+
+    @app.route('/slow.aspx')
+    def slow():
+        time.sleep(1)
+        return 'late'
+
+    return app
+
+
+@pytest.fixture
+def esic():
+    app = esic_app()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield app, 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+
+
+def test_postbacks_replay_the_hidden_fields_of_the_listing(esic):
+    app, base_url = esic
+    session = EsicSession(FakeBrowser(base_url), timeout=5)
+
+    url, page, rows = session.get_listing()
+
+    # The pager row can't be opened
+    assert [(row.protocol, row.postback) for row in rows] == [
+        (1001, ('ctl00$MainContent$grid_pedido', 'Select$0')),
+        (1002, ('ctl00$MainContent$grid_pedido', 'Select$1')),
+    ]
+    form = session.get_form(url, page)
+    assert form == (base_url + '/consultar_pedido_v2.aspx', {
+        '__VIEWSTATE': 'state',
+        '__EVENTVALIDATION': 'valid',
+        '__EVENTTARGET': '',
+    })
+
+    response = session.clone().submit(form, *rows[1].postback)
+
+    assert response.text == 'pedido'
+    assert app.posts == [{
+        '__VIEWSTATE': 'state',
+        '__EVENTVALIDATION': 'valid',
+        '__EVENTTARGET': 'ctl00$MainContent$grid_pedido',
+        '__EVENTARGUMENT': 'Select$1',
+    }]
+
+
+def test_requests_time_out(esic):
+    _, base_url = esic
+    session = EsicSession(FakeBrowser(base_url), timeout=0.1)
+
+    with pytest.raises(requests.Timeout):
+        session.get_page(base_url + '/slow.aspx')
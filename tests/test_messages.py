@@ -0,0 +1,47 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+
+import arrow
+
+from esiclivre.cutils import encode_cursor
+from esiclivre.extensions import db
+from esiclivre.models import Message, Pedido
+
+
+def get_json(client, url, **params):
+    response = client.get(url, query_string=params)
+    return response.status_code, json.loads(response.data.decode('utf8'))
+
+
+def test_messages_cursor_walks_every_message_once(client):
+    dates = [arrow.get(2015, 3, day) for day in (1, 2, 2, 2, 3, 4, 4)]
+    pedido = Pedido(protocol=1, request_date=dates[0])
+    pedido.history = [Message(date=date, justification='{}'.format(n))
+                      for n, date in enumerate(dates)]
+    db.session.add(pedido)
+    db.session.commit()
+    expected = sorted(((m.date, m.id) for m in pedido.history), reverse=True)
+
+    seen = []
+    status, page = get_json(client, '/messages', per_page_num=2)
+    while True:
+        assert status == 200
+        assert page['total'] == len(dates)
+        seen.extend((arrow.get(m['date']), m['id'])
+                    for m in page['messages'])
+        if not page['next_cursor']:
+            break
+        status, page = get_json(client, '/messages', per_page_num=2,
+                                cursor=page['next_cursor'])
+
+    assert seen == expected
+
+
+def test_messages_invalid_cursor_is_bad_request(client):
+    for cursor in ('not a cursor', encode_cursor('yesterday', 1),
+                   encode_cursor(1)):
+        status, _ = get_json(client, '/messages', cursor=cursor)
+        assert status == 400
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import imp
+import os
+
+import arrow
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+from esiclivre.extensions import db
+from esiclivre.models import Message, Pedido
+
+
+MIGRATIONS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'migrations', 'versions')
+
+
+def upgrade(revision):
+    '''Runs the upgrade of a migration on the test DB.'''
+    migration = imp.load_source(
+        'migration_' + revision,
+        os.path.join(MIGRATIONS, '{}_.py'.format(revision)))
+    with db.engine.begin() as connection:
+        with Operations.context(MigrationContext.configure(connection)):
+            migration.upgrade()
+
+
+@pytest.fixture
+def pedidos(db_session):
+    with_messages = Pedido(protocol=1, request_date=arrow.get(2015, 3, 1))
+    with_messages.history = [
+        Message(date=arrow.get(2015, 3, day), fingerprint=str(day))
+        for day in (2, 5, 3)
+    ]
+    without_messages = Pedido(protocol=2, request_date=arrow.get(2015, 4, 1))
+    updated = Pedido(protocol=3, request_date=arrow.get(2015, 5, 1),
+                     updated_at=arrow.get(2015, 6, 1))
+    db.session.add_all([with_messages, without_messages, updated])
+    db.session.commit()
+    return with_messages.id, without_messages.id, updated.id
+
+
+def test_updated_at_is_backfilled(pedidos):
+    upgrade('c3a85f1e6d07')
+
+    db.session.expire_all()
+    assert [db.session.query(Pedido).get(i).updated_at for i in pedidos] == [
+        arrow.get(2015, 3, 5), arrow.get(2015, 4, 1), arrow.get(2015, 6, 1)]
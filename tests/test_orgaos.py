@@ -0,0 +1,58 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import json
+import logging
+
+import pytest
+
+from esiclivre.browser import ESicLivre
+from esiclivre.extensions import db
+from esiclivre.models import Orgao, ResourceVersion
+
+
+@pytest.fixture
+def browser(app):
+    browser = ESicLivre()
+    browser.config(app=app, logger=logging.getLogger('test'))
+    return browser
+
+
+def orgaos(client, etag=None):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/orgaos', headers=headers)
+
+
+def test_orgaos_list_is_replaced_with_a_new_version(client, browser):
+    db.session.add(Orgao(name='SMS'))
+    ResourceVersion.bump('orgaos')
+    db.session.commit()
+    etag = orgaos(client).headers['ETag']
+
+    seen = []
+
+    def lista_de_orgaos():
+        # The list is read from eSIC before anything changes
+        response = orgaos(client, etag)
+        seen.append(response.status_code)
+        return ['SME', 'SMS']
+    browser.lista_de_orgaos = lista_de_orgaos
+    browser.update_orgaos_list()
+
+    response = orgaos(client, etag)
+    assert seen == [304]
+    assert response.status_code == 200
+    assert sorted(json.loads(response.data)['orgaos']) == ['SME', 'SMS']
+    assert ResourceVersion.current('orgaos')[0] == 2
+
+
+def test_empty_orgaos_list_keeps_the_old_one(client, browser):
+    db.session.add(Orgao(name='SMS'))
+    db.session.commit()
+    browser.lista_de_orgaos = lambda: []
+
+    browser.update_orgaos_list()
+
+    assert json.loads(orgaos(client).data)['orgaos'] == ['SMS']
+    assert ResourceVersion.current('orgaos')[0] == 0
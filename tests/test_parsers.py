@@ -0,0 +1,54 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import pytest
+
+from esiclivre.benchmarks import (ATTACHMENT_ROW, ATTACHMENTS_GRID,
+                                  pedido_fields, synthetic_pedido_page)
+from esiclivre.preprocessors.pedidos import get_parser
+
+pytest.importorskip('lxml')
+
+
+def with_grid(page, rows, outside_form=False):
+    grid = ATTACHMENTS_GRID.format(rows=rows)
+    if outside_form:
+        return page.replace('</form>', '</form>\n' + grid)
+    return page.replace('</form>', grid + '\n</form>')
+
+
+ATTACHMENTS = '\n'.join(
+    ATTACHMENT_ROW.format(number=i, date='0{}/04/2015 10:00:00'.format(i + 1))
+    for i in range(2))
+
+PAGES = {
+    'attachments': synthetic_pedido_page(1, attachments=3),
+    'no grid': synthetic_pedido_page(2, attachments=0),
+    'empty grid': with_grid(synthetic_pedido_page(3, attachments=0), ''),
+    'blank grid rows': with_grid(synthetic_pedido_page(4, attachments=0),
+                                 '<tr><td> </td><td></td><td></td></tr>'),
+    'grid outside the form': with_grid(
+        synthetic_pedido_page(5, attachments=0), ATTACHMENTS,
+        outside_form=True),
+    'no messages': synthetic_pedido_page(6, messages=0),
+    'no form': '<html><body><p>Erro.</p></body></html>',
+    'no form with grid': '<html><body>{}</body></html>'.format(
+        ATTACHMENTS_GRID.format(rows=ATTACHMENTS)),
+}
+
+
+@pytest.mark.parametrize('name', sorted(PAGES))
+def test_lxml_parses_pages_as_html5lib(name):
+    parsed = []
+    for parser in (get_parser('html5lib'), get_parser('lxml')):
+        document = parser.document(PAGES[name])
+        pedido = parser.pedido(document, None)
+        has_form = pedido._main_data is not None
+        parsed.append((
+            pedido_fields(pedido) if has_form else None,
+            parser.digest(document),
+            pedido.has_attachments_grid(),
+        ))
+
+    assert parsed[1] == parsed[0]
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import threading
+import time
+
+import pytest
+
+from esiclivre.preprocessors.pipeline import Pipeline
+
+
+def test_pipeline_persists_every_item_once():
+    persisted = []
+
+    Pipeline([lambda item: item * 2], lambda item: item + 1,
+             persisted.append).run(range(50))
+
+    # A single fetcher keeps the order
+    assert persisted == [item * 2 + 1 for item in range(50)]
+
+    persisted = []
+    Pipeline([lambda item: item] * 4, lambda item: item,
+             persisted.append, queue_size=2).run(range(200))
+
+    assert sorted(persisted) == list(range(200))
+
+
+@pytest.mark.parametrize('failing_stage', ['fetch', 'parse'])
+def test_pipeline_raises_errors_of_the_stages(failing_stage):
+    def stage(name):
+        def run(item):
+            if name == failing_stage and item == 5:
+                raise ValueError(item)
+            return item
+        return run
+
+    persisted = []
+    pipeline = Pipeline([stage('fetch')] * 2, stage('parse'),
+                        persisted.append, queue_size=2)
+
+    with pytest.raises(ValueError):
+        pipeline.run(range(1000))
+    assert 5 not in persisted
+    # The other stages stopped instead of going through every item
+    assert len(persisted) < 999
+
+
+def test_pipeline_queues_bound_the_items_ahead_of_persist():
+    fetched = []
+    release = threading.Event()
+    persisted = []
+
+    def fetch(item):
+        fetched.append(item)
+        return item
+
+    def persist(item):
+        release.wait(5)
+        persisted.append(item)
+
+    pipeline = Pipeline([fetch], lambda item: item, persist, queue_size=2)
+    runner = threading.Thread(target=pipeline.run, args=(range(100),))
+    runner.start()
+    time.sleep(0.5)
+
+    # The persisting item, 2 queued to persist, 1 parsing, 2 queued to
+    # parse and 1 fetching
+    assert len(fetched) <= 7
+    release.set()
+    runner.join(5)
+    assert persisted == list(range(100))
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import weakref
+
+import arrow
+
+from esiclivre import search
+from esiclivre.extensions import db
+from esiclivre.models import Message, Pedido
+
+
+def add_pedido(protocol, description, justification=''):
+    pedido = Pedido(protocol=protocol, description=description,
+                    request_date=arrow.get(2015, 3, 1))
+    pedido.history = [Message(justification=justification,
+                              date=arrow.get(2015, 3, 2))]
+    db.session.add(pedido)
+    db.session.flush()
+    search.update_search_index([pedido.id])
+    db.session.commit()
+    return pedido.id
+
+
+def test_search_ranks_by_full_text_index(db_session):
+    first = add_pedido(1, 'lista de escolas', 'segue a lista')
+    second = add_pedido(2, 'orçamento', 'lista de escolas anexa')
+    add_pedido(3, 'orçamento da saúde')
+
+    total, results = search.search('escolas', 0, 20)
+
+    assert total == 2
+    # Descriptions weigh more than messages
+    assert [pedido_id for pedido_id, _ in results] == [first, second]
+
+
+def test_search_without_full_text_index_uses_like(db_session, monkeypatch):
+    # As in a database with no full text search support
+    monkeypatch.setattr(search, 'CREATE_INDEX', {})
+    first = add_pedido(1, 'lista de escolas', 'segue a lista')
+    second = add_pedido(2, 'orçamento', 'lista de ESCOLAS anexa')
+    add_pedido(3, 'orçamento da saúde', '100% das escolas')
+
+    total, results = search.search('lista escolas', 0, 20)
+
+    assert total == 2
+    assert results == [(second, 0.0), (first, 0.0)]
+    # LIKE wildcards in the query are plain characters
+    assert search.search('0%', 0, 20)[0] == 1
+    assert search.search('_', 0, 20)[0] == 0
+
+
+def test_search_without_fts5_uses_like(db_session, monkeypatch):
+    # As in a SQLite build without FTS5
+    monkeypatch.setattr(search, 'FTS5_PROBE', 'SELECT no_such_function()')
+    monkeypatch.setattr(search, '_fts5_support', weakref.WeakKeyDictionary())
+    search.drop_search_index(db.engine)
+    search.create_search_index(db.engine)
+    assert not db.engine.has_table('pedido_search')
+    first = add_pedido(1, 'lista de escolas')
+    add_pedido(2, 'orçamento da saúde')
+
+    assert search.search('escolas', 0, 20) == (1, [(first, 0.0)])
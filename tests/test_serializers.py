@@ -0,0 +1,95 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import contextlib
+
+import arrow
+import pytest
+import sqlalchemy as sa
+
+from esiclivre.extensions import db, pedido_cache
+from esiclivre.models import Attachment, Author, Message, Pedido
+from esiclivre.search import update_search_index
+from esiclivre.serializers import serialize_pedidos
+from esiclivre.upserts import resolve_keywords
+
+
+def add_pedidos(protocols, messages, keywords):
+    '''Adds pedidos with these protocols, each with `messages` messages,
+    `keywords` keywords, an author and an attachment.'''
+    keywords = resolve_keywords(
+        'keyword{}'.format(i) for i in range(keywords))
+    for protocol in protocols:
+        pedido = Pedido(
+            protocol=protocol, description='pedido de teste',
+            request_date=arrow.get(2015, 3, protocol % 28 + 1),
+            orgao_name='SMS', situation='Respondido')
+        pedido.author = Author(name='author{}'.format(protocol))
+        pedido.keywords = keywords
+        pedido.history = [
+            Message(situation='Em tramitação', justification='resposta',
+                    date=arrow.get(2015, 4, i % 28 + 1))
+            for i in range(messages)
+        ]
+        pedido.attachments_recurso = [
+            Attachment(name='anexo.pdf', ia_url='https://example.com/a.pdf')]
+        db.session.add(pedido)
+    db.session.flush()
+    update_search_index()
+    db.session.commit()
+
+
+@contextlib.contextmanager
+def count_queries():
+    '''Collects the statements executed inside the block.'''
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        queries.append(statement)
+    sa.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        sa.event.remove(
+            db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def request_queries(client, url):
+    '''Returns how many queries a request made, with an empty cache.'''
+    pedido_cache.backend.clear()
+    with count_queries() as queries:
+        response = client.get(url)
+    assert response.status_code == 200
+    return len(queries)
+
+
+@pytest.mark.parametrize('url', [
+    '/keywords/keyword0',
+    '/pedidos/id/1',
+    '/pedidos/protocolo/1',
+    '/search?q=teste',
+])
+def test_pedido_endpoints_query_count_is_fixed(client, url):
+    add_pedidos([1], messages=1, keywords=1)
+    few = request_queries(client, url)
+
+    # More pedidos, with more messages and keywords each
+    add_pedidos(range(2, 31), messages=8, keywords=5)
+    many = request_queries(client, url)
+
+    assert few == many
+
+
+def test_serialize_pedidos_uses_one_query_per_relationship(db_session):
+    add_pedidos(range(1, 31), messages=8, keywords=5)
+    ids = [i for i, in db.session.query(Pedido.id)]
+
+    with count_queries() as queries:
+        pedidos = serialize_pedidos(ids)
+
+    # Pedidos, messages, authors, keywords and attachments
+    assert len(queries) == 5
+    assert len(pedidos) == 30
+    assert all(len(p['history']) == 8 and len(p['keywords']) == 5
+               for p in pedidos)
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import contextlib
+import fcntl
+import gc
+import hashlib
+import os
+import weakref
+
+import pytest
+import sqlalchemy as sa
+
+from esiclivre.benchmarks import (SyntheticListing, sync_memory,
+                                  synthetic_pedido_page)
+from esiclivre.extensions import db
+from esiclivre.models import Pedido, PedidosUpdate, UploadTask
+from esiclivre.preprocessors.http_session import Download
+from esiclivre.preprocessors.pedidos import (PedidoSaver, get_parser,
+                                             known_attachment_dates,
+                                             save_pedidos_into_db,
+                                             update_pedidos_list)
+
+
+@pytest.fixture
+def browser_engine(app, db_session, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCRAPER_ENGINE', 'browser')
+    return SyntheticListing(5, attachments=False)
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_browser_sync_saves_listing_summaries(browser_engine, incremental):
+    update_pedidos_list(browser_engine, incremental)
+
+    pedidos = db.session.query(Pedido.protocol, Pedido.listing_summary)
+    assert sorted(p for p, _ in pedidos) == [1, 2, 3, 4, 5]
+    assert all(summary for _, summary in pedidos)
+
+
+def test_unchanged_pedidos_are_skipped(browser_engine):
+    update_pedidos_list(browser_engine, False)
+    update_pedidos_list(browser_engine, False)
+
+    updates = db.session.query(PedidosUpdate.pages_fetched,
+                               PedidosUpdate.pages_skipped)
+    assert sorted(updates) == [(5, 0), (5, 5)]
+
+
+def test_unchanged_pedidos_summaries_are_updated_by_protocol(db_session):
+    # Pages of different pedidos could have the same digest
+    db.session.add_all([
+        Pedido(protocol=1, detail_digest='same', listing_summary='old'),
+        Pedido(protocol=2, detail_digest='same', listing_summary='old'),
+    ])
+    db.session.commit()
+
+    save_pedidos_into_db([], [(2, 'same', 'new')])
+
+    summaries = db.session.query(Pedido.protocol, Pedido.listing_summary)
+    assert sorted(summaries) == [(1, 'old'), (2, 'new')]
+
+
+def test_saver_does_not_keep_pages_waiting_to_be_saved(db_session):
+    parser = get_parser('html5lib')
+    saver = PedidoSaver(batch_size=10)
+    document = parser.document(synthetic_pedido_page(1, attachments=0))
+    page = weakref.ref(document)
+
+    saver(parser.pedido(document, None))
+    del document
+    gc.collect()
+
+    assert page() is None
+    saver.flush()
+    assert db.session.query(Pedido.protocol).all() == [(1,)]
+
+
+class AttachmentsSession(object):
+    '''Stands for EsicSession, downloading attachments of synthetic pedido
+    pages. Their content is the name and `version`.'''
+
+    def __init__(self, version):
+        self.version = version
+        self.downloaded = []
+
+    def download_attachments(self, url, page, folder, select):
+        downloads = []
+        for row in page.find(id='ctl00_MainContent_grid_anexos_resposta')(
+                'tr')[1:]:
+            name = row.td.text
+            if not select(name):
+                continue
+            content = '{} {}'.format(name, self.version).encode('utf8')
+            with open(os.path.join(folder, name), 'wb') as out_file:
+                out_file.write(content)
+            self.downloaded.append(name)
+            sha256 = hashlib.sha256(content).hexdigest()
+            downloads.append(Download(name, sha256, len(content)))
+        return downloads
+
+
+@contextlib.contextmanager
+def count_selects():
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.startswith('SELECT'):
+            queries.append(statement)
+    sa.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        sa.event.remove(
+            db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def save_pedidos(protocols, session, batch_size=100):
+    '''Saves synthetic pedidos with 2 attachments as the http engine does.
+    Returns the SELECTs made.'''
+    parser = get_parser('html5lib')
+    rows = [Pedido(protocol=protocol) for protocol in protocols]
+    with count_selects() as queries:
+        saver = PedidoSaver(batch_size, known_attachment_dates(rows))
+        for protocol in protocols:
+            page = synthetic_pedido_page(protocol, attachments=2)
+            saver(parser.pedido(parser.document(page), None, session, 'url'))
+        saver.flush()
+    return queries
+
+
+@pytest.fixture
+def downloads(app, db_session, tmpdir, monkeypatch):
+    monkeypatch.setitem(app.config, 'DOWNLOADS_PATH', str(tmpdir))
+    return tmpdir
+
+
+def test_saver_queries_and_queues_uploads_by_batch(downloads):
+    # Creates the orgao, author and keywords
+    save_pedidos([1], AttachmentsSession(1))
+    few = save_pedidos([2, 3], AttachmentsSession(1))
+    many = save_pedidos(range(4, 14), AttachmentsSession(1))
+
+    assert len(many) == len(few)
+    tasks = db.session.query(UploadTask.pedido_protocol, UploadTask.status)
+    assert sorted(tasks) == sorted(
+        (protocol, 'PENDING') for protocol in range(1, 14) for _ in range(2))
+    # The staging folders are unlocked
+    for protocol in range(1, 14):
+        lock_path = str(downloads.join(
+            'staging', 'pedido_{}.lock'.format(protocol)))
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_saver_downloads_only_modified_attachments(downloads):
+    save_pedidos([1, 2], AttachmentsSession(1))
+    session = AttachmentsSession(2)
+
+    save_pedidos([1, 2], session)
+
+    assert session.downloaded == []
+
+
+def test_sync_memory_does_not_grow_with_pedidos():
+    # 'manage.py benchmark memory' syncs 5,000 pedidos, which takes minutes
+    size = 300
+    growth = dict(sync_memory(size))
+
+    # Checkpoints are at each tenth of the 2 * size pages opened. The first
+    # ones also count what is loaded only once, like the listing.
+    # The first sync parses and saves them all
+    assert growth[size] - growth[2 * size // 5] < 4 * 1024
+    # The second sync skips all of them, looking up their digests
+    assert growth[2 * size] - growth[6 * size // 5] < 4 * 1024
@@ -0,0 +1,103 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+import threading
+import time
+
+import arrow
+import flask
+import pytest
+
+from esiclivre.downloads import folder_lock
+from esiclivre.extensions import db
+from esiclivre.models import UploadTask
+from esiclivre.uploader import Uploader
+
+
+class Backend(object):
+
+    def upload(self, identifier, path, metadata, name=None):
+        pass
+
+
+@pytest.fixture
+def folder(tmpdir):
+    staging = tmpdir.mkdir('staging').mkdir('pedido_1')
+    staging.join('a.pdf').write('a')
+    return staging
+
+
+def enqueue(folder, filename):
+    UploadTask.enqueue(1, str(folder), [filename])
+    db.session.commit()
+
+
+def test_task_queued_again_while_uploading_is_not_done(db_session, app,
+                                                       folder):
+    uploader = Uploader(app, Backend())
+    enqueue(folder, 'a.pdf')
+    task = uploader.claim()
+
+    # The file changed while it was uploaded
+    enqueue(folder, 'a.pdf')
+    uploader.done(task)
+
+    db.session.expire_all()
+    assert UploadTask.query.one().status == 'PENDING'
+    assert folder.join('a.pdf').check()
+
+
+@pytest.fixture
+def file_db_app(app, tmpdir):
+    '''The app on a SQLite file, as in memory each thread has its own.'''
+    file_app = flask.Flask('esiclivre')
+    file_app.config.update(
+        app.config,
+        SQLALCHEMY_DATABASE_URI='sqlite:///{}'.format(tmpdir.join('db')))
+    db.init_app(file_app)
+    with file_app.app_context():
+        db.create_all()
+        yield file_app
+        db.session.remove()
+
+
+def test_folder_is_not_removed_while_the_scraper_adds_files(file_db_app,
+                                                             folder):
+    uploader = Uploader(file_db_app, Backend())
+    enqueue(folder, 'a.pdf')
+    task_id = uploader.claim().id
+
+    def upload_done():
+        with file_db_app.app_context():
+            uploader.done(UploadTask.query.get(task_id))
+            db.session.remove()
+
+    with folder_lock(str(folder)):
+        thread = threading.Thread(target=upload_done)
+        thread.start()
+        time.sleep(0.2)
+        # As the scraper does, holding the lock
+        folder.join('b.pdf').write('b')
+        enqueue(folder, 'b.pdf')
+    thread.join()
+
+    assert folder.join('b.pdf').check()
+    assert sorted(t.status for t in UploadTask.query) == ['DONE', 'PENDING']
+
+
+def test_start_reclaims_only_stale_uploads(db_session, app, folder,
+                                           monkeypatch):
+    monkeypatch.setitem(app.config, 'UPLOAD_WORKERS', 0)
+    enqueue(folder, 'a.pdf')
+    enqueue(folder, 'b.pdf')
+    other = Uploader(app, Backend())
+    running, crashed = other.claim(), other.claim()
+    crashed.updated_at = arrow.utcnow().replace(hours=-3)
+    expected = {running.filename: 'UPLOADING', crashed.filename: 'PENDING'}
+    db.session.commit()
+
+    Uploader(app, Backend()).start()
+
+    statuses = dict((t.filename, t.status) for t in UploadTask.query)
+    assert statuses == expected
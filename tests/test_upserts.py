@@ -0,0 +1,31 @@
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from esiclivre.extensions import db
+from esiclivre.models import Keyword, PrePedido, ResourceVersion
+from esiclivre.upserts import resolve_keywords
+
+
+def test_resolve_keywords_creates_only_the_missing_ones(db_session):
+    saude, = resolve_keywords(['saúde'])
+    db.session.commit()
+
+    keywords = resolve_keywords(['educação', 'saúde', 'educação'])
+    db.session.commit()
+
+    assert [k.name for k in keywords] == ['educação', 'saúde']
+    assert keywords[1].id == saude.id
+    assert db.session.query(Keyword).count() == 2
+    assert ResourceVersion.current('keywords')[0] == 2
+
+
+def test_pre_pedido_keywords_skip_blank_names(db_session):
+    for keywords in ['', ' , ', 'saúde,, educação ,']:
+        pre_pedido = PrePedido(keywords=keywords)
+        db.session.commit()
+        assert '' not in [k.name for k in pre_pedido.all_keywords]
+
+    assert sorted(name for name, in db.session.query(Keyword.name)) == [
+        'educação', 'saúde']
+    assert PrePedido(keywords='a,,b ').as_dict['keywords'] == ['a', 'b']
@@ -17,5 +17,6 @@ execfile(activate_this, dict(__file__=activate_this))
 os.chdir(this_path)
 
 # give wsgi the "application"
-from esiclivre.app import app as application
-# application = app()
+# API only: the browser runs apart, with "python manage.py run"
+from esiclivre.app import create_api_app
+application = create_api_app()